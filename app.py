@@ -1,13 +1,51 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, has_request_context, g, make_response, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from flask_session import Session
 import os
-from datetime import datetime
+import re
+import sys
+import time
+import sqlite3
+import functools
+import secrets
+import hashlib
+import random
+import math
+import unicodedata
+import json
+import csv
+import gzip
+import io
+import zlib
+import base64
+import logging
+import mmap
+import struct
+import bisect
+import itertools
+import atexit
+import threading
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, date, timedelta, timezone
 from dotenv import load_dotenv
-from sqlalchemy import func
+from sqlalchemy import func, insert, update, or_, and_, case, literal, select, union_all, text, inspect, event, bindparam
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from markupsafe import Markup
+
+# Pillow es opcional: sin él se guardan y sirven solo las imágenes originales
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 load_dotenv()
 
 app = Flask(__name__, template_folder='Templates')
@@ -15,18 +53,572 @@ app = Flask(__name__, template_folder='Templates')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev_secret')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///site.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# Session en filesystem (útil para debug y Deploy básicos)
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
+# Ingesta de visitas: 'buffer' (write-behind en bloque) o 'sync' (un commit por clic)
+app.config['VISITAS_MODO'] = os.getenv('VISITAS_MODO', 'buffer')
+app.config['VISITAS_FLUSH_MS'] = int(os.getenv('VISITAS_FLUSH_MS', '500'))
+app.config['VISITAS_FLUSH_FILAS'] = int(os.getenv('VISITAS_FLUSH_FILAS', '200'))
+app.config['VISITAS_MAX_COLA'] = int(os.getenv('VISITAS_MAX_COLA', '10000'))
+# Tope duro de la cola: si la base sigue caída, lo más antiguo se descarta (y se cuenta) en vez de crecer sin límite
+app.config['VISITAS_LIMITE_COLA'] = int(os.getenv('VISITAS_LIMITE_COLA', '100000'))
+# Auditoría: 'async' (lotes en segundo plano con spool local) o 'sync' (en la transacción de la petición, para tests)
+app.config['AUDITORIA_MODO'] = os.getenv('AUDITORIA_MODO', 'async')
+app.config['AUDITORIA_FLUSH_MS'] = int(os.getenv('AUDITORIA_FLUSH_MS', '1000'))
+app.config['AUDITORIA_FLUSH_FILAS'] = int(os.getenv('AUDITORIA_FLUSH_FILAS', '200'))
+app.config['AUDITORIA_MAX_COLA'] = int(os.getenv('AUDITORIA_MAX_COLA', '10000'))
+app.config['AUDITORIA_LIMITE_COLA'] = int(os.getenv('AUDITORIA_LIMITE_COLA', '100000'))
+# Espera máxima entre reintentos de un buffer cuyo vaciado falla (crece al doble desde su intervalo)
+app.config['BUFFER_REINTENTO_MAX_S'] = float(os.getenv('BUFFER_REINTENTO_MAX_S', '30'))
+app.config['AUDITORIA_SPOOL_DIR'] = os.getenv('AUDITORIA_SPOOL_DIR', os.path.join(app.instance_path, 'auditoria_spool'))
+app.config['AUDITORIA_SPOOL_FSYNC'] = os.getenv('AUDITORIA_SPOOL_FSYNC', '0') == '1'
+# Segundos que vive la foto de estadísticas del panel de administración
+app.config['ESTADISTICAS_TTL'] = int(os.getenv('ESTADISTICAS_TTL', '60'))
+# PRAGMAs de SQLite aplicados a cada conexión nueva (varios workers de gunicorn sobre un mismo site.db)
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # negativo = KiB (64 MiB)
+    'temp_store': 'MEMORY',
+}
+# Retención: días que se guardan en la base (0 = para siempre); lo anterior se archiva en
+# ARCHIVO_DIR/<tabla>/<AAAA-MM>.jsonl.gz con `flask aplicar-retencion`, en lotes con pausa entre ellos
+app.config['RETENCION_VISITAS_DIAS'] = int(os.getenv('RETENCION_VISITAS_DIAS', '90'))
+app.config['RETENCION_LOGS_DIAS'] = int(os.getenv('RETENCION_LOGS_DIAS', '365'))
+app.config['RETENCION_LOTE'] = int(os.getenv('RETENCION_LOTE', '2000'))
+app.config['RETENCION_PAUSA_MS'] = int(os.getenv('RETENCION_PAUSA_MS', '50'))
+app.config['ARCHIVO_DIR'] = os.getenv('ARCHIVO_DIR', os.path.join(app.instance_path, 'archivo'))
+# Imágenes de empresas: anchos (px) de las variantes y límite de píxeles al decodificar una subida
+app.config['IMAGEN_ANCHOS'] = [int(a) for a in os.getenv('IMAGEN_ANCHOS', '320,640,1200').split(',')]
+app.config['IMAGEN_CALIDAD'] = int(os.getenv('IMAGEN_CALIDAD', '80'))
+app.config['IMAGEN_MAX_PIXELES'] = int(os.getenv('IMAGEN_MAX_PIXELES', str(40_000_000)))
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_SUBIDA_MB', '10')) * 1024 * 1024
+# Recomendaciones: peso = (1 + visitas recientes·PESO_VISITA + favoritos·PESO_FAVORITO) × impulso del plan
+app.config['RECOMENDACION_DIAS'] = int(os.getenv('RECOMENDACION_DIAS', '30'))
+app.config['RECOMENDACION_PESO_VISITA'] = float(os.getenv('RECOMENDACION_PESO_VISITA', '1'))
+app.config['RECOMENDACION_PESO_FAVORITO'] = float(os.getenv('RECOMENDACION_PESO_FAVORITO', '5'))
+app.config['RECOMENDACION_IMPULSO_PLAN'] = {'Sin Plan': 1.0, 'Valvanera': 1.5, 'Castillo Marroquin': 2.0, 'Diosa Chía': 3.0}
+# Cada cuánto se recarga el índice completo (visitas de otros workers, visitas que salen de la ventana)
+app.config['RECOMENDACION_REFRESCO_S'] = int(os.getenv('RECOMENDACION_REFRESCO_S', '600'))
+# Memoria máxima (bytes) de las tarjetas de empresa ya renderizadas
+app.config['FRAGMENTOS_MAX_BYTES'] = int(os.getenv('FRAGMENTOS_MAX_BYTES', str(8 * 1024 * 1024)))
+# Empresas por página en /<categoria> y /api/catalogo/<categoria>
+app.config['CATALOGO_POR_PAGINA'] = int(os.getenv('CATALOGO_POR_PAGINA', '24'))
+# Detector de N+1 (siempre activo en debug): una sentencia idéntica repetida N_MAS_1_REPETICIONES
+# veces desde la misma línea (de app.py o de una plantilla) en una sola petición es un N+1
+app.config['DETECTAR_N_MAS_1'] = os.getenv('DETECTAR_N_MAS_1', '0') == '1'
+app.config['N_MAS_1_REPETICIONES'] = int(os.getenv('N_MAS_1_REPETICIONES', '3'))
+# Perfil de SQL por petición (PERFIL_SQL=1): sentencias y tiempo en base de datos por endpoint, y un
+# log JSON (una línea por sentencia) de las que tardan más de PERFIL_LENTA_MS
+app.config['PERFIL_SQL'] = os.getenv('PERFIL_SQL', '0') == '1'
+app.config['PERFIL_LENTA_MS'] = float(os.getenv('PERFIL_LENTA_MS', '100'))
+app.config['PERFIL_LOG'] = os.getenv('PERFIL_LOG', os.path.join(app.instance_path, 'consultas_lentas.jsonl'))
+app.config['PERFIL_VENTANA'] = int(os.getenv('PERFIL_VENTANA', '500'))  # últimas peticiones por endpoint
+# Métricas Prometheus en /metrics: un archivo mmap por hilo de cada worker en METRICAS_DIR
+# (compartido por todos los workers de gunicorn); con METRICAS_TOKEN se exige "Authorization: Bearer <token>"
+app.config['METRICAS'] = os.getenv('METRICAS', '1') == '1'
+app.config['METRICAS_DIR'] = os.getenv('METRICAS_DIR', os.path.join(app.instance_path, 'metricas'))
+app.config['METRICAS_TOKEN'] = os.getenv('METRICAS_TOKEN')
+# Sesiones del servidor: 'sqlite' (tabla compartida entre workers), 'memoria' (LRU de un solo proceso)
+# o 'filesystem' (Flask-Session, un archivo por sesión en flask_session/)
+app.config['SESION_BACKEND'] = os.getenv('SESION_BACKEND', 'sqlite')
+app.config['SESION_MAX_MEMORIA'] = int(os.getenv('SESION_MAX_MEMORIA', '10000'))
+app.config['SESION_BARRIDO_S'] = int(os.getenv('SESION_BARRIDO_S', '300'))
+# Una sesión sin cambios solo se reescribe (para alargar su vida) cada SESION_RENOVAR_S segundos
+app.config['SESION_RENOVAR_S'] = int(os.getenv('SESION_RENOVAR_S', '300'))
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(seconds=int(os.getenv('SESION_TTL_S', str(31 * 24 * 3600))))
 
 db = SQLAlchemy(app)
+
+@event.listens_for(Engine, 'connect')
+def _configurar_sqlite(conexion_dbapi, _registro):
+    if not isinstance(conexion_dbapi, sqlite3.Connection):
+        return
+    cursor = conexion_dbapi.cursor()
+    for nombre, valor in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {nombre} = {valor}')
+    cursor.close()
+
+# -------------------------------
+# Unidad de trabajo: un único commit atómico por petición
+# -------------------------------
+def unidad_de_trabajo(vista):
+    """La vista solo añade cambios a la sesión; aquí se confirman todos juntos o ninguno."""
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        try:
+            respuesta = vista(*args, **kwargs)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return respuesta
+    return envoltura
+
+def despues_de_confirmar(funcion):
+    """Ejecuta `funcion` cuando la transacción actual se confirme (se descarta si hay rollback)."""
+    db.session.info.setdefault('al_confirmar', []).append(funcion)
+
+@event.listens_for(db.session, 'after_commit')
+def _al_confirmar(sesion):
+    if has_request_context():
+        g.commits = g.get('commits', 0) + 1
+    for funcion in sesion.info.pop('al_confirmar', []):
+        funcion()
+
+@event.listens_for(db.session, 'after_rollback')
+def _al_revertir(sesion):
+    sesion.info.pop('al_confirmar', None)
+
+@app.after_request
+def _vigilar_commits(response):
+    # Más de un commit por petición rompe la atomicidad y multiplica los fsync
+    if app.debug and g.get('commits', 0) > 1:
+        app.logger.warning('%s hizo %d commits en una sola petición', request.endpoint, g.commits)
+    return response
+
+# -------------------------------
+# Detector de N+1: sentencias SQL por petición y su origen
+# -------------------------------
+# Máximo de sentencias por endpoint; no debe crecer con el número de filas
+# (lo comprueban tests/test_presupuesto_consultas.py y `flask verificar-consultas`)
+PRESUPUESTO_CONSULTAS = {
+    'admin_dashboard': 2,
+    'api_admin_logs': 2,
+    'api_admin_empresas': 2,
+    'api_admin_exploradores': 2,
+    'auditoria_favoritos': 2,
+    'explorador_dashboard': 3,
+    'emprendedor_dashboard': 4,
+    'comida': 3,
+    'api_catalogo': 3,
+    'ver_emprendimiento': 2,
+    'ver_explorador': 2,
+    'api_empresas_similares': 4,
+    'api_recomendaciones_explorador': 6,
+}
+PRESUPUESTO_CONSULTAS_DEFECTO = 10
+
+def _origen_consulta():
+    """'archivo:línea' del marco más interno de app.py o de una plantilla que lanzó la sentencia."""
+    marco = sys._getframe(2)
+    while marco is not None:
+        plantilla = marco.f_globals.get('__jinja_template__')
+        if plantilla is not None:
+            return f'{plantilla.name}:{plantilla.get_corresponding_lineno(marco.f_lineno)}'
+        if marco.f_code.co_filename == __file__:
+            return f'app.py:{marco.f_lineno}'
+        marco = marco.f_back
+    return '?'
+
+def escuchar_sentencias(evento, oyente):
+    """Registra `oyente` en todos los Engine la primera vez que hace falta: sin detector ni perfil no cuesta nada."""
+    if not event.contains(Engine, evento, oyente):
+        event.listen(Engine, evento, oyente)
+
+def _anotar_sentencia(_conexion, _cursor, sentencia, _parametros, _contexto, _executemany):
+    if has_request_context() and 'consultas' in g:
+        g.consultas.append((sentencia, _origen_consulta()))
+
+def analizar_consultas(endpoint, consultas):
+    """Avisos de una petición: presupuesto superado y sentencias repetidas desde el mismo origen."""
+    avisos = []
+    presupuesto = PRESUPUESTO_CONSULTAS.get(endpoint, PRESUPUESTO_CONSULTAS_DEFECTO)
+    if len(consultas) > presupuesto:
+        avisos.append(f'{len(consultas)} sentencias (presupuesto {presupuesto})')
+    for (sentencia, origen), n in Counter(consultas).items():
+        if n >= app.config['N_MAS_1_REPETICIONES']:
+            avisos.append(f'posible N+1: {n} veces desde {origen}: {" ".join(sentencia.split())[:120]}')
+    return avisos
+
+@app.before_request
+def _contar_consultas():
+    if app.debug or app.config['DETECTAR_N_MAS_1']:
+        escuchar_sentencias('before_cursor_execute', _anotar_sentencia)
+        g.consultas = []
+
+@app.after_request
+def _vigilar_consultas(response):
+    if 'consultas' in g:
+        for aviso in analizar_consultas(request.endpoint, g.consultas):
+            app.logger.warning('%s: %s', request.endpoint, aviso)
+        response.headers['X-Consultas'] = str(len(g.consultas))
+    return response
+
+# -------------------------------
+# Perfil de SQL por petición y log de consultas lentas (PERFIL_SQL=1)
+# -------------------------------
+class PerfilEndpoints:
+    """Últimas PERFIL_VENTANA peticiones de cada endpoint y sus sentencias más lentas (por worker)."""
+
+    def __init__(self, ventana, lentas_por_endpoint=5):
+        self.ventana = ventana
+        self.lentas_por_endpoint = lentas_por_endpoint
+        self._peticiones = {}  # endpoint -> deque[(total_ms, db_ms, sentencias)]
+        self._lentas = {}      # endpoint -> [(ms, sentencia)] de mayor a menor
+        self._lock = threading.Lock()
+
+    def registrar(self, endpoint, total_ms, db_ms, sentencias, lentas):
+        with self._lock:
+            self._peticiones.setdefault(endpoint, deque(maxlen=self.ventana)).append((total_ms, db_ms, sentencias))
+            if lentas:
+                peores = self._lentas.get(endpoint, []) + lentas
+                self._lentas[endpoint] = sorted(peores, key=lambda p: -p[0])[:self.lentas_por_endpoint]
+
+    def top(self, n=10):
+        """Los n endpoints que más tiempo pasan en la base de datos dentro de la ventana."""
+        def p95(valores):
+            valores = sorted(valores)
+            return round(valores[min(len(valores) - 1, int(len(valores) * 0.95))], 2)
+
+        with self._lock:
+            copia = {e: list(v) for e, v in self._peticiones.items()}
+            lentas = {e: list(v) for e, v in self._lentas.items()}
+
+        filas = []
+        for endpoint, peticiones in copia.items():
+            total, db_ms, sentencias = zip(*peticiones)
+            filas.append({
+                'endpoint': endpoint,
+                'peticiones': len(peticiones),
+                'db_ms_total': round(sum(db_ms), 2),
+                'db_ms_media': round(sum(db_ms) / len(db_ms), 2),
+                'db_ms_p95': p95(db_ms),
+                'total_ms_p95': p95(total),
+                'sentencias_media': round(sum(sentencias) / len(sentencias), 1),
+                'sentencias_max': max(sentencias),
+                'mas_lentas': [{'ms': round(ms, 2), 'sentencia': sentencia} for ms, sentencia in lentas.get(endpoint, [])],
+            })
+        return sorted(filas, key=lambda f: -f['db_ms_total'])[:n]
+
+    def reiniciar(self):
+        with self._lock:
+            self._peticiones.clear()
+            self._lentas.clear()
+
+perfil_endpoints = PerfilEndpoints(app.config['PERFIL_VENTANA'])
+
+log_consultas_lentas = logging.getLogger('myiana.consultas_lentas')
+if app.config['PERFIL_SQL'] and not log_consultas_lentas.handlers:
+    os.makedirs(os.path.dirname(app.config['PERFIL_LOG']), exist_ok=True)
+    _manejador = logging.FileHandler(app.config['PERFIL_LOG'], encoding='utf-8', delay=True)
+    _manejador.setFormatter(logging.Formatter('%(message)s'))
+    log_consultas_lentas.addHandler(_manejador)
+    log_consultas_lentas.setLevel(logging.INFO)
+    log_consultas_lentas.propagate = False
+
+def _iniciar_cronometro(conexion, _cursor, _sentencia, _parametros, _contexto, _executemany):
+    if has_request_context() and 'perfil' in g:
+        conexion.info.setdefault('perfil_inicio', []).append(time.perf_counter())
+
+def _medir_sentencia(conexion, _cursor, sentencia, _parametros, _contexto, executemany):
+    inicios = conexion.info.get('perfil_inicio')
+    if not inicios or not has_request_context() or 'perfil' not in g:
+        return
+    ms = (time.perf_counter() - inicios.pop()) * 1000
+    perfil = g.perfil
+    perfil['sentencias'] += 1
+    perfil['db_ms'] += ms
+    if ms >= app.config['PERFIL_LENTA_MS']:
+        sentencia = ' '.join(sentencia.split())
+        perfil['lentas'].append((ms, sentencia[:500]))
+        # Sin parámetros: pueden llevar datos personales
+        log_consultas_lentas.info(json.dumps({
+            'fecha': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'endpoint': request.endpoint,
+            'metodo': request.method,
+            'ruta': request.path,
+            'ms': round(ms, 2),
+            'executemany': executemany,
+            'origen': _origen_consulta(),
+            'sentencia': sentencia[:2000],
+            'pid': os.getpid(),
+        }, ensure_ascii=False))
+
+@app.before_request
+def _iniciar_perfil():
+    if app.config['PERFIL_SQL']:
+        escuchar_sentencias('before_cursor_execute', _iniciar_cronometro)
+        escuchar_sentencias('after_cursor_execute', _medir_sentencia)
+        g.perfil = {'inicio': time.perf_counter(), 'sentencias': 0, 'db_ms': 0.0, 'lentas': []}
+
+@app.after_request
+def _cerrar_perfil(response):
+    perfil = g.pop('perfil', None)
+    if perfil is not None and request.endpoint != 'static':
+        total_ms = (time.perf_counter() - perfil['inicio']) * 1000
+        perfil_endpoints.registrar(request.endpoint or 'sin_ruta', total_ms, perfil['db_ms'], perfil['sentencias'], perfil['lentas'])
+        response.headers['Server-Timing'] = f'db;dur={perfil["db_ms"]:.1f};desc="{perfil["sentencias"]} sentencias", app;dur={total_ms:.1f}'
+    return response
+
+# -------------------------------
+# Métricas Prometheus (/metrics) compartidas entre workers de gunicorn
+# -------------------------------
+class ArchivoMetricas:
+    """Valores float64 de un único escritor en un archivo mmap.
+
+    Formato: [usado:u64] y entradas [largo:u32][clave utf-8][relleno a 8][valor:f64]. Otros procesos
+    lo leen sin coordinarse: `usado` se publica después de escribir cada entrada nueva.
+    """
+
+    TAMAÑO_INICIAL = 64 * 1024
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._archivo = open(ruta, 'w+b')
+        self._archivo.truncate(self.TAMAÑO_INICIAL)
+        self._mm = mmap.mmap(self._archivo.fileno(), self.TAMAÑO_INICIAL)
+        self._usado = 8
+        struct.pack_into('<Q', self._mm, 0, self._usado)
+        self._posiciones = {}
+
+    def sumar(self, clave, n):
+        pos = self._posiciones.get(clave)
+        if pos is None:
+            pos = self._agregar(clave)
+        struct.pack_into('<d', self._mm, pos, struct.unpack_from('<d', self._mm, pos)[0] + n)
+
+    def _agregar(self, clave):
+        datos = clave.encode()
+        cabecera = 4 + len(datos) + (-(4 + len(datos)) % 8)
+        fin = self._usado + cabecera + 8
+        if fin > len(self._mm):
+            tamaño = len(self._mm)
+            while tamaño < fin:
+                tamaño *= 2
+            self._mm.close()
+            self._archivo.truncate(tamaño)
+            self._mm = mmap.mmap(self._archivo.fileno(), tamaño)
+        struct.pack_into(f'<I{len(datos)}s', self._mm, self._usado, len(datos), datos)
+        pos = self._usado + cabecera
+        struct.pack_into('<d', self._mm, pos, 0.0)
+        self._usado = fin
+        struct.pack_into('<Q', self._mm, 0, fin)
+        self._posiciones[clave] = pos
+        return pos
+
+    @staticmethod
+    def leer(ruta):
+        with open(ruta, 'rb') as archivo:
+            datos = archivo.read()
+        usado = struct.unpack_from('<Q', datos, 0)[0] if len(datos) >= 8 else 0
+        pos = 8
+        while pos < usado:
+            largo = struct.unpack_from('<I', datos, pos)[0]
+            clave = datos[pos + 4:pos + 4 + largo].decode()
+            pos += 4 + largo + (-(4 + largo) % 8)
+            yield clave, struct.unpack_from('<d', datos, pos)[0]
+            pos += 8
+
+class _ArchivoNulo:
+    def sumar(self, clave, n):
+        pass
+
+class _PrestamoArchivo:
+    """Archivo de métricas prestado a un hilo; vuelve a la lista de libres cuando el hilo termina."""
+
+    def __init__(self, archivo, libres):
+        self.archivo = archivo
+        self._libres = libres
+
+    def __del__(self):
+        self._libres.append(self.archivo)
+
+class MetricasCompartidas:
+    """Contadores, gauges e histogramas de todos los workers, en archivos de METRICAS_DIR.
+
+    Cada hilo escribe en su propio archivo (<pid>-<n>.bin), así que el camino caliente no toma
+    ningún lock; /metrics suma todos los archivos. Los gauges solo cuentan procesos vivos.
+    """
+
+    def __init__(self, directorio, activo=True):
+        self.directorio = directorio
+        self.activo = activo
+        self._pid = None
+
+    def _archivo(self):
+        if self._pid != os.getpid():
+            # Primer uso en este proceso (o tras un fork): nada heredado del padre
+            self._pid = os.getpid()
+            self._libres = []
+            self._secuencia = itertools.count()
+            self._local = threading.local()
+        prestamo = getattr(self._local, 'prestamo', None)
+        if prestamo is None:
+            try:
+                archivo = self._libres.pop()
+            except IndexError:
+                archivo = self._nuevo_archivo()
+            prestamo = self._local.prestamo = _PrestamoArchivo(archivo, self._libres)
+        return prestamo.archivo
+
+    def _nuevo_archivo(self):
+        ruta = os.path.join(self.directorio, f'{self._pid}-{next(self._secuencia)}.bin')
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            return ArchivoMetricas(ruta)
+        except OSError:
+            # Las métricas nunca deben tumbar una petición: se apagan en este proceso
+            app.logger.exception('No se pudo crear %s; métricas desactivadas en este worker', ruta)
+            self.activo = False
+            return _ArchivoNulo()
+
+    def sumar(self, nombre, n=1.0, **etiquetas):
+        if self.activo:
+            self._archivo().sumar(nombre + _serie_metrica(tuple(etiquetas.items())), n)
+
+    def observar(self, nombre, valor, buckets, **etiquetas):
+        if not self.activo:
+            return
+        archivo = self._archivo()
+        serie = _serie_metrica(tuple(etiquetas.items()))
+        i = bisect.bisect_left(buckets, valor)
+        le = _numero_prometheus(buckets[i]) if i < len(buckets) else '+Inf'
+        # Bucket no acumulado; /metrics lo acumula al exportar
+        archivo.sumar(nombre + '_bucket' + serie + '\t' + le, 1)
+        archivo.sumar(nombre + '_sum' + serie, valor)
+        archivo.sumar(nombre + '_count' + serie, 1)
+
+    def totales(self):
+        """{clave: valor} sumando los archivos de todos los procesos."""
+        totales = Counter()
+        if not os.path.isdir(self.directorio):
+            return totales
+        vivos = {}
+        for nombre_archivo in os.listdir(self.directorio):
+            if not nombre_archivo.endswith('.bin'):
+                continue
+            pid = int(nombre_archivo.split('-', 1)[0])
+            if pid not in vivos:
+                vivos[pid] = _proceso_vivo(pid)
+            for clave, valor in ArchivoMetricas.leer(os.path.join(self.directorio, nombre_archivo)):
+                if vivos[pid] or METRICAS.get(clave.split('{', 1)[0], ('',))[0] != 'gauge':
+                    totales[clave] += valor
+        return totales
+
+    def exportar(self):
+        """Texto en formato de exposición de Prometheus."""
+        totales = self.totales()
+        lineas = []
+        for nombre, (tipo, ayuda) in METRICAS.items():
+            lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} {tipo}']
+            if tipo != 'histogram':
+                lineas += [f'{clave} {_numero_prometheus(v)}' for clave, v in sorted(totales.items())
+                           if clave.split('{', 1)[0] == nombre]
+                continue
+
+            # Serie = etiquetas sin `le` ('' o '{endpoint="...",...}')
+            buckets = {}
+            for clave, v in totales.items():
+                if clave.startswith(nombre + '_bucket'):
+                    serie, le = clave[len(nombre + '_bucket'):].split('\t')
+                    buckets.setdefault(serie, {})[le] = v
+            for serie in sorted(buckets):
+                previas = serie[1:-1] + ',' if serie else ''
+                acumulado = 0
+                for le in sorted(buckets[serie], key=float) + ([] if '+Inf' in buckets[serie] else ['+Inf']):
+                    acumulado += buckets[serie].get(le, 0)
+                    lineas.append(f'{nombre}_bucket{{{previas}le="{le}"}} {_numero_prometheus(acumulado)}')
+                for sufijo in ('_sum', '_count'):
+                    lineas.append(f'{nombre}{sufijo}{serie} {_numero_prometheus(totales[nombre + sufijo + serie])}')
+        return '\n'.join(lineas) + '\n'
+
+    def limpiar_muertos(self):
+        """Borra los archivos de procesos que ya terminaron; devuelve cuántos."""
+        borrados = 0
+        for nombre_archivo in os.listdir(self.directorio) if os.path.isdir(self.directorio) else []:
+            if nombre_archivo.endswith('.bin') and not _proceso_vivo(int(nombre_archivo.split('-', 1)[0])):
+                os.remove(os.path.join(self.directorio, nombre_archivo))
+                borrados += 1
+        return borrados
+
+@functools.lru_cache(maxsize=4096)
+def _serie_metrica(etiquetas):
+    """'{a="x",b="y"}' para las etiquetas ((a, x), (b, y)); '' sin etiquetas."""
+    if not etiquetas:
+        return ''
+    pares = ','.join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for k, v in sorted(etiquetas))
+    return f'{{{pares}}}'
+
+def _numero_prometheus(valor):
+    return repr(float(valor)) if valor != int(valor) else str(int(valor))
+
+# nombre -> (tipo, ayuda)
+METRICAS = {
+    'myiana_http_duracion_segundos': ('histogram', 'Latencia de las peticiones por endpoint y método'),
+    'myiana_http_respuestas_total': ('counter', 'Respuestas por endpoint y código de estado'),
+    'myiana_http_en_curso': ('gauge', 'Peticiones en curso en los workers vivos'),
+    'myiana_db_checkout_segundos': ('histogram', 'Espera para obtener una conexión del pool de SQLAlchemy'),
+    'myiana_visitas_total': ('counter', 'Visitas registradas (confirmadas en la base de datos)'),
+    'myiana_favoritos_total': ('counter', 'Favoritos agregados y quitados'),
+    'myiana_logins_total': ('counter', 'Inicios de sesión por resultado'),
+    'myiana_buffer_descartadas_total': ('counter', 'Filas descartadas por un buffer lleno con la base caída'),
+}
+BUCKETS_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CHECKOUT = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+metricas = MetricasCompartidas(app.config['METRICAS_DIR'], activo=app.config['METRICAS'])
+
+def _cronometrar_checkout(pool):
+    """Mide cada pool.connect() (la espera por una conexión libre, o abrir una nueva)."""
+    conectar = pool.connect
+
+    @functools.wraps(conectar)
+    def connect():
+        inicio = time.perf_counter()
+        try:
+            return conectar()
+        finally:
+            metricas.observar('myiana_db_checkout_segundos', time.perf_counter() - inicio, BUCKETS_CHECKOUT)
+    pool.connect = connect
+
+if app.config['METRICAS']:
+    with app.app_context():
+        # engine.dispose() crea un pool nuevo sin este cronómetro
+        _cronometrar_checkout(db.engine.pool)
+
+@app.before_request
+def _abrir_metricas():
+    if metricas.activo:
+        g.metricas_inicio = time.perf_counter()
+        metricas.sumar('myiana_http_en_curso', 1)
+
+@app.after_request
+def _registrar_metricas(response):
+    inicio = g.get('metricas_inicio')
+    if inicio is not None:
+        endpoint = request.endpoint or 'sin_ruta'
+        metricas.observar('myiana_http_duracion_segundos', time.perf_counter() - inicio, BUCKETS_HTTP,
+                          endpoint=endpoint, metodo=request.method)
+        metricas.sumar('myiana_http_respuestas_total', endpoint=endpoint, codigo=response.status_code)
+    return response
+
+@app.teardown_request
+def _cerrar_metricas(_error):
+    # teardown corre siempre, también si la vista lanzó una excepción
+    if g.pop('metricas_inicio', None) is not None:
+        metricas.sumar('myiana_http_en_curso', -1)
+
+@app.route('/metrics')
+def metrics():
+    """Métricas de todos los workers en formato de texto de Prometheus."""
+    token = app.config['METRICAS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'No autorizado'}), 403
+    return app.response_class(metricas.exportar(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.cli.command('limpiar-metricas')
+def limpiar_metricas():
+    """Borra los archivos de métricas de workers que ya terminaron (sus contadores vuelven a cero)."""
+    print(f'{metricas.limpiar_muertos()} archivo(s) borrado(s)')
 # Modelo de usuario
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
-    role = db.Column(db.String(20), nullable=False, default='Explorador')
+    role = db.Column(db.String(20), nullable=False, default='Explorador', index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Relaciones con los modelos de detalle (añadimos cascade)
@@ -42,7 +634,7 @@ class User(db.Model):
 
 class Explorador(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
 
     primer_nombre = db.Column(db.String(50))
     segundo_nombre = db.Column(db.String(50))
@@ -54,7 +646,7 @@ class Explorador(db.Model):
 
 class Emprendedor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
 
     # Datos personales
     primer_nombre = db.Column(db.String(50))
@@ -69,7 +661,7 @@ class Empresa(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre_emprendimiento = db.Column(db.String(100), nullable=False)
     nit = db.Column(db.String(30), unique=True, nullable=False)
-    clasificacion = db.Column(db.String(50))
+    clasificacion = db.Column(db.String(50), index=True)
     plan = db.Column(db.String(50), default='Sin Plan')
     zona = db.Column(db.String(100))
     ubicacion = db.Column(db.String(100))
@@ -77,11 +669,22 @@ class Empresa(db.Model):
     url = db.Column(db.String(200))
     rango_precios = db.Column(db.String(50))          # nuevo: ejemplo "$ - $$ - $$$"
     imagen_filename = db.Column(db.String(200))       # nuevo: nombre de archivo en static/uploads/
+    imagen_variantes = db.Column(db.String(100))      # anchos generados en static/Empresas/variantes/, p. ej. "320,640,1200"
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # sube con cada edición (caché de tarjetas)
+    # Contadores desnormalizados: se actualizan con UPDATE ... SET n = n + 1 (ver sumar_contador_empresa)
+    favoritos_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    visitas_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
-    emprendedor_id = db.Column(db.Integer, db.ForeignKey('emprendedor.id'))
-    visitas = db.relationship('Visita', backref='empresa', lazy=True)
+    emprendedor_id = db.Column(db.Integer, db.ForeignKey('emprendedor.id'), index=True)
+    # passive_deletes: al borrar la empresa no se cargan sus visitas (eliminar_emprendimiento las borra en bloque)
+    visitas = db.relationship('Visita', backref='empresa', lazy=True, passive_deletes=True)
     favoritos = db.relationship('Favorito', backref='empresa', lazy=True)  # relación
 
+# Búsquedas de categoría sin distinguir mayúsculas (func.lower(Empresa.clasificacion) == ...)
+db.Index('ix_empresa_clasificacion_lower', func.lower(Empresa.clasificacion))
+# Listados de categoría ordenados por popularidad
+db.Index('ix_empresa_clasificacion_favoritos', func.lower(Empresa.clasificacion), Empresa.favoritos_count.desc())
+
 class Favorito(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     explorador_id = db.Column(db.Integer, db.ForeignKey('explorador.id'), nullable=False)
@@ -90,6 +693,11 @@ class Favorito(db.Model):
 
     explorador = db.relationship('Explorador', backref='favoritos')
 
+    __table_args__ = (
+        db.Index('uq_favorito_explorador_empresa', 'explorador_id', 'empresa_id', unique=True),
+        db.Index('ix_favorito_empresa_id', 'empresa_id'),
+    )
+
 class Visita(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'))
@@ -97,22 +705,818 @@ class Visita(db.Model):
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
     tipo = db.Column(db.String(50), default='clic')  # clic, guardado, etc.
 
+    __table_args__ = (
+        db.Index('ix_visita_empresa_fecha', 'empresa_id', 'fecha'),
+        db.Index('ix_visita_fecha', 'fecha'),
+    )
+
+# Conteo pre-agregado de visitas por empresa, día y hora.
+# Las gráficas de /api/visitas/... leen de aquí en vez de recorrer Visita.
+class VisitaDiaria(db.Model):
+    __tablename__ = 'visita_diaria'
+
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), primary_key=True)
+    dia = db.Column(db.Date, primary_key=True)
+    hora = db.Column(db.Integer, primary_key=True)  # 0-23
+    dia_semana = db.Column(db.Integer, nullable=False)  # Lunes=0, Domingo=6
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_visita_diaria_empresa_semana', 'empresa_id', 'dia_semana', 'dia', 'total'),
+    )
+
+def sumar_visitas_diarias(conteos):
+    """Suma al rollup los conteos {(empresa_id, dia, hora): n} en una sola sentencia (upsert)."""
+    if not conteos:
+        return
+
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    filas = [
+        {'empresa_id': empresa_id, 'dia': dia, 'hora': hora, 'dia_semana': dia.weekday(), 'total': n}
+        for (empresa_id, dia, hora), n in conteos.items()
+    ]
+    stmt = upsert(VisitaDiaria)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['empresa_id', 'dia', 'hora'],
+        set_={'total': VisitaDiaria.total + stmt.excluded.total}
+    )
+    db.session.execute(stmt, filas)
+
+    por_empresa = Counter()
+    for (empresa_id, _dia, _hora), n in conteos.items():
+        por_empresa[empresa_id] += n
+    tabla = Empresa.__table__
+    db.session.execute(
+        tabla.update().where(tabla.c.id == bindparam('b_id'))
+        .values(visitas_count=tabla.c.visitas_count + bindparam('b_n')),
+        [{'b_id': empresa_id, 'b_n': n} for empresa_id, n in por_empresa.items()]
+    )
+    despues_de_confirmar(functools.partial(indice_recomendaciones.sumar_visitas, por_empresa))
+    despues_de_confirmar(functools.partial(metricas.sumar, 'myiana_visitas_total', sum(por_empresa.values())))
+
+def sumar_contador_empresa(empresa_id, columna, delta):
+    """UPDATE empresa SET <columna> = <columna> + delta dentro de la transacción actual; devuelve el valor nuevo."""
+    tabla = Empresa.__table__
+    # Sentencia Core: no pasa por el before_flush, así que no sube Empresa.version ni invalida la tarjeta
+    return db.session.execute(
+        tabla.update().where(tabla.c.id == empresa_id)
+        .values({columna: tabla.c[columna] + delta})
+        .returning(tabla.c[columna])
+    ).scalar()
+
 class LogAccion(db.Model):
     __tablename__ = 'log_accion'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     tipo_entidad = db.Column(db.String(100))  # Ej: "Usuario", "Emprendimiento"
     entidad_id = db.Column(db.Integer, nullable=True)  # ID del registro afectado
     accion = db.Column(db.String(200))  # Ej: "Creación", "Eliminación", "Modificación"
     detalles = db.Column(db.Text)  # Texto libre con información adicional
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Referencias tipadas para filtrar sin recorrer `detalles`
+    empresa_id = db.Column(db.Integer, nullable=True)  # empresa afectada (sin FK: el log sobrevive al borrado)
+    rol_actor = db.Column(db.String(20), nullable=True)  # rol de quien hizo la acción
+    codigo_accion = db.Column(db.String(40), nullable=True, index=True)  # Ej: "FAVORITO_AGREGAR"
+
     user = db.relationship('User', backref='acciones_log')
 
+    __table_args__ = (
+        db.Index('ix_log_accion_tipo_fecha', 'tipo_entidad', 'fecha'),
+        db.Index('ix_log_accion_fecha', 'fecha'),
+        db.Index('ix_log_accion_empresa_fecha', 'empresa_id', 'fecha'),
+    )
+
     def __repr__(self):
         return f"<LogAccion {self.id} - {self.accion} - {self.tipo_entidad}>"
 
+# Códigos normalizados de acción (LogAccion.codigo_accion)
+USUARIO_CREAR = 'USUARIO_CREAR'
+EMPRESA_CREAR = 'EMPRESA_CREAR'
+EMPRESA_EDITAR = 'EMPRESA_EDITAR'
+EMPRENDEDOR_ELIMINAR = 'EMPRENDEDOR_ELIMINAR'
+EXPLORADOR_EDITAR = 'EXPLORADOR_EDITAR'
+EXPLORADOR_ELIMINAR = 'EXPLORADOR_ELIMINAR'
+FAVORITO_AGREGAR = 'FAVORITO_AGREGAR'
+FAVORITO_ELIMINAR = 'FAVORITO_ELIMINAR'
+EMPRESAS_IMPORTAR = 'EMPRESAS_IMPORTAR'
+USUARIOS_IMPORTAR = 'USUARIOS_IMPORTAR'
+RETENCION_ARCHIVAR = 'RETENCION_ARCHIVAR'
+
+def registrar_auditoria(accion, codigo, detalles, entidad_id=None, tipo_entidad=None,
+                        empresa_id=None, user_id=None, rol_actor=None):
+    """Registra un LogAccion junto con el commit de quien llama.
+
+    En modo 'sync' el log entra en la misma transacción; en modo 'async' se
+    encola al confirmarse la transacción y lo escribe el buffer de auditoría.
+    """
+    if has_request_context():
+        user_id = user_id if user_id is not None else session.get('user_id')
+        rol_actor = rol_actor or session.get('role')
+
+    datos = {
+        'user_id': user_id,
+        'tipo_entidad': tipo_entidad,
+        'entidad_id': entidad_id,
+        'accion': accion,
+        'detalles': detalles,
+        'empresa_id': empresa_id,
+        'rol_actor': rol_actor,
+        'codigo_accion': codigo
+    }
+
+    if app.config['AUDITORIA_MODO'] == 'sync':
+        log = LogAccion(**datos)
+        db.session.add(log)
+        return log
+
+    # Solo se encola si la transacción de la petición se confirma
+    datos['fecha'] = datetime.utcnow()
+    despues_de_confirmar(lambda: buffer_auditoria.agregar(datos))
+    return datos
+
+# -------------------------------
+# Buffer de escritura (write-behind)
+# -------------------------------
+# Registro de buffers activos, para exponer sus estadísticas en /admin/buffers
+BUFFERS = {}
+
+class BufferEscritura:
+    """Acumula filas en memoria y las escribe en bloque desde un hilo en segundo plano.
+
+    Se vacía cada `intervalo_ms` o cuando hay `max_filas` pendientes. Si la cola
+    llega a `max_cola`, el hilo de la petición vacía en línea (back-pressure), salvo
+    que el último vaciado haya fallado: entonces solo avisa al hilo, que reintenta con
+    espera creciente. Por encima de `limite_cola` se descartan las filas más antiguas.
+    """
+
+    def __init__(self, nombre, escribir, intervalo_ms, max_filas, max_cola, limite_cola):
+        self.nombre = nombre
+        self._escribir = escribir  # función(lista_de_filas), se llama dentro de app_context
+        self.intervalo = intervalo_ms / 1000.0
+        self.max_filas = max_filas
+        self.max_cola = max_cola
+        self.limite_cola = max(limite_cola, max_cola)
+        self._reiniciar()
+        BUFFERS[nombre] = self
+        atexit.register(self.detener)
+
+    def _reiniciar(self):
+        # Tras un fork (gunicorn --preload) el hilo y los locks del padre no sirven
+        self._pid = os.getpid()
+        self._cola = deque()
+        self._lock = threading.Lock()
+        self._lock_vaciado = threading.Lock()
+        self._evento = threading.Event()
+        self._hilo = None
+        self._detenido = False
+        self._recientes = deque(maxlen=600)  # (timestamp, filas) de los últimos vaciados
+        self.flushes_total = 0
+        self.filas_total = 0
+        self.errores = 0
+        self.descartadas = 0
+        self.fallos_seguidos = 0
+        self._reintentar_en = 0.0  # time.monotonic() antes del cual no se reintenta tras un error
+        self.max_profundidad = 0
+        self.ultimo_flush_ms = 0.0
+
+    def agregar(self, fila):
+        if self._pid != os.getpid():
+            self._reiniciar()
+
+        with self._lock:
+            self._al_agregar(fila)
+            self._cola.append(fila)
+            descartadas = self._recortar()
+            profundidad = len(self._cola)
+            self.max_profundidad = max(self.max_profundidad, profundidad)
+        self._avisar_descarte(descartadas)
+
+        # Con la base fallando, vaciar en línea solo dejaría a la petición esperando detrás del reintento
+        if profundidad >= self.max_cola and not self.fallos_seguidos:
+            self.vaciar()
+            return
+
+        if self._hilo is None or not self._hilo.is_alive():
+            self._iniciar_hilo()
+        if profundidad >= self.max_filas:
+            self._evento.set()
+
+    def _iniciar_hilo(self):
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive():
+                return
+            self._hilo = threading.Thread(target=self._bucle, name=f'buffer-{self.nombre}', daemon=True)
+            self._hilo.start()
+
+    def _bucle(self):
+        self._al_iniciar_hilo()
+        while not self._detenido:
+            self._evento.wait(self.intervalo)
+            self._evento.clear()
+            self.vaciar()
+
+    def _recortar(self):
+        """Descarta lo más antiguo por encima de limite_cola; se llama con self._lock tomado."""
+        sobrantes = len(self._cola) - self.limite_cola
+        if sobrantes <= 0:
+            return 0
+        filas = [self._cola.popleft() for _ in range(sobrantes)]
+        self.descartadas += sobrantes
+        self._al_descartar(filas)
+        return sobrantes
+
+    def _avisar_descarte(self, descartadas):
+        if descartadas:
+            metricas.sumar('myiana_buffer_descartadas_total', descartadas, buffer=self.nombre)
+            app.logger.error('Buffer %s lleno (%d filas): %d descartadas', self.nombre, self.limite_cola, descartadas)
+
+    # Ganchos para subclases (p. ej. el spool de auditoría); se llaman con self._lock tomado
+    def _al_agregar(self, fila):
+        pass
+
+    def _al_descartar(self, filas):
+        pass
+
+    def _al_tomar_lote(self):
+        return None
+
+    def _al_confirmar_lote(self, lote):
+        pass
+
+    def _al_fallar_lote(self, lote):
+        pass
+
+    def _al_iniciar_hilo(self):
+        pass
+
+    def vaciar(self, forzar=False):
+        with self._lock_vaciado:
+            if not forzar and time.monotonic() < self._reintentar_en:
+                return  # esperando para reintentar tras un error
+            with self._lock:
+                filas = list(self._cola)
+                self._cola.clear()
+                lote = self._al_tomar_lote() if filas else None
+            if not filas:
+                return
+
+            inicio = time.perf_counter()
+            try:
+                with app.app_context():
+                    self._escribir(filas)
+            except Exception:
+                # Se devuelven a la cola para reintentar, cada vez con más espera
+                self.errores += 1
+                self.fallos_seguidos += 1
+                espera = min(self.intervalo * 2 ** self.fallos_seguidos, app.config['BUFFER_REINTENTO_MAX_S'])
+                self._reintentar_en = time.monotonic() + espera
+                app.logger.exception('Error vaciando el buffer %s (%d filas); reintento en %.1f s',
+                                     self.nombre, len(filas), espera)
+                with self._lock:
+                    self._cola.extendleft(reversed(filas))
+                    self._al_fallar_lote(lote)
+                    descartadas = self._recortar()
+                self._avisar_descarte(descartadas)
+                return
+
+            self.fallos_seguidos = 0
+            self._reintentar_en = 0.0
+            with self._lock:
+                self._al_confirmar_lote(lote)
+            self.ultimo_flush_ms = (time.perf_counter() - inicio) * 1000
+            self.flushes_total += 1
+            self.filas_total += len(filas)
+            self._recientes.append((time.time(), len(filas)))
+
+    def detener(self):
+        """Drena la cola al apagar el worker."""
+        if self._pid != os.getpid():
+            return
+        self._detenido = True
+        self._evento.set()
+        if self._hilo is not None and self._hilo.is_alive():
+            self._hilo.join(timeout=5)
+        self.vaciar(forzar=True)
+
+    def estadisticas(self):
+        hace_un_minuto = time.time() - 60
+        recientes = [(t, n) for t, n in list(self._recientes) if t >= hace_un_minuto]
+        return {
+            'profundidad_cola': len(self._cola),
+            'max_profundidad': self.max_profundidad,
+            'flushes_total': self.flushes_total,
+            'filas_total': self.filas_total,
+            'errores': self.errores,
+            'descartadas': self.descartadas,
+            'fallos_seguidos': self.fallos_seguidos,
+            'flushes_por_minuto': len(recientes),
+            'filas_por_segundo': round(sum(n for _, n in recientes) / 60.0, 2),
+            'ultimo_flush_ms': round(self.ultimo_flush_ms, 2),
+        }
+
+def _escribir_visitas(filas):
+    db.session.execute(insert(Visita), filas)
+    sumar_visitas_diarias(Counter((f['empresa_id'], f['fecha'].date(), f['fecha'].hour) for f in filas))
+    db.session.commit()
+
+buffer_visitas = BufferEscritura(
+    'visitas',
+    _escribir_visitas,
+    intervalo_ms=app.config['VISITAS_FLUSH_MS'],
+    max_filas=app.config['VISITAS_FLUSH_FILAS'],
+    max_cola=app.config['VISITAS_MAX_COLA'],
+    limite_cola=app.config['VISITAS_LIMITE_COLA']
+)
+
+# -------------------------------
+# Auditoría asíncrona con spool local (al menos una vez)
+# -------------------------------
+class BufferAuditoria(BufferEscritura):
+    """Buffer de LogAccion que además anota cada evento en un spool por proceso.
+
+    El spool se rota al tomar cada lote y se borra cuando el lote queda escrito,
+    así un worker que muere deja sus eventos pendientes en disco para reenviarlos.
+
+    No cubre la ventana entre el commit de la petición y la escritura en el spool
+    (el evento se anota en el hook after_commit): si el proceso muere justo ahí, el
+    evento se pierde. Anotarlo antes del commit reenviaría eventos de transacciones
+    revertidas, que es peor para una auditoría.
+    """
+
+    def __init__(self, *args, directorio, fsync=False, **kwargs):
+        self.directorio = directorio
+        self.fsync = fsync
+        super().__init__(*args, **kwargs)
+
+    def _reiniciar(self):
+        super()._reiniciar()
+        self._archivo = None
+        self._segmento = 0
+        self._pendientes = []  # segmentos rotados aún no confirmados
+
+    def _ruta_spool(self):
+        return os.path.join(self.directorio, f'auditoria-{self._pid}.jsonl')
+
+    def _al_agregar(self, fila):
+        if self._archivo is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            self._archivo = open(self._ruta_spool(), 'a', encoding='utf-8')
+        self._archivo.write(json.dumps(fila, default=_json_fecha) + '\n')
+        self._archivo.flush()
+        if self.fsync:
+            os.fsync(self._archivo.fileno())
+
+    def _al_tomar_lote(self):
+        if self._archivo is None:
+            return list(self._pendientes)
+        self._archivo.close()
+        self._archivo = None
+        self._segmento += 1
+        rotado = os.path.join(self.directorio, f'auditoria-{self._pid}-{self._segmento}.enviando')
+        try:
+            os.replace(self._ruta_spool(), rotado)
+            self._pendientes.append(rotado)
+        except FileNotFoundError:
+            # Alguien reclamó o borró el spool; los eventos siguen en memoria
+            pass
+        return list(self._pendientes)
+
+    def _al_descartar(self, filas):
+        # Los segmentos pendientes se borrarán con el próximo lote confirmado: las filas que
+        # salen de memoria quedan en un segmento propio, que se reenvía cuando este proceso
+        # termine (o con `flask reenviar-auditoria --todos` desde otro)
+        os.makedirs(self.directorio, exist_ok=True)
+        self._segmento += 1
+        ruta = os.path.join(self.directorio, f'auditoria-{self._pid}-{self._segmento}.enviando')
+        with open(ruta, 'w', encoding='utf-8') as archivo:
+            for fila in filas:
+                archivo.write(json.dumps(fila, default=_json_fecha) + '\n')
+
+    def _al_confirmar_lote(self, lote):
+        for ruta in lote or []:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+            if ruta in self._pendientes:
+                self._pendientes.remove(ruta)
+
+    def _al_iniciar_hilo(self):
+        try:
+            reenviar_spool_auditoria(self.directorio)
+        except Exception:
+            app.logger.exception('No se pudo reenviar el spool de auditoría')
+
+def _json_fecha(valor):
+    if isinstance(valor, date):  # también datetime
+        return valor.isoformat()
+    raise TypeError(f'No serializable: {valor!r}')
+
+def _proceso_vivo(pid):
+    if os.name == 'nt':
+        # En Windows os.kill(pid, 0) no sondea: envía CTRL_C_EVENT al grupo de procesos
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        manejador = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not manejador:
+            return kernel32.GetLastError() == 5  # ERROR_ACCESS_DENIED: existe, pero es de otro usuario
+        try:
+            codigo = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(manejador, ctypes.byref(codigo)):
+                return True
+            return codigo.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(manejador)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def reenviar_spool_auditoria(directorio, todos=False):
+    """Escribe los eventos que dejaron en el spool procesos ya terminados; devuelve cuántos.
+
+    También recoge los `reenvio-<pid>-…` de un reenvío que murió a medias. Si la escritura
+    falla, el archivo vuelve a su nombre original para el siguiente intento.
+    """
+    if not os.path.isdir(directorio):
+        return 0
+
+    total = 0
+    for nombre in sorted(os.listdir(directorio)):
+        encontrado = re.match(r'(?:reenvio-(\d+)-)?(auditoria-(\d+)(?:-\d+)?\.(?:jsonl|enviando))$', nombre)
+        if not encontrado:
+            continue
+        # Dueño: quien lo estaba reenviando o, si nadie, el worker que lo escribió
+        pid = int(encontrado.group(1) or encontrado.group(3))
+        if pid == os.getpid() or (not todos and _proceso_vivo(pid)):
+            continue
+
+        # Renombrar es atómico: solo un worker se queda con cada archivo
+        origen = os.path.join(directorio, nombre)
+        original = os.path.join(directorio, encontrado.group(2))
+        reclamado = os.path.join(directorio, f'reenvio-{os.getpid()}-{encontrado.group(2)}')
+        try:
+            os.replace(origen, reclamado)
+        except FileNotFoundError:
+            continue
+
+        try:
+            with open(reclamado, encoding='utf-8') as archivo:
+                eventos = [json.loads(linea) for linea in archivo if linea.strip()]
+            for evento in eventos:
+                if evento.get('fecha'):
+                    evento['fecha'] = datetime.fromisoformat(evento['fecha'])
+
+            with app.app_context():
+                try:
+                    for i in range(0, len(eventos), 1000):
+                        db.session.execute(insert(LogAccion), eventos[i:i + 1000])
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+        except Exception:
+            os.replace(reclamado, original)
+            raise
+        os.remove(reclamado)
+        total += len(eventos)
+    return total
+
+def _escribir_auditoria(filas):
+    db.session.execute(insert(LogAccion), filas)
+    db.session.commit()
+
+buffer_auditoria = BufferAuditoria(
+    'auditoria',
+    _escribir_auditoria,
+    intervalo_ms=app.config['AUDITORIA_FLUSH_MS'],
+    max_filas=app.config['AUDITORIA_FLUSH_FILAS'],
+    max_cola=app.config['AUDITORIA_MAX_COLA'],
+    limite_cola=app.config['AUDITORIA_LIMITE_COLA'],
+    directorio=app.config['AUDITORIA_SPOOL_DIR'],
+    fsync=app.config['AUDITORIA_SPOOL_FSYNC']
+)
+
+# -------------------------------
+# Imágenes de empresas: variantes redimensionadas (WebP + JPEG)
+# -------------------------------
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = app.config['IMAGEN_MAX_PIXELES']
+
+def _base_variante(nombre_archivo):
+    # Con la extensión: foo.jpg y foo.png no comparten variantes (foo-jpg_320.webp, foo-png_320.webp)
+    raiz, extension = os.path.splitext(nombre_archivo)
+    return secure_filename(f"{raiz}-{extension.lstrip('.').lower()}" if extension else raiz)
+
+def _ruta_variante(nombre_archivo, ancho, formato):
+    return os.path.join(app.static_folder, 'Empresas', 'variantes', f'{_base_variante(nombre_archivo)}_{ancho}.{formato}')
+
+def generar_variantes(nombre_archivo):
+    """Decodifica una sola vez static/Empresas/<nombre_archivo> y guarda cada ancho en WebP y JPEG.
+
+    Devuelve el texto para Empresa.imagen_variantes, o None si Pillow no está instalado.
+    Lanza ValueError si el archivo no es una imagen o supera IMAGEN_MAX_PIXELES.
+    """
+    if Image is None:
+        return None
+
+    origen = os.path.join(app.static_folder, 'Empresas', nombre_archivo)
+    calidad = app.config['IMAGEN_CALIDAD']
+    try:
+        with Image.open(origen) as original:
+            # Aún solo se ha leído la cabecera: se rechaza antes de reservar memoria para los píxeles
+            if original.width * original.height > app.config['IMAGEN_MAX_PIXELES']:
+                raise ValueError(f'La imagen es demasiado grande ({original.width}x{original.height} px).')
+            mayor = max(app.config['IMAGEN_ANCHOS'])
+            # Los JPEG se decodifican directamente a escala reducida (1/2, 1/4, 1/8)
+            original.draft('RGB', (mayor, mayor))
+            img = ImageOps.exif_transpose(original).convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError('El archivo subido no es una imagen válida.') from e
+
+    anchos = sorted({min(a, img.width) for a in app.config['IMAGEN_ANCHOS']}, reverse=True)
+    os.makedirs(os.path.dirname(_ruta_variante(nombre_archivo, 0, 'jpg')), exist_ok=True)
+    # De mayor a menor: cada variante se reduce a partir de la anterior
+    for ancho in anchos:
+        if ancho < img.width:
+            img = img.resize((ancho, max(1, round(img.height * ancho / img.width))), Image.Resampling.LANCZOS)
+        img.save(_ruta_variante(nombre_archivo, ancho, 'webp'), 'WEBP', quality=calidad, method=4)
+        img.save(_ruta_variante(nombre_archivo, ancho, 'jpg'), 'JPEG', quality=calidad, optimize=True, progressive=True)
+    return ','.join(str(a) for a in sorted(anchos))
+
+def _urls_variantes(nombre_archivo, variantes, formato):
+    return [(url_for('static', filename=f'Empresas/variantes/{_base_variante(nombre_archivo)}_{a}.{formato}'), int(a))
+            for a in variantes.split(',')]
+
+@app.template_global()
+def imagen_empresa(nombre_archivo, variantes, defecto='Imagenes/placeholder.png'):
+    """src y srcset (WebP y JPEG) para <picture>; sin variantes se usa el original."""
+    if not nombre_archivo:
+        return {'src': url_for('static', filename=defecto), 'srcset_webp': None, 'srcset_jpg': None}
+    if not variantes:
+        return {'src': url_for('static', filename=f'Empresas/{nombre_archivo}'), 'srcset_webp': None, 'srcset_jpg': None}
+
+    jpg = _urls_variantes(nombre_archivo, variantes, 'jpg')
+    return {
+        'src': jpg[0][0],
+        'srcset_webp': ', '.join(f'{url} {a}w' for url, a in _urls_variantes(nombre_archivo, variantes, 'webp')),
+        'srcset_jpg': ', '.join(f'{url} {a}w' for url, a in jpg),
+    }
+
+def url_imagen_empresa(nombre_archivo, variantes, ancho=640, defecto='Imagenes/default.jpg'):
+    """URL de una sola imagen (APIs JSON): la variante JPEG más pequeña que cubra `ancho`."""
+    if not nombre_archivo:
+        return url_for('static', filename=defecto)
+    if not variantes:
+        return url_for('static', filename=f'Empresas/{nombre_archivo}')
+    jpg = _urls_variantes(nombre_archivo, variantes, 'jpg')
+    return next((url for url, a in jpg if a >= ancho), jpg[-1][0])
+
+@app.cli.command('generar-variantes')
+@click.option('--todas', is_flag=True, help='Regenera también las empresas que ya tienen variantes.')
+def generar_variantes_cli(todas):
+    """Genera las variantes de las imágenes ya subidas."""
+    if Image is None:
+        raise SystemExit('Pillow no está instalado (pip install Pillow)')
+
+    consulta = Empresa.query.filter(Empresa.imagen_filename.isnot(None))
+    if not todas:
+        consulta = consulta.filter(Empresa.imagen_variantes.is_(None))
+
+    hechas = fallidas = 0
+    for empresa in consulta.all():
+        try:
+            empresa.imagen_variantes = generar_variantes(empresa.imagen_filename)
+            hechas += 1
+        except (ValueError, FileNotFoundError) as e:
+            print(f'  {empresa.imagen_filename}: {e}')
+            fallidas += 1
+    db.session.commit()
+    print(f'{hechas} imagen(es) procesadas, {fallidas} con error')
+
+# -------------------------------
+# Sesiones del servidor (memoria LRU o tabla SQLite)
+# -------------------------------
+class SesionGuardada(db.Model):
+    __tablename__ = 'sesion_servidor'
+    sid = db.Column(db.String(64), primary_key=True)
+    datos = db.Column(db.LargeBinary, nullable=False)
+    expira = db.Column(db.Float, nullable=False, index=True)  # epoch en segundos
+
+class SesionServidor(SecureCookieSession):
+    def __init__(self, datos=None, sid=None, expira=None):
+        super().__init__(datos)
+        self.sid = sid
+        self.expira = expira  # None = todavía no guardada
+
+    @property
+    def new(self):
+        return self.expira is None
+
+class AlmacenMemoria:
+    """LRU acotado con expiración. Cada proceso tiene el suyo: solo para un único worker."""
+
+    def __init__(self, max_sesiones):
+        self.max_sesiones = max_sesiones
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def leer(self, sid):
+        with self._lock:
+            entrada = self._sesiones.get(sid)
+            if entrada is None:
+                return None
+            if entrada[1] < time.time():
+                del self._sesiones[sid]
+                return None
+            self._sesiones.move_to_end(sid)
+            return entrada
+
+    def guardar(self, sid, datos, expira):
+        with self._lock:
+            self._sesiones[sid] = (datos, expira)
+            self._sesiones.move_to_end(sid)
+            while len(self._sesiones) > self.max_sesiones:
+                self._sesiones.popitem(last=False)
+
+    def borrar(self, sid):
+        with self._lock:
+            self._sesiones.pop(sid, None)
+
+    def purgar(self):
+        ahora = time.time()
+        with self._lock:
+            vencidas = [sid for sid, (_, expira) in self._sesiones.items() if expira < ahora]
+            for sid in vencidas:
+                del self._sesiones[sid]
+        return len(vencidas)
+
+class AlmacenSQLite:
+    """Tabla sesion_servidor compartida por los workers; las vencidas se barren cada `barrido_s`."""
+
+    def __init__(self, barrido_s, motor=None):
+        self.barrido_s = barrido_s
+        self.motor = motor  # None = db.engine de la app
+        self._proximo_barrido = 0.0
+        self._tabla = SesionGuardada.__table__
+
+    def _motor(self):
+        return self.motor if self.motor is not None else db.engine
+
+    def leer(self, sid):
+        with self._motor().connect() as conexion:
+            fila = conexion.execute(
+                select(self._tabla.c.datos, self._tabla.c.expira).where(self._tabla.c.sid == sid)
+            ).first()
+        if fila is None or fila.expira < time.time():
+            return None
+        return fila.datos, fila.expira
+
+    def guardar(self, sid, datos, expira):
+        motor = self._motor()
+        if motor.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+
+        stmt = upsert(self._tabla).values(sid=sid, datos=datos, expira=expira)
+        stmt = stmt.on_conflict_do_update(index_elements=['sid'], set_={'datos': datos, 'expira': expira})
+        with motor.begin() as conexion:
+            conexion.execute(stmt)
+
+        if time.monotonic() >= self._proximo_barrido:
+            self._proximo_barrido = time.monotonic() + self.barrido_s
+            self.purgar()
+
+    def borrar(self, sid):
+        with self._motor().begin() as conexion:
+            conexion.execute(self._tabla.delete().where(self._tabla.c.sid == sid))
+
+    def purgar(self):
+        with self._motor().begin() as conexion:
+            return conexion.execute(self._tabla.delete().where(self._tabla.c.expira < time.time())).rowcount
+
+class InterfazSesiones(SessionInterface):
+    """Guarda en el servidor solo lo que cambia; la cookie lleva únicamente el id de sesión."""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, almacen, renovar_s):
+        self.almacen = almacen
+        self.renovar_s = renovar_s
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            guardada = self.almacen.leer(sid)
+            if guardada is not None:
+                datos, expira = guardada
+                try:
+                    return SesionServidor(self.serializer.loads(datos), sid=sid, expira=expira)
+                except ValueError:
+                    pass
+        # Los visitantes anónimos no escriben nada hasta que la sesión tenga datos
+        return SesionServidor(sid=secrets.token_urlsafe(32))
+
+    def save_session(self, app, sesion, response):
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+        if sesion.accessed:
+            response.vary.add('Cookie')
+
+        # Sesión vaciada (logout): se borra del almacén y del navegador
+        if not sesion:
+            if sesion.modified and not sesion.new:
+                self.almacen.borrar(sesion.sid)
+                response.delete_cookie(nombre, domain=dominio, path=ruta,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        ahora = time.time()
+        if not sesion.modified and not sesion.new and sesion.expira - ahora > ttl - self.renovar_s:
+            return
+
+        expira = ahora + ttl
+        self.almacen.guardar(sesion.sid, self.serializer.dumps(dict(sesion)).encode('utf-8'), expira)
+        response.set_cookie(nombre, sesion.sid,
+                            expires=datetime.fromtimestamp(expira, timezone.utc),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=dominio, path=ruta,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+def crear_interfaz_sesiones(backend):
+    if backend == 'memoria':
+        return InterfazSesiones(AlmacenMemoria(app.config['SESION_MAX_MEMORIA']), app.config['SESION_RENOVAR_S'])
+    if backend == 'sqlite':
+        return InterfazSesiones(AlmacenSQLite(app.config['SESION_BARRIDO_S']), app.config['SESION_RENOVAR_S'])
+    raise ValueError(f'SESION_BACKEND desconocido: {backend}')
+
+if app.config['SESION_BACKEND'] == 'filesystem':
+    app.config['SESSION_TYPE'] = 'filesystem'
+    Session(app)
+else:
+    app.session_interface = crear_interfaz_sesiones(app.config['SESION_BACKEND'])
+
+@app.cli.command('purgar-sesiones')
+def purgar_sesiones():
+    """Borra de la tabla sesion_servidor las sesiones vencidas."""
+    if app.config['SESION_BACKEND'] != 'sqlite':
+        print("Solo aplica a SESION_BACKEND='sqlite' (en memoria caducan solas dentro de cada proceso)")
+        return
+    print(f'{app.session_interface.almacen.purgar()} sesión(es) vencida(s) eliminada(s)')
+
+@app.cli.command('bench-sesiones')
+@click.option('--peticiones', default=5000, show_default=True)
+def bench_sesiones(peticiones):
+    """Mide el coste por petición de abrir y guardar la sesión en cada backend."""
+    import tempfile
+    import warnings
+    from sqlalchemy import create_engine
+    from werkzeug.test import EnvironBuilder
+    from flask_session.filesystem import FileSystemSessionInterface
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        motor = create_engine('sqlite:///' + os.path.join(carpeta, 'sesiones.db'))
+        SesionGuardada.__table__.create(motor)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            interfaces = {
+                'memoria': InterfazSesiones(AlmacenMemoria(app.config['SESION_MAX_MEMORIA']), app.config['SESION_RENOVAR_S']),
+                'sqlite': InterfazSesiones(AlmacenSQLite(app.config['SESION_BARRIDO_S'], motor=motor), app.config['SESION_RENOVAR_S']),
+                'filesystem': FileSystemSessionInterface(app, cache_dir=os.path.join(carpeta, 'flask_session')),
+            }
+
+        for nombre, interfaz in interfaces.items():
+            # Sesión de un usuario autenticado, como la que deja /login
+            sesion = interfaz.open_session(app, app.request_class(EnvironBuilder().get_environ()))
+            sesion.update({'user_id': 1, 'username': 'bench', 'role': 'Explorador'})
+            respuesta = app.response_class()
+            interfaz.save_session(app, sesion, respuesta)
+            peticion = app.request_class(EnvironBuilder(headers={'Cookie': respuesta.headers['Set-Cookie'].split(';')[0]}).get_environ())
+
+            resultados = []
+            for modifica in (False, True):
+                inicio = time.perf_counter()
+                for i in range(peticiones):
+                    sesion = interfaz.open_session(app, peticion)
+                    if modifica:
+                        sesion['ultima'] = i
+                    interfaz.save_session(app, sesion, app.response_class())
+                resultados.append((time.perf_counter() - inicio) / peticiones * 1e6)
+            print(f'{nombre:<11} lectura {resultados[0]:>8.1f} µs/petición   con escritura {resultados[1]:>8.1f} µs/petición')
+        motor.dispose()
+
 # Rutas
 @app.route('/BotonLog')
 def index():
@@ -127,6 +1531,7 @@ def index():
     return redirect(url_for('login'))
 
 @app.route('/register', methods=['GET', 'POST'])
+@unidad_de_trabajo
 def register():
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -139,16 +1544,9 @@ def register():
             flash('Usuario o correo ya registrado', 'danger')
             return redirect(url_for('register'))
 
-        # Crear el usuario base
-        new_user = User(username=username, email=email, role=role)
-        new_user.set_password(password)
-        db.session.add(new_user)
-        db.session.commit()
-
         # -------------------------------
-        # Conversión segura de fecha
+        # Conversión segura de fecha (antes de crear nada)
         # -------------------------------
-        from datetime import datetime
         fecha_nacimiento_str = request.form.get('fecha_nacimiento', '').strip()
         fecha_nacimiento = None
         if fecha_nacimiento_str:
@@ -158,12 +1556,16 @@ def register():
                 flash("Formato de fecha inválido. Usa AAAA-MM-DD.", "danger")
                 return redirect(url_for('register'))
 
+        # Crear el usuario base
+        new_user = User(username=username, email=email, role=role)
+        new_user.set_password(password)
+        db.session.add(new_user)
+
         # -------------------------------
-        # Registro según el rol
+        # Registro según el rol (mismo commit que el usuario)
         # -------------------------------
         if role == 'Explorador':
-            nuevo_explorador = Explorador(
-                user_id=new_user.id,
+            new_user.explorador = Explorador(
                 primer_nombre=request.form.get('primer_nombre', '').strip(),
                 segundo_nombre=request.form.get('segundo_nombre', '').strip(),
                 primer_apellido=request.form.get('primer_apellido', '').strip(),
@@ -172,11 +1574,9 @@ def register():
                 telefono=request.form.get('telefono', '').strip(),
                 preferencias=request.form.get('preferencias', '').strip()
             )
-            db.session.add(nuevo_explorador)
 
         elif role == 'Emprendedor':
-            nuevo_emprendedor = Emprendedor(
-                user_id=new_user.id,
+            new_user.emprendedor = Emprendedor(
                 primer_nombre=request.form.get('primer_nombre_emp', '').strip(),
                 segundo_nombre=request.form.get('segundo_nombre_emp', '').strip(),
                 primer_apellido=request.form.get('primer_apellido_emp', '').strip(),
@@ -184,21 +1584,19 @@ def register():
                 fecha_nacimiento=fecha_nacimiento,
                 telefono=request.form.get('telefono_emp', '').strip(),
             )
-            db.session.add(nuevo_emprendedor)
 
-        # Guardar todo
-        db.session.commit()
+        db.session.flush()  # para conocer new_user.id
 
         # -------------------------------
         # 📘 REGISTRO EN AUDITORÍA
         # -------------------------------
-        log = LogAccion(
-            entidad_id=new_user.id,
+        registrar_auditoria(
             accion="Creación",
+            codigo=USUARIO_CREAR,
+            entidad_id=new_user.id,
             detalles=f"Se creó el usuario '{new_user.username}' con rol '{new_user.role}'."
         )
-        db.session.add(log)
-        db.session.commit()
+        despues_de_confirmar(estadisticas_admin.invalidar)
 
         flash('Registro exitoso. Ya puedes iniciar sesión.', 'success')
         return redirect(url_for('login'))
@@ -218,6 +1616,7 @@ def login():
         ).first()
 
         if user and user.check_password(password):
+            metricas.sumar('myiana_logins_total', resultado='ok')
             session['user_id'] = user.id
             session['username'] = user.username
             session['role'] = user.role
@@ -231,6 +1630,7 @@ def login():
                 return redirect(url_for('explorador_dashboard'))
 
         else:
+            metricas.sumar('myiana_logins_total', resultado='fallido')
             flash('Credenciales incorrectas', 'danger')
 
     return render_template('Base/login.html')
@@ -264,7 +1664,7 @@ def emprendedor_dashboard():
 
     acciones_labels = [a[0] for a in acciones] or ["Sin registros"]
     acciones_values = [a[1] for a in acciones] or [0]
-    favoritos_count = Favorito.query.filter_by(empresa_id=empresa.id).count()
+    favoritos_count = empresa.favoritos_count
 
     # Si ya tiene empresa, renderizamos el dashboard normal
     return render_template(
@@ -276,6 +1676,7 @@ def emprendedor_dashboard():
         )
 
 @app.route('/registrar_visita/<int:empresa_id>', methods=['POST'])
+@unidad_de_trabajo
 def registrar_visita(empresa_id):
     # Verificar si hay sesión activa
     if 'user_id' not in session or session.get('role') != 'Explorador':
@@ -287,28 +1688,45 @@ def registrar_visita(empresa_id):
     if not explorador:
         return jsonify({'success': False, 'message': 'Explorador no encontrado.'}), 404
 
-    # Registrar visita
+    ahora = datetime.utcnow()
+
+    # Modo buffer: la visita se escribe en bloque desde el hilo del buffer
+    if app.config['VISITAS_MODO'] == 'buffer':
+        buffer_visitas.agregar({'empresa_id': empresa_id, 'fecha': ahora, 'tipo': 'clic'})
+        return jsonify({'success': True})
+
+    # Modo sync: registrar visita (y su conteo en el rollup diario en la misma transacción)
     nueva_visita = Visita(
         empresa_id=empresa_id,
-        fecha=datetime.utcnow(),
+        fecha=ahora,
         tipo='clic'
     )
     db.session.add(nueva_visita)
-    db.session.commit()
+    sumar_visitas_diarias({(empresa_id, ahora.date(), ahora.hour): 1})
 
     return jsonify({'success': True})
 
+# Estado de los buffers de escritura (profundidad de cola y ritmo de vaciado)
+@app.route('/admin/buffers')
+def estado_buffers():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    return jsonify({nombre: b.estadisticas() for nombre, b in BUFFERS.items()})
+
 @app.route('/api/visitas/<int:empresa_id>')
 def visitas_por_dia(empresa_id):
-    from datetime import datetime
     dias_semana = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
     visitas = [0] * 7  # Inicializa con 0 para los 7 días
 
-    registros = Visita.query.filter_by(empresa_id=empresa_id).all()
+    # Una sola consulta agregada sobre el rollup (Lunes=0, Domingo=6)
+    registros = db.session.query(VisitaDiaria.dia_semana, func.sum(VisitaDiaria.total))\
+        .filter(VisitaDiaria.empresa_id == empresa_id)\
+        .group_by(VisitaDiaria.dia_semana)\
+        .all()
 
-    for v in registros:
-        dia = v.fecha.weekday()  # Lunes=0, Domingo=6
-        visitas[dia] += 1
+    for dia, total in registros:
+        visitas[dia] = int(total or 0)
 
     # Si no hay suficientes datos, generar aleatorios de respaldo
     if sum(visitas) < 5:
@@ -322,7 +1740,6 @@ def visitas_por_dia(empresa_id):
 
 @app.route('/api/visitas_dia/<int:empresa_id>/<string:dia>')
 def visitas_por_dia_semana(empresa_id, dia):
-    from datetime import datetime, timedelta
     import random
 
     dias_semana = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
@@ -331,27 +1748,31 @@ def visitas_por_dia_semana(empresa_id, dia):
 
     dia_index = dias_semana.index(dia)
 
-    # Generar las últimas 10 semanas
-    hoy = datetime.utcnow()
-    semanas_labels = []
-    visitas_semanales = []
-
+    # Fechas del día elegido en cada una de las últimas 10 semanas (ISO)
+    hoy = datetime.utcnow().date()
+    fechas = []
     for i in range(10):
         semana_inicio = hoy - timedelta(weeks=i)
-        semana_label = f"Semana {10 - i}"
-        semanas_labels.append(semana_label)
-
-        # Filtrar visitas reales por esa semana y día
-        semana_visitas = (
-            Visita.query.filter(
-                Visita.empresa_id == empresa_id,
-                db.extract('week', Visita.fecha) == semana_inicio.isocalendar()[1],
-                db.extract('year', Visita.fecha) == semana_inicio.year
-            ).all()
-        )
+        lunes = semana_inicio - timedelta(days=semana_inicio.weekday())
+        fechas.append(lunes + timedelta(days=dia_index))
+
+    # Una sola consulta indexada para las 10 semanas
+    registros = db.session.query(VisitaDiaria.dia, func.sum(VisitaDiaria.total))\
+        .filter(
+            VisitaDiaria.empresa_id == empresa_id,
+            VisitaDiaria.dia_semana == dia_index,
+            VisitaDiaria.dia.in_(fechas)
+        )\
+        .group_by(VisitaDiaria.dia)\
+        .all()
+    por_fecha = {d: int(total or 0) for d, total in registros}
 
-        # Contar las que correspondan al día elegido
-        count = sum(1 for v in semana_visitas if v.fecha.weekday() == dia_index)
+    semanas_labels = []
+    visitas_semanales = []
+    for i, fecha in enumerate(fechas):
+        semanas_labels.append(f"Semana {10 - i}")
+
+        count = por_fecha.get(fecha, 0)
         # Si no hay suficientes datos, generamos aleatorios
         if count == 0:
             count = random.randint(3, 15)
@@ -364,6 +1785,7 @@ def visitas_por_dia_semana(empresa_id, dia):
     })
 
 @app.route('/registrar_empresa', methods=['GET', 'POST'])
+@unidad_de_trabajo
 def registrar_empresa():
     user_id = session.get('user_id')
 
@@ -411,6 +1833,14 @@ def registrar_empresa():
         imagen.save(ruta_guardado)
         imagen_filename = nuevo_nombre
 
+        # Miniaturas y WebP se generan una sola vez, al subir
+        try:
+            imagen_variantes = generar_variantes(imagen_filename)
+        except ValueError as e:
+            os.remove(ruta_guardado)
+            flash(str(e), 'danger')
+            return redirect(url_for('registrar_empresa'))
+
         nueva_empresa = Empresa(
             nombre_emprendimiento=nombre_emprendimiento,
             nit=nit,
@@ -421,20 +1851,22 @@ def registrar_empresa():
             rango_precios=rango_precios,
             url=url_empresa,
             imagen_filename=imagen_filename,
+            imagen_variantes=imagen_variantes,
             emprendedor_id=emprendedor.id
         )
 
         db.session.add(nueva_empresa)
-        db.session.commit()
+        db.session.flush()  # para conocer nueva_empresa.id
 
         # Auditoría
-        log = LogAccion(
+        registrar_auditoria(
             accion="Creación de Empresa",
+            codigo=EMPRESA_CREAR,
             entidad_id=nueva_empresa.id,
+            empresa_id=nueva_empresa.id,
             detalles=f"El emprendedor {emprendedor.id} registró la empresa '{nombre_emprendimiento}'."
         )
-        db.session.add(log)
-        db.session.commit()
+        despues_de_confirmar(estadisticas_admin.invalidar)
 
         flash('Tu empresa ha sido registrada correctamente.', 'success')
         return redirect(url_for('emprendedor_dashboard'))
@@ -442,6 +1874,7 @@ def registrar_empresa():
     return render_template('Emprededores/registrar_empresa.html', emprendedor=emprendedor)
 
 @app.route('/editar_empresa/<int:id>', methods=['POST'])
+@unidad_de_trabajo
 def editar_empresa(id):
     empresa = Empresa.query.get_or_404(id)
     datos_antes = empresa.__dict__.copy()
@@ -454,8 +1887,6 @@ def editar_empresa(id):
     empresa.rango_precios = request.form.get('rango_precios', empresa.rango_precios)
     empresa.clasificacion = request.form.get('clasificacion', empresa.clasificacion)
 
-    db.session.commit()
-
     # Auditoría
     cambios = []
     for campo in ['nombre_emprendimiento', 'nit', 'zona', 'ubicacion', 'plan', 'clasificacion','rango_precios']:
@@ -464,14 +1895,14 @@ def editar_empresa(id):
 
     detalles = ", ".join(cambios) if cambios else "Sin cambios detectados"
 
-    log = LogAccion(
+    registrar_auditoria(
         accion="Edición Emprendedor",
+        codigo=EMPRESA_EDITAR,
         entidad_id=empresa.id,
-        user_id=session.get('user_id'),
+        empresa_id=empresa.id,
         detalles=f"Actualizó su empresa '{empresa.nombre_emprendimiento}'. {detalles}"
     )
-    db.session.add(log)
-    db.session.commit()
+    despues_de_confirmar(estadisticas_admin.invalidar)
 
     flash('Información actualizada correctamente.', 'success')
     return redirect(url_for('emprendedor_dashboard'))
@@ -483,13 +1914,715 @@ def logout():
     flash('Has cerrado sesión', 'info')
     return redirect(url_for('login'))
 
+# Reenvía los eventos de auditoría que quedaron en el spool (workers caídos)
+@app.cli.command('reenviar-auditoria')
+@click.option('--todos', is_flag=True, help='Incluye spools de procesos que parecen vivos.')
+def reenviar_auditoria(todos):
+    total = reenviar_spool_auditoria(app.config['AUDITORIA_SPOOL_DIR'], todos=todos)
+    print(f'{total} evento(s) de auditoría reenviados')
+
 # Helper: crear base de datos si no existe
 @app.cli.command('init-db')
 def init_db():
     db.create_all()
+    aplicar_migraciones()
     print('Base de datos creada (site.db)')
 
+# -------------------------------
+# Búsqueda de texto completo (SQLite FTS5)
+# -------------------------------
+# Índice externo sobre empresa: los triggers lo mantienen al día en altas,
+# ediciones y borrados, vengan del ORM o de SQL directo.
+SQL_INDICE_BUSQUEDA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS empresa_fts USING fts5(
+        nombre_emprendimiento, descripcion, clasificacion, zona,
+        content='empresa', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS empresa_fts_ai AFTER INSERT ON empresa BEGIN
+        INSERT INTO empresa_fts(rowid, nombre_emprendimiento, descripcion, clasificacion, zona)
+        VALUES (new.id, new.nombre_emprendimiento, new.descripcion, new.clasificacion, new.zona);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS empresa_fts_ad AFTER DELETE ON empresa BEGIN
+        INSERT INTO empresa_fts(empresa_fts, rowid, nombre_emprendimiento, descripcion, clasificacion, zona)
+        VALUES ('delete', old.id, old.nombre_emprendimiento, old.descripcion, old.clasificacion, old.zona);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS empresa_fts_au
+        AFTER UPDATE OF nombre_emprendimiento, descripcion, clasificacion, zona ON empresa BEGIN
+        INSERT INTO empresa_fts(empresa_fts, rowid, nombre_emprendimiento, descripcion, clasificacion, zona)
+        VALUES ('delete', old.id, old.nombre_emprendimiento, old.descripcion, old.clasificacion, old.zona);
+        INSERT INTO empresa_fts(rowid, nombre_emprendimiento, descripcion, clasificacion, zona)
+        VALUES (new.id, new.nombre_emprendimiento, new.descripcion, new.clasificacion, new.zona);
+    END""",
+]
+
+def crear_indice_busqueda(reconstruir=True):
+    """Crea la tabla FTS5 y sus triggers en la transacción actual; confirma quien la llama."""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    for sql in SQL_INDICE_BUSQUEDA:
+        db.session.execute(text(sql))
+    if reconstruir:
+        db.session.execute(text("INSERT INTO empresa_fts(empresa_fts) VALUES ('rebuild')"))
+    return True
+
+def indice_busqueda_disponible():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    return db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'empresa_fts'")
+    ).first() is not None
+
+def consulta_fts(texto, columna=None):
+    """Convierte lo que escribe el usuario en una consulta FTS5 con prefijos: 'cafe centro' -> '"cafe"* "centro"*'."""
+    tokens = re.findall(r'\w+', texto or '')
+    if not tokens:
+        return None
+    consulta = ' '.join(f'"{t}"*' for t in tokens)
+    if columna:
+        consulta = f'{columna} : ({consulta})'
+    return consulta
+
+@app.cli.command('reindexar-busqueda')
+def reindexar_busqueda():
+    if crear_indice_busqueda():
+        db.session.commit()
+        print('Índice de búsqueda reconstruido')
+    else:
+        print('El índice FTS5 solo está disponible en SQLite')
+
+# -------------------------------
+# Migraciones de esquema versionadas
+# -------------------------------
+# create_all() solo crea tablas que no existen; los cambios sobre un site.db
+# existente (índices, columnas nuevas) van aquí, en orden y una sola vez.
+class MigracionEsquema(db.Model):
+    __tablename__ = 'schema_migraciones'
+
+    version = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(200), nullable=False)
+    aplicada_en = db.Column(db.DateTime, default=datetime.utcnow)
+
+MIGRACIONES = []
+# version -> función que cuenta, sin cambiar nada, los datos que tocaría la migración (migrar --estado)
+PREVIAS_MIGRACION = {}
+
+def migracion(version, nombre, previa=None):
+    """Registra una migración; su función puede devolver un texto con lo que hizo (se imprime al aplicarla)."""
+    def registrar(funcion):
+        MIGRACIONES.append((version, nombre, funcion))
+        MIGRACIONES.sort(key=lambda m: m[0])
+        if previa:
+            PREVIAS_MIGRACION[version] = previa
+        return funcion
+    return registrar
+
+def _favoritos_duplicados():
+    """Condición de los favoritos repetidos (mismo explorador y empresa) salvo el más antiguo de cada par."""
+    primeros = select(func.min(Favorito.id)).group_by(Favorito.explorador_id, Favorito.empresa_id)
+    return Favorito.id.notin_(primeros)
+
+def _previa_migracion_indices():
+    n = db.session.query(func.count(Favorito.id)).filter(_favoritos_duplicados()).scalar()
+    return f'borrará {n} favorito(s) duplicado(s) (se archivan antes)' if n else None
+
+@migracion(1, 'Índices de las rutas más consultadas', previa=_previa_migracion_indices)
+def _migracion_indices():
+    # El índice único de favoritos exige quitar antes los duplicados: se archivan y luego se borran
+    detalle = None
+    tabla = Favorito.__table__
+    duplicados = db.session.execute(select(tabla).where(_favoritos_duplicados()).order_by(tabla.c.id)).all()
+    if duplicados:
+        ruta = os.path.join(app.config['ARCHIVO_DIR'], 'favorito',
+                            f"duplicados-migracion-1-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl.gz")
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        columnas = [c.name for c in tabla.columns]
+        with gzip.open(ruta, 'wt', encoding='utf-8') as archivo:
+            for fila in duplicados:
+                archivo.write(_linea_jsonl(columnas, fila))
+        db.session.execute(tabla.delete().where(_favoritos_duplicados()))
+        detalle = f'{len(duplicados)} favorito(s) duplicado(s) borrados; copia en {ruta}'
+        app.logger.warning('Migración 1: %s', detalle)
+    for sql in [
+        "CREATE INDEX IF NOT EXISTS ix_visita_empresa_fecha ON visita (empresa_id, fecha)",
+        "CREATE INDEX IF NOT EXISTS ix_visita_fecha ON visita (fecha)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_favorito_explorador_empresa ON favorito (explorador_id, empresa_id)",
+        "CREATE INDEX IF NOT EXISTS ix_favorito_empresa_id ON favorito (empresa_id)",
+        "CREATE INDEX IF NOT EXISTS ix_log_accion_tipo_fecha ON log_accion (tipo_entidad, fecha)",
+        "CREATE INDEX IF NOT EXISTS ix_log_accion_fecha ON log_accion (fecha)",
+        "CREATE INDEX IF NOT EXISTS ix_log_accion_user_id ON log_accion (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_empresa_clasificacion ON empresa (clasificacion)",
+        "CREATE INDEX IF NOT EXISTS ix_empresa_clasificacion_lower ON empresa (lower(clasificacion))",
+        "CREATE INDEX IF NOT EXISTS ix_empresa_emprendedor_id ON empresa (emprendedor_id)",
+        "CREATE INDEX IF NOT EXISTS ix_explorador_user_id ON explorador (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_emprendedor_user_id ON emprendedor (user_id)",
+        'CREATE INDEX IF NOT EXISTS ix_user_role ON "user" (role)',
+    ]:
+        db.session.execute(text(sql))
+    return detalle
+
+@migracion(2, 'Índice FTS5 de empresas')
+def _migracion_busqueda():
+    crear_indice_busqueda()
+
+# Texto libre de `accion` (registros antiguos) -> código normalizado
+CODIGOS_ACCION_LEGADO = {
+    'Creación': USUARIO_CREAR,
+    'Creación de Empresa': EMPRESA_CREAR,
+    'Edición Emprendedor': EMPRESA_EDITAR,
+    'Edición de Emprendedor': EMPRESA_EDITAR,
+    'Edición de Explorador': EXPLORADOR_EDITAR,
+    'Agregacion Favorito': FAVORITO_AGREGAR,
+    'Eliminación Favorito': FAVORITO_ELIMINAR,
+}
+
+def _codigo_de_log_legado(accion, detalles):
+    if accion == 'Eliminación':
+        return EMPRENDEDOR_ELIMINAR if 'emprendedor' in (detalles or '') else EXPLORADOR_ELIMINAR
+    return CODIGOS_ACCION_LEGADO.get(accion)
+
+@migracion(3, 'Columnas tipadas de auditoría (empresa_id, rol_actor, codigo_accion)')
+def _migracion_auditoria_tipada():
+    columnas = {c['name'] for c in inspect(db.session.connection()).get_columns('log_accion')}
+    for nombre, tipo in [('empresa_id', 'INTEGER'), ('rol_actor', 'VARCHAR(20)'), ('codigo_accion', 'VARCHAR(40)')]:
+        if nombre not in columnas:
+            db.session.execute(text(f"ALTER TABLE log_accion ADD COLUMN {nombre} {tipo}"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_log_accion_codigo_accion ON log_accion (codigo_accion)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_log_accion_empresa_fecha ON log_accion (empresa_id, fecha)"))
+
+    # Backfill: se interpreta el texto de los registros existentes
+    empresas_por_nombre = {}
+    for empresa_id, nombre in db.session.query(Empresa.id, Empresa.nombre_emprendimiento):
+        # Un nombre repetido es ambiguo: no se asigna
+        empresas_por_nombre[nombre] = None if nombre in empresas_por_nombre else empresa_id
+    roles = dict(db.session.query(User.id, User.role))
+
+    patron_empresa = re.compile(r'la empresa (.+)$')
+    consulta = db.session.query(LogAccion.id, LogAccion.accion, LogAccion.detalles, LogAccion.entidad_id, LogAccion.user_id)\
+        .filter(LogAccion.codigo_accion.is_(None)).order_by(LogAccion.id)
+    # Por páginas de 1000 con keyset sobre id: con millones de logs no se carga la tabla entera
+    # (ni se deja un cursor abierto sobre log_accion mientras se actualiza)
+    ultimo_id = 0
+    while True:
+        filas = consulta.filter(LogAccion.id > ultimo_id).limit(1000).all()
+        if not filas:
+            break
+        cambios = []
+        for log_id, accion, detalles, entidad_id, user_id in filas:
+            codigo = _codigo_de_log_legado(accion, detalles)
+            empresa_id = None
+            if codigo in (EMPRESA_CREAR, EMPRESA_EDITAR):
+                empresa_id = entidad_id
+            elif codigo in (FAVORITO_AGREGAR, FAVORITO_ELIMINAR):
+                encontrado = patron_empresa.search(detalles or '')
+                if encontrado:
+                    empresa_id = empresas_por_nombre.get(encontrado.group(1).strip())
+            cambios.append({
+                'id': log_id,
+                'codigo_accion': codigo,
+                'empresa_id': empresa_id,
+                'rol_actor': roles.get(user_id)
+            })
+        db.session.execute(update(LogAccion), cambios)
+        ultimo_id = filas[-1].id
+
+@migracion(4, 'Anchos de las variantes de imagen de empresa')
+def _migracion_variantes_imagen():
+    columnas = {c['name'] for c in inspect(db.session.connection()).get_columns('empresa')}
+    if 'imagen_variantes' not in columnas:
+        db.session.execute(text("ALTER TABLE empresa ADD COLUMN imagen_variantes VARCHAR(100)"))
+
+@migracion(5, 'Versión de empresa para la caché de tarjetas')
+def _migracion_version_empresa():
+    columnas = {c['name'] for c in inspect(db.session.connection()).get_columns('empresa')}
+    if 'version' not in columnas:
+        db.session.execute(text("ALTER TABLE empresa ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+@migracion(6, 'Matriz de co-ocurrencia de favoritos')
+def _migracion_coocurrencias():
+    # create_all() ya creó la tabla; se llena con los favoritos existentes
+    db.session.execute(CoocurrenciaFavorito.__table__.delete())
+    db.session.execute(text(SQL_RECONSTRUIR_COOCURRENCIAS))
+
+@migracion(7, 'Contadores de favoritos y visitas en empresa')
+def _migracion_contadores_empresa():
+    columnas = {c['name'] for c in inspect(db.session.connection()).get_columns('empresa')}
+    for columna in ('favoritos_count', 'visitas_count'):
+        if columna not in columnas:
+            db.session.execute(text(f"ALTER TABLE empresa ADD COLUMN {columna} INTEGER NOT NULL DEFAULT 0"))
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_empresa_clasificacion_favoritos ON empresa (lower(clasificacion), favoritos_count DESC)"
+    ))
+    reconciliar_contadores_empresa()
+
+@migracion(8, 'Variantes de imagen nombradas con su extensión')
+def _migracion_nombres_variantes():
+    # Las variantes anteriores (sin extensión en el nombre) pueden ser de otra imagen: se vuelve al original
+    # hasta regenerarlas; la versión sube para que tarjetas en caché y ETags no apunten a los archivos viejos
+    con_variantes = Empresa.query.filter(Empresa.imagen_variantes.isnot(None))
+    categorias = {c for (c,) in con_variantes.with_entities(Empresa.clasificacion).distinct()}
+    n = con_variantes.update({'imagen_variantes': None, 'version': Empresa.version + 1}, synchronize_session=False)
+    incrementar_versiones_categoria(categorias)
+    if n:
+        return f'{n} empresa(s) muestran la imagen original hasta ejecutar `flask generar-variantes`'
+
+def aplicar_migraciones():
+    """Crea las tablas nuevas y aplica las migraciones pendientes; devuelve las aplicadas."""
+    db.create_all()
+    aplicadas = {v for (v,) in db.session.query(MigracionEsquema.version)}
+    nuevas = []
+    for version, nombre, funcion in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        try:
+            detalle = funcion()
+            db.session.add(MigracionEsquema(version=version, nombre=nombre))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        nuevas.append((version, nombre, detalle))
+    return nuevas
+
+@app.cli.command('migrar')
+@click.option('--estado', is_flag=True, help='Solo muestra las migraciones aplicadas y pendientes.')
+def migrar(estado):
+    if estado:
+        db.create_all()
+        aplicadas = {m.version: m for m in MigracionEsquema.query.all()}
+        for version, nombre, _ in MIGRACIONES:
+            m = aplicadas.get(version)
+            marca = m.aplicada_en.strftime('%Y-%m-%d %H:%M') if m else 'pendiente'
+            print(f'{version:>4}  {nombre}  [{marca}]')
+            previa = PREVIAS_MIGRACION.get(version) if not m else None
+            aviso = previa() if previa else None
+            if aviso:
+                print(f'        {aviso}')
+        return
+
+    nuevas = aplicar_migraciones()
+    for version, nombre, detalle in nuevas:
+        print(f'Aplicada migración {version}: {nombre}')
+        if detalle:
+            print(f'        {detalle}')
+    if not nuevas:
+        print('El esquema ya está al día')
+
+def _consultas_rutas():
+    """Consulta representativa de cada ruta caliente, para revisar su plan de ejecución."""
+    return {
+        'comida / catalogo_clasificacion': Empresa.query.filter(func.lower(Empresa.clasificacion) == 'comida'),
+        'login': User.query.filter((User.username == 'admin') | (User.email == 'admin')),
+        'registrar_visita / toggle_favorito (explorador)': Explorador.query.filter_by(user_id=1),
+        'emprendedor_dashboard (emprendedor)': Emprendedor.query.filter_by(user_id=1),
+        'emprendedor_dashboard (empresa)': Empresa.query.filter_by(emprendedor_id=1),
+        'emprendedor_dashboard (acciones)': db.session.query(LogAccion.accion, func.count(LogAccion.id))
+            .filter_by(user_id=1).group_by(LogAccion.accion),
+        'comida (populares)': Empresa.query.filter(func.lower(Empresa.clasificacion) == 'comida')
+            .order_by(Empresa.favoritos_count.desc()),
+        'toggle_favorito (existente)': Favorito.query.filter_by(explorador_id=1, empresa_id=1),
+        'explorador_dashboard': Favorito.query.filter_by(explorador_id=1).order_by(Favorito.fecha_guardado.desc()),
+        'auditoria_favoritos': LogAccion.query.filter(LogAccion.empresa_id == 1,
+            LogAccion.codigo_accion.in_([FAVORITO_AGREGAR, FAVORITO_ELIMINAR]))
+            .order_by(LogAccion.fecha.desc()).limit(50),
+        'api_admin_logs': LogAccion.query.order_by(LogAccion.fecha.desc(), LogAccion.id.desc()).limit(51),
+        'visitas_por_dia': db.session.query(VisitaDiaria.dia_semana, func.sum(VisitaDiaria.total))
+            .filter(VisitaDiaria.empresa_id == 1).group_by(VisitaDiaria.dia_semana),
+        'visitas (crudas) por empresa': Visita.query.filter(Visita.empresa_id == 1, Visita.fecha >= datetime(2024, 1, 1)),
+    }
+
+def plan_de_consulta(consulta):
+    compilada = consulta.statement.compile(db.engine, compile_kwargs={'render_postcompile': True})
+    parametros = tuple(compilada.params[nombre] for nombre in (compilada.positiontup or []))
+    filas = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compilada), parametros).all()
+    return [fila[-1] for fila in filas]
+
+@app.cli.command('verificar-indices')
+def verificar_indices():
+    """Falla si alguna ruta caliente recorre una tabla completa (EXPLAIN QUERY PLAN)."""
+    if db.engine.dialect.name != 'sqlite':
+        print('La verificación usa EXPLAIN QUERY PLAN de SQLite')
+        return
+
+    fallos = 0
+    for ruta, consulta in _consultas_rutas().items():
+        plan = plan_de_consulta(consulta)
+        # "SCAN tabla" sin índice es un recorrido completo
+        recorridos = [p for p in plan if p.startswith('SCAN') and 'INDEX' not in p and 'PRIMARY KEY' not in p]
+        ok = not recorridos and any('INDEX' in p or 'PRIMARY KEY' in p for p in plan)
+        fallos += 0 if ok else 1
+        print(f"{'OK   ' if ok else 'FALLA'} {ruta}")
+        for p in plan:
+            print(f'        {p}')
+
+    if fallos:
+        raise SystemExit(f'{fallos} consulta(s) sin índice')
+
+def _rutas_con_presupuesto():
+    """(url, usuario con sesión o None) de cada endpoint de PRESUPUESTO_CONSULTAS, con los datos más cargados de la base."""
+    admin = User.query.filter(func.lower(User.role) == 'administrador').first()
+    explorador = Explorador.query.join(Favorito, Favorito.explorador_id == Explorador.id)\
+        .group_by(Explorador.id).order_by(func.count(Favorito.id).desc()).first() or Explorador.query.first()
+    emprendedor = Emprendedor.query.join(Empresa, Empresa.emprendedor_id == Emprendedor.id).first()
+    empresa = Empresa.query.filter(Empresa.clasificacion.isnot(None)).order_by(Empresa.favoritos_count.desc()).first()
+
+    rutas = []
+    if admin:
+        rutas += [(url, admin.id) for url in ('/admin_dashboard', '/api/admin/logs', '/api/admin/empresas', '/api/admin/exploradores')]
+    if explorador:
+        rutas += [('/explorador_dashboard', explorador.user_id), ('/api/explorador/recomendaciones', explorador.user_id),
+                  (f'/explorador/{explorador.id}', None)]
+    if emprendedor:
+        rutas += [('/emprendedor/dashboard', emprendedor.user_id), (f'/emprendimiento/{emprendedor.id}', None)]
+    if empresa:
+        rutas += [(f'/api/auditoria_favoritos/{empresa.id}', None), (f'/{empresa.clasificacion}', None),
+                  (f'/api/catalogo/{empresa.clasificacion}', None), (f'/api/empresas/{empresa.id}/similares', None)]
+    return rutas
+
+@app.cli.command('verificar-consultas')
+def verificar_consultas():
+    """Falla si alguna ruta supera su presupuesto de sentencias o repite una sentencia (N+1).
+
+    Cada ruta se pide dos veces y se mide la segunda (cachés calientes). La sesión va en una cookie
+    firmada para no escribir en sesion_servidor (en un request real su lectura y escritura quedan
+    fuera del conteo: ocurren antes de before_request y después de after_request).
+    """
+    app.config['DETECTAR_N_MAS_1'] = True
+    interfaz_sesiones, app.session_interface = app.session_interface, SecureCookieSessionInterface()
+    try:
+        fallos = sum(1 for _url, _endpoint, avisos in _medir_rutas_con_presupuesto() if avisos)
+    finally:
+        app.session_interface = interfaz_sesiones
+
+    if fallos:
+        raise SystemExit(f'{fallos} ruta(s) fuera de presupuesto')
+
+def _medir_rutas_con_presupuesto():
+    """Mide cada ruta de _rutas_con_presupuesto e imprime el resultado; devuelve [(url, endpoint, avisos)]."""
+    rutas = _rutas_con_presupuesto()
+    if not rutas:
+        print('No hay usuarios ni empresas con los que recorrer las rutas')
+    resultados = []
+    for url, user_id in rutas:
+        usuario = db.session.query(User.id, User.role, User.username).filter_by(id=user_id).one()._asdict() if user_id else None
+        for _ in range(2):
+            # Sesión de base de datos nueva en cada petición, como en un request real (sin mapa de identidad previo)
+            db.session.remove()
+            with app.test_request_context(url):
+                if usuario:
+                    session.update(user_id=usuario['id'], role=usuario['role'], username=usuario['username'])
+                respuesta = app.full_dispatch_request()
+                endpoint, consultas = request.endpoint, list(g.consultas)
+        avisos = analizar_consultas(endpoint, consultas)
+        if respuesta.status_code >= 400:
+            avisos.append(f'respondió {respuesta.status_code}')
+        resultados.append((url, endpoint, avisos))
+        presupuesto = PRESUPUESTO_CONSULTAS.get(endpoint, PRESUPUESTO_CONSULTAS_DEFECTO)
+        print(f"{'FALLA' if avisos else 'OK   '} {url:<45} {len(consultas):>3}/{presupuesto} sentencias")
+        for aviso in avisos:
+            print(f'        {aviso}')
+    return resultados
+
+# Reconstruye el rollup VisitaDiaria a partir de la tabla Visita
+def reconstruir_visitas_diarias():
+    dia = func.date(Visita.fecha)
+    hora = db.extract('hour', Visita.fecha)
+    consulta = db.session.query(Visita.empresa_id, dia, hora, func.count(Visita.id))\
+        .filter(Visita.empresa_id.isnot(None), Visita.fecha.isnot(None))\
+        .group_by(Visita.empresa_id, dia, hora)
+
+    # El GROUP BY se materializa antes de tocar el rollup
+    agregados = [(empresa_id, date.fromisoformat(d) if isinstance(d, str) else d, int(h), n)
+                 for empresa_id, d, h, n in consulta]
+    # Solo se rehacen los días que aún tienen visitas crudas: de los ya archivados por
+    # aplicar-retencion no queda más que su rollup
+    if agregados:
+        VisitaDiaria.query.filter(VisitaDiaria.dia >= min(d for _e, d, _h, _n in agregados)).delete()
+
+    lote = []
+    total_filas = 0
+    for empresa_id, d, h, n in agregados:
+        lote.append({'empresa_id': empresa_id, 'dia': d, 'hora': h, 'dia_semana': d.weekday(), 'total': n})
+        if len(lote) >= 5000:
+            db.session.execute(insert(VisitaDiaria), lote)
+            total_filas += len(lote)
+            lote = []
+    if lote:
+        db.session.execute(insert(VisitaDiaria), lote)
+        total_filas += len(lote)
+
+    # visitas_count sale del rollup: se vuelve a alinear con lo reconstruido
+    reconciliar_contadores_empresa()
+    db.session.commit()
+    return total_filas
+
+@app.cli.command('backfill-visitas')
+def backfill_visitas():
+    print(f'Rollup de visitas reconstruido ({reconstruir_visitas_diarias()} filas)')
+
+# -------------------------------
+# Retención y archivo de visitas y logs
+# -------------------------------
+# tabla -> (modelo, clave de config con los días que se guardan en la base)
+POLITICAS_RETENCION = {
+    'visita': (Visita, 'RETENCION_VISITAS_DIAS'),
+    'log_accion': (LogAccion, 'RETENCION_LOGS_DIAS'),
+}
+
+def limite_retencion(tabla, hoy=None):
+    """Medianoche (UTC) del primer día que se conserva en la base; None si la tabla se guarda para siempre.
+
+    El corte va por días completos: un día está entero en la base o entero en el archivo, así
+    reconstruir_visitas_diarias() rehace bien los días que aún tienen visitas crudas.
+    """
+    dias = app.config[POLITICAS_RETENCION[tabla][1]]
+    if dias <= 0:
+        return None
+    hoy = hoy or datetime.utcnow().date()
+    return datetime.combine(hoy - timedelta(days=dias), datetime.min.time())
+
+def _ruta_archivo(tabla, mes):
+    return os.path.join(app.config['ARCHIVO_DIR'], tabla, f'{mes}.jsonl.gz')
+
+def archivar_tabla(tabla, lote=None, pausa_ms=None):
+    """Pasa al archivo mensual y borra de la base las filas anteriores al límite de retención; devuelve {mes: filas}.
+
+    Cada lote es una lectura, un append al .jsonl.gz del mes (con fsync) y un DELETE por id en su
+    propia transacción corta, con una pausa entre lotes para que los workers puedan escribir. Si
+    el proceso muere entre el append y el DELETE, el lote se archiva otra vez en la siguiente
+    pasada: el archivo puede tener ids repetidos (consultar-archivo los descarta), nunca huecos.
+    """
+    modelo, _config = POLITICAS_RETENCION[tabla]
+    limite = limite_retencion(tabla)
+    por_mes = Counter()
+    if limite is None:
+        return por_mes
+    lote = lote or app.config['RETENCION_LOTE']
+    pausa = (app.config['RETENCION_PAUSA_MS'] if pausa_ms is None else pausa_ms) / 1000
+    t = modelo.__table__
+    columnas = [c.name for c in t.columns]
+
+    while True:
+        filas = db.session.execute(
+            select(t).where(t.c.fecha < limite).order_by(t.c.fecha, t.c.id).limit(lote)
+        ).all()
+        # Suelta la transacción de lectura: en SQLite pasar de lectura a escritura puede fallar con 'database is locked'
+        db.session.commit()
+        if not filas:
+            return por_mes
+
+        meses = {}
+        for fila in filas:
+            meses.setdefault(fila.fecha.strftime('%Y-%m'), []).append(fila)
+        for mes, del_mes in meses.items():
+            ruta = _ruta_archivo(tabla, mes)
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            # Cada lote se añade como un miembro gzip más; gzip.open los lee uno tras otro
+            with open(ruta, 'ab') as crudo:
+                with gzip.GzipFile(fileobj=crudo, mode='ab') as comprimido:
+                    comprimido.write(''.join(_linea_jsonl(columnas, f) for f in del_mes).encode('utf-8'))
+                crudo.flush()
+                os.fsync(crudo.fileno())
+            por_mes[mes] += len(del_mes)
+
+        db.session.execute(t.delete().where(t.c.id.in_([f.id for f in filas])))
+        db.session.commit()
+        time.sleep(pausa)
+
+def _pasada_retencion(tablas, simular):
+    for tabla in tablas:
+        limite = limite_retencion(tabla)
+        if limite is None:
+            print(f'{tabla:<11} sin retención: se guarda para siempre')
+            continue
+        modelo = POLITICAS_RETENCION[tabla][0]
+        if simular:
+            n = db.session.query(func.count(modelo.id)).filter(modelo.fecha < limite).scalar()
+            print(f'{tabla:<11} {n} filas anteriores al {limite:%Y-%m-%d} se archivarían')
+            continue
+
+        inicio = time.perf_counter()
+        por_mes = archivar_tabla(tabla)
+        total = sum(por_mes.values())
+        print(f'{tabla:<11} {total} filas anteriores al {limite:%Y-%m-%d} archivadas en {len(por_mes)} mes(es) '
+              f'({time.perf_counter() - inicio:.1f} s)')
+        if total:
+            registrar_auditoria(
+                accion='Archivado por retención',
+                codigo=RETENCION_ARCHIVAR,
+                tipo_entidad=tabla,
+                detalles=f"{total} filas de {tabla} anteriores al {limite:%Y-%m-%d} movidas a "
+                         f"{os.path.join(app.config['ARCHIVO_DIR'], tabla)} ({', '.join(sorted(por_mes))}).",
+                rol_actor='Sistema'
+            )
+            db.session.commit()
+
+def _bloquear_sin_esperar(archivo):
+    """Candado exclusivo sobre `archivo` (abierto para escritura); False si otro proceso lo tiene.
+
+    Se suelta al cerrar el archivo o al terminar el proceso.
+    """
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(archivo.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:  # BlockingIOError en POSIX, PermissionError en Windows
+        return False
+    return True
+
+@app.cli.command('aplicar-retencion')
+@click.option('--tabla', 'tablas', type=click.Choice(list(POLITICAS_RETENCION)), multiple=True, help='Por defecto, todas')
+@click.option('--simular', is_flag=True, help='Solo contar lo que se archivaría')
+@click.option('--cada', type=float, help='Modo programado: repetir cada N horas, sin cron')
+def aplicar_retencion(tablas, simular, cada):
+    """Archiva en ARCHIVO_DIR/<tabla>/<AAAA-MM>.jsonl.gz y borra de la base lo que supera su retención.
+
+    Visitas: RETENCION_VISITAS_DIAS (el rollup visita_diaria y visitas_count se conservan siempre).
+    Logs: RETENCION_LOGS_DIAS. Un candado de archivo impide que dos pasadas se pisen.
+    """
+    visitas_dias = app.config['RETENCION_VISITAS_DIAS']
+    if 0 < visitas_dias < app.config['RECOMENDACION_DIAS']:
+        raise SystemExit(f"RETENCION_VISITAS_DIAS ({visitas_dias}) es menor que RECOMENDACION_DIAS "
+                         f"({app.config['RECOMENDACION_DIAS']}): las recomendaciones perderían visitas")
+    tablas = tablas or list(POLITICAS_RETENCION)
+    os.makedirs(app.config['ARCHIVO_DIR'], exist_ok=True)
+
+    while True:
+        with open(os.path.join(app.config['ARCHIVO_DIR'], '.retencion.lock'), 'w') as candado:
+            if _bloquear_sin_esperar(candado):
+                _pasada_retencion(tablas, simular)
+            else:
+                print('Otra pasada de retención está en curso; se omite esta')
+        if not cada:
+            return
+        db.session.remove()
+        time.sleep(cada * 3600)
+
+def _leer_archivo(tabla, desde=None, hasta=None):
+    """Filas (dict) de los archivos mensuales de `tabla` que pueden caer entre desde y hasta, sin ids repetidos."""
+    carpeta = os.path.join(app.config['ARCHIVO_DIR'], tabla)
+    if not os.path.isdir(carpeta):
+        return
+    for nombre in sorted(os.listdir(carpeta)):
+        mes = nombre.split('.')[0]
+        if (desde and mes < f'{desde:%Y-%m}') or (hasta and mes > f'{hasta:%Y-%m}'):
+            continue
+        vistos = set()
+        with gzip.open(os.path.join(carpeta, nombre), 'rt', encoding='utf-8') as archivo:
+            for linea in archivo:
+                fila = json.loads(linea)
+                if fila['id'] not in vistos:
+                    vistos.add(fila['id'])
+                    yield fila
+
+@app.cli.command('consultar-archivo')
+@click.argument('ruta', default='-')
+@click.option('--tabla', type=click.Choice(list(POLITICAS_RETENCION)), default='log_accion', show_default=True)
+@click.option('--desde', type=click.DateTime(['%Y-%m-%d']))
+@click.option('--hasta', type=click.DateTime(['%Y-%m-%d']), help='Incluido')
+@click.option('--empresa-id', type=int)
+@click.option('--codigo', help='codigo_accion (logs)')
+@click.option('--user-id', type=int, help='Autor (logs)')
+@click.option('--texto', help='Subcadena de detalles (logs)')
+@click.option('--formato', type=click.Choice(['csv', 'jsonl']), help='Por defecto, según la extensión (jsonl en stdout)')
+def consultar_archivo(ruta, tabla, desde, hasta, empresa_id, codigo, user_id, texto, formato):
+    """Busca en lo ya archivado por aplicar-retencion (leyendo los .jsonl.gz, sin volver a cargarlos en la base)."""
+    if tabla == 'visita' and (codigo or user_id or texto):
+        raise click.UsageError('--codigo, --user-id y --texto solo aplican a log_accion')
+    columnas = [c.name for c in POLITICAS_RETENCION[tabla][0].__table__.columns]
+    hasta_excl = (hasta + timedelta(days=1)).isoformat() if hasta else None
+
+    def coincidencias():
+        for fila in _leer_archivo(tabla, desde, hasta):
+            fecha = fila.get('fecha') or ''
+            if (desde and fecha < desde.isoformat()) or (hasta_excl and fecha >= hasta_excl):
+                continue
+            if (empresa_id and fila.get('empresa_id') != empresa_id) or (codigo and fila.get('codigo_accion') != codigo) \
+                    or (user_id and fila.get('user_id') != user_id) or (texto and texto not in (fila.get('detalles') or '')):
+                continue
+            yield [fila.get(c) for c in columnas]
+
+    with _abrir_intercambio(ruta, 'w') as archivo:
+        n = _escribir_intercambio(archivo, formato or ('jsonl' if ruta == '-' else _formato_intercambio(ruta, None)),
+                                  columnas, coincidencias())
+    click.echo(f'{n} filas', err=True)
+
+# -------------------------------
+# Benchmark de escrituras concurrentes (PRAGMAs por defecto vs ajustados)
+# -------------------------------
+def _trabajador_escrituras(ruta, pragmas, segundos, salida):
+    # Cada iteración imita una petición: visita + rollup + auditoría en una transacción.
+    # Timeout por defecto de sqlite3 (5 s), el mismo con el que conecta la app sin PRAGMAs
+    conexion = sqlite3.connect(ruta, isolation_level=None)
+    for nombre, valor in pragmas.items():
+        conexion.execute(f'PRAGMA {nombre} = {valor}')
+    escrituras = bloqueos = 0
+    fin = time.monotonic() + segundos
+    while time.monotonic() < fin:
+        try:
+            conexion.execute('BEGIN IMMEDIATE')
+            conexion.execute("INSERT INTO visita (empresa_id, fecha) VALUES (1, datetime('now'))")
+            conexion.execute("""INSERT INTO visita_diaria (empresa_id, dia, hora, dia_semana, total)
+                VALUES (1, date('now'), 0, 0, 1)
+                ON CONFLICT (empresa_id, dia, hora) DO UPDATE SET total = total + 1""")
+            conexion.execute("INSERT INTO log_accion (accion, detalles, fecha) VALUES ('bench', '', datetime('now'))")
+            conexion.execute('COMMIT')
+            escrituras += 1
+        except sqlite3.OperationalError:
+            if conexion.in_transaction:
+                conexion.execute('ROLLBACK')
+            bloqueos += 1
+    conexion.close()
+    salida.put((escrituras, bloqueos))
+
+def _medir_escrituras(pragmas, procesos, segundos):
+    import multiprocessing
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, 'bench.db')
+        conexion = sqlite3.connect(ruta)
+        conexion.executescript("""
+            CREATE TABLE visita (id INTEGER PRIMARY KEY, empresa_id INTEGER, fecha DATETIME);
+            CREATE TABLE visita_diaria (empresa_id INTEGER, dia DATE, hora INTEGER, dia_semana INTEGER,
+                total INTEGER, PRIMARY KEY (empresa_id, dia, hora));
+            CREATE TABLE log_accion (id INTEGER PRIMARY KEY, accion TEXT, detalles TEXT, fecha DATETIME);
+        """)
+        if 'journal_mode' in pragmas:
+            # journal_mode es persistente: se fija una vez antes de lanzar los procesos
+            conexion.execute(f"PRAGMA journal_mode = {pragmas['journal_mode']}")
+        conexion.close()
+
+        salida = multiprocessing.Queue()
+        trabajadores = [multiprocessing.Process(target=_trabajador_escrituras, args=(ruta, pragmas, segundos, salida))
+                        for _ in range(procesos)]
+        for t in trabajadores:
+            t.start()
+        resultados = [salida.get() for _ in trabajadores]
+        for t in trabajadores:
+            t.join()
+
+    escrituras = sum(r[0] for r in resultados)
+    bloqueos = sum(r[1] for r in resultados)
+    return escrituras / segundos, bloqueos
+
+@app.cli.command('bench-escrituras')
+@click.option('--procesos', default=4, show_default=True, help='Procesos escritores simultáneos.')
+@click.option('--segundos', default=5.0, show_default=True)
+def bench_escrituras(procesos, segundos):
+    """Compara escrituras/s y errores de bloqueo con y sin los PRAGMAs de SQLITE_PRAGMAS.
+
+    "por defecto" es lo que tendría la app sin ellos: valores de SQLite y la espera de 5 s de sqlite3.
+    """
+    for etiqueta, pragmas in (('por defecto', {}), ('ajustado', app.config['SQLITE_PRAGMAS'])):
+        por_segundo, bloqueos = _medir_escrituras(pragmas, procesos, segundos)
+        print(f'{etiqueta:<12} {por_segundo:>10.1f} escrituras/s  {bloqueos:>8} errores de bloqueo')
+
 @app.route('/crear_admin')
+@unidad_de_trabajo
 def crear_admin():
     admin = User.query.filter_by(username='admin').first()
     if admin:
@@ -502,19 +2635,170 @@ def crear_admin():
     )
     admin.set_password('admin')
     db.session.add(admin)
-    db.session.commit()
     return "Usuario administrador creado correctamente: admin / admin123"
 
+# -------------------------------
+# Versiones por categoría: ETag / Last-Modified de las páginas del catálogo
+# -------------------------------
+class VersionCategoria(db.Model):
+    __tablename__ = 'version_categoria'
+    categoria = db.Column(db.String(50), primary_key=True)  # clasificación en minúsculas
+    version = db.Column(db.Integer, nullable=False, default=0)
+    actualizada = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def incrementar_versiones_categoria(categorias, conexion=None):
+    """Sube la versión de cada categoría en la transacción en curso (escrituras fuera del ORM pasan su conexión)."""
+    filas = [{'categoria': c.lower(), 'version': 1, 'actualizada': datetime.utcnow()} for c in set(categorias) if c]
+    if not filas:
+        return
+
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    stmt = upsert(VersionCategoria)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['categoria'],
+        set_={'version': VersionCategoria.version + 1, 'actualizada': stmt.excluded.actualizada}
+    )
+    (conexion or db.session).execute(stmt, filas)
+
+# Cualquier alta, edición o baja de Empresa (o de un Favorito, que cambia el conteo de la tarjeta)
+# invalida las páginas de su categoría en el mismo commit; una edición sube además Empresa.version
+@event.listens_for(db.session, 'before_flush')
+def _versionar_categorias(sesion, _contexto, _instancias):
+    categorias = set()
+    for obj in list(sesion.new) + list(sesion.deleted):
+        if isinstance(obj, Empresa):
+            categorias.add(obj.clasificacion)
+            if obj in sesion.deleted:
+                despues_de_confirmar(functools.partial(cache_tarjetas.invalidar, obj.id))
+        elif isinstance(obj, Favorito):
+            empresa = obj.empresa or (obj.empresa_id and sesion.get(Empresa, obj.empresa_id))
+            if empresa:
+                categorias.add(empresa.clasificacion)
+    for obj in sesion.dirty:
+        if isinstance(obj, Empresa) and sesion.is_modified(obj):
+            historial = inspect(obj).attrs.clasificacion.history
+            categorias.update(historial.deleted or ())
+            categorias.add(obj.clasificacion)
+            obj.version = (obj.version or 1) + 1
+            despues_de_confirmar(functools.partial(cache_tarjetas.invalidar, obj.id))
+    if categorias:
+        incrementar_versiones_categoria(categorias)
+
+_EPOCA = datetime(2000, 1, 1)
+
+def _huella_despliegue():
+    """Cambia al desplegar plantillas o estilos nuevos, para no servir 304 de páginas con otro HTML."""
+    h = hashlib.sha256()
+    for carpeta in (app.template_folder, os.path.join(app.static_folder, 'Estilos'), os.path.join(app.static_folder, 'Java')):
+        for raiz, _dirs, archivos in sorted(os.walk(os.path.join(app.root_path, carpeta))):
+            for nombre in sorted(archivos):
+                with open(os.path.join(raiz, nombre), 'rb') as archivo:
+                    h.update(archivo.read())
+    return h.hexdigest()[:12]
+
+HUELLA_DESPLIEGUE = _huella_despliegue()
+
+def respuesta_condicional_categoria(categoria, generar):
+    """Responde 304 si el cliente ya tiene la versión actual de la categoría; si no, llama a `generar()`.
+
+    El ETag incluye usuario y rol porque la cabecera de la página cambia con la sesión.
+    """
+    fila = db.session.get(VersionCategoria, categoria.lower())
+    version, actualizada = (fila.version, fila.actualizada) if fila else (0, _EPOCA)
+    identidad = f"{session.get('username')}|{session.get('role')}"
+    # La query string (orden, filtros, cursor) elige qué página se sirve
+    consulta = request.query_string.decode()
+    etag = hashlib.sha256(f'{categoria.lower()}|{version}|{identidad}|{consulta}|{HUELLA_DESPLIEGUE}'.encode()).hexdigest()[:32]
+    ultima_modificacion = actualizada.replace(microsecond=0, tzinfo=timezone.utc)
+
+    if request.if_none_match:
+        vigente = request.if_none_match.contains(etag)
+    else:
+        vigente = request.if_modified_since is not None and ultima_modificacion <= request.if_modified_since
+
+    respuesta = app.response_class(status=304) if vigente else make_response(generar())
+    respuesta.set_etag(etag)
+    respuesta.last_modified = ultima_modificacion
+    respuesta.headers['Cache-Control'] = 'private, no-cache' if 'user_id' in session else 'public, no-cache'
+    respuesta.vary.add('Cookie')
+    return respuesta
+
+# -------------------------------
+# Caché de tarjetas de empresa renderizadas (LRU con tope de memoria)
+# -------------------------------
+_HUECO_ACCIONES = '<!--acciones-->'
+
+class CacheFragmentos:
+    """Fragmentos HTML por (empresa_id, version). Una edición sube la versión, así que
+    ningún worker vuelve a servir la tarjeta vieja; en este proceso además se borra al confirmar."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self._fragmentos = OrderedDict()  # (empresa_id, version) -> (fragmento, tamaño)
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, generar):
+        with self._lock:
+            entrada = self._fragmentos.get(clave)
+            if entrada is not None:
+                self._fragmentos.move_to_end(clave)
+                self.aciertos += 1
+                return entrada[0]
+            self.fallos += 1
+
+        fragmento = generar()
+        tamaño = sum(len(parte) for parte in fragmento)
+        with self._lock:
+            if clave not in self._fragmentos and tamaño <= self.max_bytes:
+                self._fragmentos[clave] = (fragmento, tamaño)
+                self.bytes += tamaño
+                while self.bytes > self.max_bytes:
+                    _, (_, liberado) = self._fragmentos.popitem(last=False)
+                    self.bytes -= liberado
+        return fragmento
+
+    def invalidar(self, empresa_id):
+        with self._lock:
+            for clave in [c for c in self._fragmentos if c[0] == empresa_id]:
+                self.bytes -= self._fragmentos.pop(clave)[1]
+
+    def estadisticas(self):
+        with self._lock:
+            return {'fragmentos': len(self._fragmentos), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'aciertos': self.aciertos, 'fallos': self.fallos}
+
+cache_tarjetas = CacheFragmentos(app.config['FRAGMENTOS_MAX_BYTES'])
+
+@app.template_global()
+def tarjeta_empresa(e):
+    """Tarjeta de categoria.html partida en dos alrededor del hueco de acciones por usuario."""
+    def generar():
+        html = render_template('Explorador/tarjeta_empresa.html', e=e, acciones=Markup(_HUECO_ACCIONES))
+        antes, despues = html.split(_HUECO_ACCIONES, 1)
+        return Markup(antes), Markup(despues)
+
+    antes, despues = cache_tarjetas.obtener((e.id, e.version), generar)
+    return {'antes': antes, 'despues': despues}
+
 # Catálogo por clasificación
 @app.route('/catalogo/<string:clasificacion>')
 def catalogo_clasificacion(clasificacion):
-    # normalizar la clasificación si hace falta
-    empresas = Empresa.query.filter(func.lower(Empresa.clasificacion) == clasificacion.lower()).all()
-    # Si quieres paginar, aquí es donde lo harías
-    return render_template('Catalogo/catalogo_list.html', empresas=empresas, clasificacion=clasificacion)
+    def generar():
+        # Primera página; el resto se pide a /api/catalogo/<clasificacion> con el cursor `siguiente`
+        empresas, siguiente = pagina_catalogo(clasificacion, request.args.get('orden'))
+        return render_template('Catalogo/catalogo_list.html', empresas=empresas, siguiente=siguiente, clasificacion=clasificacion)
+    return respuesta_condicional_categoria(clasificacion, generar)
 
 # Toggle favorito (guardar / quitar)
 @app.route('/favorito/toggle', methods=['POST'])
+@unidad_de_trabajo
 def toggle_favorito():
     if 'user_id' not in session:
         return jsonify({'ok': False, 'msg': 'Necesitas iniciar sesión'}), 401
@@ -536,42 +2820,147 @@ def toggle_favorito():
     if fav:
         # quitar favorito
         db.session.delete(fav)
+        actualizar_coocurrencias(explorador.id, empresa.id, -1)
+        fav_count = sumar_contador_empresa(empresa.id, 'favoritos_count', -1)
 
         # Registrar auditoría
-        log = LogAccion(
-            user_id=session['user_id'],
+        registrar_auditoria(
+            accion='Eliminación Favorito',
+            codigo=FAVORITO_ELIMINAR,
             tipo_entidad='Favorito',
             entidad_id=fav.id,
-            accion='Eliminación Favorito',
+            empresa_id=empresa.id,
             detalles=f"El usuario {nombre_usuario} eliminó de favoritos la empresa {empresa.nombre_emprendimiento}",
         )
-        db.session.add(log)
-        db.session.commit()
         action = 'removed'
     else:
         # crear favorito
         fav = Favorito(explorador_id=explorador.id, empresa_id=empresa.id)
         db.session.add(fav)
+        db.session.flush()  # para conocer fav.id
+        actualizar_coocurrencias(explorador.id, empresa.id, +1)
+        fav_count = sumar_contador_empresa(empresa.id, 'favoritos_count', +1)
         #Registrar auditoría
-        log = LogAccion(
-            user_id=session['user_id'],
+        registrar_auditoria(
+            accion='Agregacion Favorito',
+            codigo=FAVORITO_AGREGAR,
             tipo_entidad='Favorito',
             entidad_id=fav.id,
-            accion='Agregacion Favorito',
+            empresa_id=empresa.id,
             detalles=f"El usuario {nombre_usuario} agregó a favoritos la empresa {empresa.nombre_emprendimiento}",
         )
-        db.session.add(log)
-        db.session.commit()
         action = 'added'
-    db.session.commit()
 
-    # devolver nuevo conteo de favoritos
-    fav_count = Favorito.query.filter_by(empresa_id=empresa.id).count()
+    despues_de_confirmar(functools.partial(metricas.sumar, 'myiana_favoritos_total',
+                                           accion='agregar' if action == 'added' else 'quitar'))
+
+    # devolver nuevo conteo de favoritos (el contador se actualizó en esta misma transacción)
     return jsonify({'ok': True, 'action': action, 'favoritos_count': fav_count})
 
+def reconciliar_contadores_empresa(corregir=True):
+    """Recalcula favoritos_count y visitas_count desde favorito y visita_diaria; corrige solo las filas con deriva.
+
+    Devuelve la lista de diferencias encontradas: (empresa_id, columna, guardado, real). Lectura y
+    corrección van en la misma transacción de escritura y cada UPDATE recalcula el valor real en la
+    propia sentencia, así un toggle o un vaciado de visitas concurrente no se pisa. Quien llama
+    confirma o revierte enseguida: hasta entonces las demás escrituras esperan.
+    """
+    conexion = db.session.connection()
+    if corregir and conexion.dialect.name == 'sqlite' and not conexion.connection.dbapi_connection.in_transaction:
+        # pysqlite no abre transacción antes de un SELECT: se toma el candado de escritura antes de leer
+        conexion.exec_driver_sql('BEGIN IMMEDIATE')
+
+    tabla = Empresa.__table__
+    reales = {
+        'favoritos_count': select(func.count(Favorito.id))
+            .where(Favorito.empresa_id == tabla.c.id).scalar_subquery(),
+        'visitas_count': select(func.coalesce(func.sum(VisitaDiaria.total), 0))
+            .where(VisitaDiaria.empresa_id == tabla.c.id).scalar_subquery(),
+    }
+    diferencias = []
+    for columna, real in reales.items():
+        filas = db.session.execute(select(tabla.c.id, tabla.c[columna], real).where(tabla.c[columna] != real)).all()
+        diferencias.extend((empresa_id, columna, guardado, int(valor)) for empresa_id, guardado, valor in filas)
+        if filas and corregir:
+            # Sentencia Core sobre la tabla: no marca las empresas como editadas (versión y caché intactas)
+            db.session.execute(tabla.update().where(tabla.c[columna] != real).values({columna: real}))
+    diferencias.sort()
+    return diferencias
+
+@app.cli.command('reconciliar-contadores')
+@click.option('--solo-revisar', is_flag=True, help='Informa la deriva sin corregirla')
+def reconciliar_contadores(solo_revisar):
+    """Compara los contadores de empresa con favorito y visita_diaria y repara la deriva."""
+    diferencias = reconciliar_contadores_empresa(corregir=not solo_revisar)
+    for empresa_id, columna, guardado, real in diferencias[:50]:
+        print(f'empresa {empresa_id}: {columna} {guardado} -> {real}')
+    if len(diferencias) > 50:
+        print(f'... y {len(diferencias) - 50} más')
+
+    if solo_revisar:
+        db.session.rollback()
+        print(f'{len(diferencias)} contadores con deriva (sin cambios)')
+    else:
+        db.session.commit()
+        print(f'{len(diferencias)} contadores corregidos')
+
+
+# -------------------------------
+# Archivos estáticos con huella de contenido (?v=<hash>) y caché de un año
+# -------------------------------
+class ManifiestoEstaticos:
+    """Hash corto del contenido de cada archivo de static/; se recalcula solo si cambian mtime o tamaño."""
+
+    def __init__(self, carpeta):
+        self.carpeta = carpeta
+        self._huellas = {}
+
+    def huella(self, filename):
+        ruta = safe_join(self.carpeta, filename)
+        if ruta is None:
+            return None
+        try:
+            st = os.stat(ruta)
+        except OSError:
+            return None
+
+        clave = (st.st_mtime_ns, st.st_size)
+        guardada = self._huellas.get(filename)
+        if guardada and guardada[0] == clave:
+            return guardada[1]
+
+        h = hashlib.sha256()
+        with open(ruta, 'rb') as archivo:
+            for bloque in iter(lambda: archivo.read(1 << 16), b''):
+                h.update(bloque)
+        huella = h.hexdigest()[:12]
+        self._huellas[filename] = (clave, huella)
+        return huella
+
+manifiesto_estaticos = ManifiestoEstaticos(app.static_folder)
+
+# Todo url_for('static', filename=...) lleva la huella del contenido
+@app.url_defaults
+def _huella_estaticos(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        huella = manifiesto_estaticos.huella(values['filename'])
+        if huella:
+            values['v'] = huella
 
 @app.after_request
 def add_header(response):
+    # Las páginas con GET condicional fijan su propia política (no-cache + ETag)
+    if 'ETag' in response.headers and request.endpoint != 'static':
+        return response
+    if request.endpoint == 'static':
+        # Solo la URL con la huella vigente es inmutable; sin ella el navegador revalida (ETag)
+        v = request.args.get('v')
+        if v and v == manifiesto_estaticos.huella(request.view_args['filename']):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, no-cache"
+        return response
+
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, private, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
@@ -590,7 +2979,74 @@ if __name__ == '__main__':
     app.run(debug=True) 
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------
-from collections import Counter
+
+# -------------------------------
+# Estadísticas del panel de administración
+# -------------------------------
+class SnapshotEstadisticas:
+    """Guarda el resultado de `calcular` durante `ttl` segundos o hasta que se invalide."""
+
+    def __init__(self, calcular, ttl):
+        self._calcular = calcular
+        self.ttl = ttl
+        self._valor = None
+        self._expira = 0.0
+        self._lock = threading.Lock()
+
+    def obtener(self):
+        with self._lock:
+            if self._valor is None or time.monotonic() >= self._expira:
+                self._valor = self._calcular()
+                self._expira = time.monotonic() + self.ttl
+            return self._valor
+
+    def invalidar(self):
+        with self._lock:
+            self._valor = None
+
+def calcular_estadisticas_admin():
+    """Todos los conteos del panel en una sola consulta (UNION ALL de GROUP BY)."""
+    rol = func.lower(User.role)
+    consulta = union_all(
+        select(literal('rol'), rol, func.count()).group_by(rol),
+        select(literal('plan'), Empresa.plan, func.count()).group_by(Empresa.plan),
+        select(literal('preferencia'), Explorador.preferencias, func.count()).group_by(Explorador.preferencias),
+        select(literal('accion'), LogAccion.codigo_accion, func.count()).group_by(LogAccion.codigo_accion)
+    )
+
+    # Los códigos terminan en _CREAR / _EDITAR / _ELIMINAR
+    categoria_accion = {'CREAR': 'Creación', 'EDITAR': 'Edición', 'ELIMINAR': 'Eliminación'}
+
+    conteos = {'rol': Counter(), 'plan': Counter(), 'preferencia': Counter(), 'accion': Counter()}
+    for grupo, clave, n in db.session.execute(consulta):
+        if grupo == 'accion':
+            clave = categoria_accion.get((clave or '').rsplit('_', 1)[-1])
+        conteos[grupo][clave] += n
+
+    total_exploradores = conteos['rol'].get('explorador', 0)
+    total_emprendedores = conteos['rol'].get('emprendedor', 0)
+
+    labels_plan = ['Sin Plan','Valvanera', 'Castillo Marroquin', 'Diosa chia']
+    labels_pref = ['Comida', 'Deportes', 'Ocio', 'Arte y Cultura', 'Naturaleza', 'Compras']
+    acciones_labels = ['Creación', 'Edición', 'Eliminación']
+
+    return {
+        'total_usuarios': sum(conteos['rol'].values()),
+        'total_exploradores': total_exploradores,
+        'total_emprendedores': total_emprendedores,
+        'roles_data': {
+            'Exploradores': total_exploradores,
+            'Emprendedores': total_emprendedores
+        },
+        'labels_plan': labels_plan,
+        'values_plan': [conteos['plan'].get(p, 0) for p in labels_plan],
+        'labels_pref': labels_pref,
+        'values_pref': [conteos['preferencia'].get(p, 0) for p in labels_pref],
+        'acciones_labels': acciones_labels,
+        'acciones_values': [conteos['accion'].get(a, 0) for a in acciones_labels]
+    }
+
+estadisticas_admin = SnapshotEstadisticas(calcular_estadisticas_admin, app.config['ESTADISTICAS_TTL'])
 
 @app.route('/admin_dashboard')
 def admin_dashboard():
@@ -598,74 +3054,367 @@ def admin_dashboard():
         flash("Tu sesión ha expirado. Inicia sesión nuevamente.", "warning")
         return redirect(url_for('login'))
     
-    # Totales generales
-    total_usuarios = User.query.count()
-    total_exploradores = User.query.filter(func.lower(User.role) == 'explorador').count()
-    total_emprendedores = User.query.filter(func.lower(User.role) == 'emprendedor').count()
     username = session.get('username')
     role = session.get('role')
 
-    # Datos para la gráfica de roles
-    roles_data = {
-        'Exploradores': total_exploradores,
-        'Emprendedores': total_emprendedores
-    }
-    
-    # --- Datos para exploradores ---
-    exploradores = Explorador.query.all()
+    estadisticas = estadisticas_admin.obtener()
 
-    # --- Datos para emprendedores ---
-    empresa = Empresa.query.all()
-    emprendedores = Emprendedor.query.all()
-    planes_posibles = ['Sin Plan','Valvanera', 'Castillo Marroquin', 'Diosa chia']
+    return render_template(
+        'Base/dashboard_admin.html',
+        role=role,
+        username=username,
+        **estadisticas
+    )
 
-    logs = LogAccion.query.order_by(LogAccion.fecha.desc()).all()
+@app.route('/admin/perf')
+def admin_perf():
+    """Endpoints que más tiempo pasan en SQL en este worker (requiere PERFIL_SQL=1)."""
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
 
-    # Contar cuántos emprendedores hay por plan
-    planes = [e.plan if e.plan in planes_posibles else 'Sin plan' for e in empresa]
-    plan_counts = Counter(planes)
+    n = max(1, min(request.args.get('n', 10, type=int), 100))
+    return jsonify({
+        'activo': app.config['PERFIL_SQL'],
+        'pid': os.getpid(),
+        'ventana': app.config['PERFIL_VENTANA'],
+        'lenta_ms': app.config['PERFIL_LENTA_MS'],
+        'log': app.config['PERFIL_LOG'],
+        'endpoints': perfil_endpoints.top(n)
+    })
 
-    labels_plan = planes_posibles
-    values_plan = [plan_counts.get(p, 0) for p in labels_plan]
+# -------------------------------
+# APIs paginadas del panel de administración (keyset sobre orden + id)
+# -------------------------------
+def _codificar_cursor(valor, ultimo_id):
+    if isinstance(valor, datetime):
+        carga = {'v': valor.isoformat(), 't': 'dt', 'id': ultimo_id}
+    else:
+        carga = {'v': valor, 'id': ultimo_id}
+    return base64.urlsafe_b64encode(json.dumps(carga).encode()).decode()
+
+def _decodificar_cursor(cursor):
+    carga = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    valor = carga['v']
+    # El cursor viene del cliente: solo escalares (un dict o una lista llegaría tal cual a la base)
+    if valor is not None and not isinstance(valor, (str, int, float)):
+        raise ValueError('Cursor inválido')
+    if carga.get('t') == 'dt':
+        valor = datetime.fromisoformat(valor)
+    return valor, int(carga['id'])
+
+def paginar_keyset(consulta, expresion, columna_id, descendente=True, cursor=None, limite=50):
+    """Devuelve (filas, siguiente_cursor) ordenando por (expresion, id) sin OFFSET.
+
+    Con una consulta de entidades devuelve los objetos; con una consulta de columnas, las filas.
+    """
+    descripciones = consulta.column_descriptions
+    entidades = len(descripciones) == 1 and isinstance(descripciones[0]['expr'], type)
+    if cursor:
+        try:
+            valor, ultimo_id = _decodificar_cursor(cursor)
+        except (ValueError, KeyError, TypeError):
+            return None, None
 
-    # --- Gráfica de preferencias (Exploradores) ---
-    preferencias_posibles = ['Comida', 'Deportes', 'Ocio', 'Arte y Cultura', 'Naturaleza', 'Compras']
-    preferencias = [exp.preferencias for exp in exploradores if exp.preferencias in preferencias_posibles]
-    preferencias_count = Counter(preferencias)
+        if descendente:
+            consulta = consulta.filter(or_(expresion < valor, and_(expresion == valor, columna_id < ultimo_id)))
+        else:
+            consulta = consulta.filter(or_(expresion > valor, and_(expresion == valor, columna_id > ultimo_id)))
 
-    labels_pref = preferencias_posibles
-    values_pref = [preferencias_count.get(p, 0) for p in labels_pref]
+    if descendente:
+        consulta = consulta.order_by(expresion.desc(), columna_id.desc())
+    else:
+        consulta = consulta.order_by(expresion.asc(), columna_id.asc())
 
-    acciones_labels = ['Creación', 'Edición', 'Eliminación']
+    filas = consulta.add_columns(expresion.label('_orden'), columna_id.label('_id')).limit(limite + 1).all()
 
-    conteo_acciones = {
-        'Creación': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Creación%')).scalar(),
-        'Edición': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Edición%')).scalar(),
-        'Eliminación': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Eliminación%')).scalar()
-    }
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = _codificar_cursor(filas[-1]._orden, filas[-1]._id)
 
-    acciones_values = [conteo_acciones[label] for label in acciones_labels]
+    return ([fila[0] for fila in filas] if entidades else filas), siguiente
 
-    return render_template(
-        'Base/dashboard_admin.html',
-        total_usuarios=total_usuarios,
-        total_exploradores=total_exploradores,
-        total_emprendedores=total_emprendedores,
-        roles_data=roles_data,
-        emprendedores=emprendedores,
-        empresa=empresa,
-        exploradores=exploradores,
-        labels_plan=labels_plan,
-        values_plan=values_plan,
-        labels_pref=labels_pref,
-        values_pref=values_pref,
-        logs=logs,
-        acciones_labels=acciones_labels,
-        acciones_values=acciones_values,
-        role=role,
-        username=username
+def _parametros_paginacion(ordenes, orden_defecto):
+    """Lee orden, dir, cursor y limite de la query string."""
+    expresion = ordenes.get(request.args.get('orden', orden_defecto), ordenes[orden_defecto])
+    descendente = request.args.get('dir', 'desc') != 'asc'
+    cursor = request.args.get('cursor') or None
+    limite = max(1, min(request.args.get('limite', 50, type=int), 200))
+    return expresion, descendente, cursor, limite
+
+def _fecha_param(nombre):
+    valor = request.args.get(nombre, '').strip()
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+def _filtrar_logs(consulta):
+    """Filtros de request.args comunes al listado de logs y a su exportación."""
+    accion = request.args.get('accion', '').strip()
+    if accion:
+        consulta = consulta.filter(LogAccion.accion.like(f'%{accion}%'))
+    codigo = request.args.get('codigo', '').strip()
+    if codigo:
+        consulta = consulta.filter(LogAccion.codigo_accion == codigo)
+    empresa_id = request.args.get('empresa_id', type=int)
+    if empresa_id:
+        consulta = consulta.filter(LogAccion.empresa_id == empresa_id)
+    tipo_entidad = request.args.get('tipo_entidad', '').strip()
+    if tipo_entidad:
+        consulta = consulta.filter(LogAccion.tipo_entidad == tipo_entidad)
+    user_id = request.args.get('user_id', type=int)
+    if user_id:
+        consulta = consulta.filter(LogAccion.user_id == user_id)
+    desde = _fecha_param('desde')
+    if desde:
+        consulta = consulta.filter(LogAccion.fecha >= desde)
+    hasta = _fecha_param('hasta')
+    if hasta:
+        consulta = consulta.filter(LogAccion.fecha < hasta + timedelta(days=1))
+    texto = request.args.get('q', '').strip()
+    if texto:
+        consulta = consulta.filter(LogAccion.detalles.like(f'%{texto}%'))
+    return consulta
+
+@app.route('/api/admin/logs')
+def api_admin_logs():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = _filtrar_logs(LogAccion.query.options(joinedload(LogAccion.user)))
+
+    expresion, descendente, cursor, limite = _parametros_paginacion(
+        {'fecha': LogAccion.fecha, 'id': LogAccion.id}, 'fecha')
+    logs, siguiente = paginar_keyset(consulta, expresion, LogAccion.id, descendente, cursor, limite)
+    if logs is None:
+        return jsonify({'error': 'Cursor inválido'}), 400
+
+    return jsonify({
+        'items': [{
+            'id': log.id,
+            'fecha': log.fecha.strftime('%Y-%m-%d %H:%M') if log.fecha else None,
+            'usuario': log.user.username if log.user else 'Sistema',
+            'accion': log.accion,
+            'codigo': log.codigo_accion,
+            'tipo_entidad': log.tipo_entidad,
+            'entidad_id': log.entidad_id,
+            'empresa_id': log.empresa_id,
+            'rol_actor': log.rol_actor,
+            'detalles': log.detalles
+        } for log in logs],
+        'siguiente': siguiente
+    })
+
+# -------------------------------
+# Exportación de logs y visitas en streaming (CSV / JSONL con gzip)
+# -------------------------------
+# formato -> (mimetype, extensión del archivo descargado)
+FORMATOS_EXPORTACION = {'csv': ('text/csv; charset=utf-8', 'csv'), 'jsonl': ('application/gzip', 'jsonl.gz')}
+FILAS_POR_TROZO = 1000
+
+def _trozos_exportacion(formato, columnas, filas):
+    """Genera la descarga por trozos de FILAS_POR_TROZO filas; en 'jsonl' cada trozo sale ya comprimido (gzip)."""
+    buffer = io.StringIO()
+    if formato == 'csv':
+        escritor = csv.writer(buffer)
+        escritor.writerow(columnas)
+        escribir = escritor.writerow
+        comprimir = None
+    else:
+        escribir = lambda fila: buffer.write(_linea_jsonl(columnas, fila))
+        comprimir = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+
+    def vaciar(final=False):
+        datos = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        if comprimir is None:
+            return datos
+        # Z_SYNC_FLUSH entrega lo comprimido hasta aquí sin cerrar el flujo
+        return comprimir.compress(datos) + comprimir.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    # Cabecera (CSV o gzip) de inmediato, antes de la primera fila
+    yield vaciar()
+    for n, fila in enumerate(filas, 1):
+        escribir(fila)
+        if n % FILAS_POR_TROZO == 0:
+            yield vaciar()
+    yield vaciar(final=True)
+
+def respuesta_exportacion(nombre, consulta):
+    """Descarga en streaming de `consulta`: el cursor se lee con yield_per, así que la memoria no depende del total."""
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({'error': 'Formato no soportado (csv o jsonl)'}), 400
+    mimetype, extension = FORMATOS_EXPORTACION[formato]
+    resultado = db.session.execute(consulta.execution_options(yield_per=FILAS_POR_TROZO))
+    archivo = f"{nombre}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}"
+    return Response(
+        stream_with_context(_trozos_exportacion(formato, list(resultado.keys()), resultado)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{archivo}"',
+                 'X-Accel-Buffering': 'no'}  # que nginx no acumule la respuesta entera
     )
 
+@app.route('/api/admin/logs/exportar')
+def exportar_logs():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = select(
+        LogAccion.id, LogAccion.fecha, LogAccion.user_id, User.username.label('usuario'), LogAccion.rol_actor,
+        LogAccion.accion, LogAccion.codigo_accion, LogAccion.tipo_entidad, LogAccion.entidad_id,
+        LogAccion.empresa_id, LogAccion.detalles
+    ).outerjoin(User, User.id == LogAccion.user_id)
+    return respuesta_exportacion('logs', _filtrar_logs(consulta).order_by(LogAccion.fecha, LogAccion.id))
+
+@app.route('/api/admin/visitas/exportar')
+def exportar_visitas():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = select(Visita.id, Visita.fecha, Visita.empresa_id, Visita.explorador_id, Visita.tipo)
+    empresa_id = request.args.get('empresa_id', type=int)
+    if empresa_id:
+        consulta = consulta.filter(Visita.empresa_id == empresa_id)
+    tipo = request.args.get('tipo', '').strip()
+    if tipo:
+        consulta = consulta.filter(Visita.tipo == tipo)
+    desde = _fecha_param('desde')
+    if desde:
+        consulta = consulta.filter(Visita.fecha >= desde)
+    hasta = _fecha_param('hasta')
+    if hasta:
+        consulta = consulta.filter(Visita.fecha < hasta + timedelta(days=1))
+    return respuesta_exportacion('visitas', consulta.order_by(Visita.fecha, Visita.id))
+
+@app.route('/api/admin/empresas')
+def api_admin_empresas():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = Empresa.query
+
+    texto = request.args.get('q', '').strip()
+    if texto:
+        consulta = consulta.filter(or_(
+            Empresa.nombre_emprendimiento.ilike(f'%{texto}%'),
+            Empresa.nit.like(f'%{texto}%')
+        ))
+    plan = request.args.get('plan', '').strip()
+    if plan:
+        consulta = consulta.filter(Empresa.plan == plan)
+    clasificacion = request.args.get('clasificacion', '').strip()
+    if clasificacion:
+        consulta = consulta.filter(func.lower(Empresa.clasificacion) == clasificacion.lower())
+
+    expresion, descendente, cursor, limite = _parametros_paginacion({
+        'id': Empresa.id,
+        'nombre': Empresa.nombre_emprendimiento,
+        'plan': func.coalesce(Empresa.plan, ''),
+        'clasificacion': func.coalesce(Empresa.clasificacion, ''),
+        'favoritos': Empresa.favoritos_count,
+        'visitas': Empresa.visitas_count
+    }, 'id')
+    empresas, siguiente = paginar_keyset(consulta, expresion, Empresa.id, descendente, cursor, limite)
+    if empresas is None:
+        return jsonify({'error': 'Cursor inválido'}), 400
+
+    return jsonify({
+        'items': [{
+            'id': e.id,
+            'nombre_emprendimiento': e.nombre_emprendimiento,
+            'nit': e.nit,
+            'zona': e.zona,
+            'ubicacion': e.ubicacion,
+            'plan': e.plan,
+            'clasificacion': e.clasificacion,
+            'favoritos_count': e.favoritos_count,
+            'visitas_count': e.visitas_count
+        } for e in empresas],
+        'siguiente': siguiente
+    })
+
+@app.route('/api/admin/exploradores')
+def api_admin_exploradores():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = Explorador.query
+
+    texto = request.args.get('q', '').strip()
+    if texto:
+        consulta = consulta.filter(or_(
+            Explorador.primer_nombre.ilike(f'%{texto}%'),
+            Explorador.primer_apellido.ilike(f'%{texto}%'),
+            Explorador.telefono.like(f'%{texto}%')
+        ))
+    preferencias = request.args.get('preferencias', '').strip()
+    if preferencias:
+        consulta = consulta.filter(Explorador.preferencias == preferencias)
+
+    expresion, descendente, cursor, limite = _parametros_paginacion({
+        'id': Explorador.id,
+        'nombre': func.coalesce(Explorador.primer_nombre, ''),
+        'apellido': func.coalesce(Explorador.primer_apellido, '')
+    }, 'id')
+    exploradores, siguiente = paginar_keyset(consulta, expresion, Explorador.id, descendente, cursor, limite)
+    if exploradores is None:
+        return jsonify({'error': 'Cursor inválido'}), 400
+
+    return jsonify({
+        'items': [{
+            'id': x.id,
+            'primer_nombre': x.primer_nombre,
+            'segundo_nombre': x.segundo_nombre,
+            'primer_apellido': x.primer_apellido,
+            'segundo_apellido': x.segundo_apellido,
+            'telefono': x.telefono,
+            'preferencias': x.preferencias,
+            'fecha_nacimiento': x.fecha_nacimiento.isoformat() if x.fecha_nacimiento else None
+        } for x in exploradores],
+        'siguiente': siguiente
+    })
+
+@app.route('/api/admin/emprendedores')
+def api_admin_emprendedores():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    consulta = Emprendedor.query
+
+    texto = request.args.get('q', '').strip()
+    if texto:
+        consulta = consulta.filter(or_(
+            Emprendedor.primer_nombre.ilike(f'%{texto}%'),
+            Emprendedor.primer_apellido.ilike(f'%{texto}%'),
+            Emprendedor.telefono.like(f'%{texto}%')
+        ))
+
+    expresion, descendente, cursor, limite = _parametros_paginacion({
+        'id': Emprendedor.id,
+        'nombre': func.coalesce(Emprendedor.primer_nombre, ''),
+        'apellido': func.coalesce(Emprendedor.primer_apellido, '')
+    }, 'id')
+    emprendedores, siguiente = paginar_keyset(consulta, expresion, Emprendedor.id, descendente, cursor, limite)
+    if emprendedores is None:
+        return jsonify({'error': 'Cursor inválido'}), 400
+
+    return jsonify({
+        'items': [{
+            'id': e.id,
+            'user_id': e.user_id,
+            'primer_nombre': e.primer_nombre,
+            'primer_apellido': e.primer_apellido,
+            'telefono': e.telefono,
+            'fecha_nacimiento': e.fecha_nacimiento.isoformat() if e.fecha_nacimiento else None
+        } for e in emprendedores],
+        'siguiente': siguiente
+    })
+
 # --- Ver detalles de un emprendimiento ---
 @app.route('/emprendimiento/<int:id>')
 def ver_emprendimiento(id):
@@ -681,23 +3430,36 @@ def ver_explorador(id):
 
 # --- Eliminar emprendimiento ---
 @app.route('/eliminar_emprendimiento/<int:id>', methods=['POST'])
+@unidad_de_trabajo
 def eliminar_emprendimiento(id):
-    emprendimiento = Emprendedor.query.get_or_404(id)
+    # Los favoritos de cada empresa se borran uno a uno por el ORM: se cargan de una vez para todas
+    emprendimiento = Emprendedor.query.options(
+        joinedload(Emprendedor.user),
+        selectinload(Emprendedor.empresas).selectinload(Empresa.favoritos)
+    ).filter_by(id=id).first_or_404()
     user = emprendimiento.user  # Obtiene el usuario asociado
 
+    ids = [empresa.id for empresa in emprendimiento.empresas]
+    if ids:
+        # Visitas y su rollup, en bloque: pueden ser miles y no tocan versiones ni contadores de otras empresas
+        db.session.execute(Visita.__table__.delete().where(Visita.empresa_id.in_(ids)))
+        db.session.execute(VisitaDiaria.__table__.delete().where(VisitaDiaria.empresa_id.in_(ids)))
     for empresa in emprendimiento.empresas:
+        quitar_empresa_de_coocurrencias(empresa.id)
+        for favorito in empresa.favoritos:
+            db.session.delete(favorito)
         db.session.delete(empresa)
 
     # Registrar en auditoría antes de eliminar
-    log = LogAccion(
+    registrar_auditoria(
         accion='Eliminación',
+        codigo=EMPRENDEDOR_ELIMINAR,
         entidad_id=user.id,
         detalles=f'Se eliminó el emprendedor"{user.username}".'
     )
-    db.session.add(log)
 
     db.session.delete(user)
-    db.session.commit()
+    despues_de_confirmar(estadisticas_admin.invalidar)
 
     flash('Emprendimiento eliminado completamente.', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -705,6 +3467,7 @@ def eliminar_emprendimiento(id):
 
 # --- Editar emprendimiento ---
 @app.route('/editar_emprendimiento/<int:id>', methods=['POST'])
+@unidad_de_trabajo
 def editar_emprendimiento(id):
     e = Empresa.query.get_or_404(id)
 
@@ -726,9 +3489,6 @@ def editar_emprendimiento(id):
     e.plan = request.form.get('plan', e.plan)
     e.clasificacion = request.form.get('clasificacion', e.clasificacion)
 
-    # Guardar cambios
-    db.session.commit()
-
     # Comparar y generar detalle de los cambios
     cambios = []
     for campo, valor_anterior in datos_antes.items():
@@ -739,13 +3499,15 @@ def editar_emprendimiento(id):
     detalles = ", ".join(cambios) if cambios else "Sin cambios detectados"
 
     # Registrar auditoría
-    log = LogAccion(
+    registrar_auditoria(
         accion="Edición de Emprendedor",
+        codigo=EMPRESA_EDITAR,
         entidad_id=e.id,
+        empresa_id=e.id,
         detalles=f"Se editaron los datos del emprendimiento '{e.nombre_emprendimiento}'. Cambios: {detalles}"
     )
-    db.session.add(log)
-    db.session.commit()
+
+    despues_de_confirmar(estadisticas_admin.invalidar)
 
     flash('Información actualizada correctamente.', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -753,20 +3515,37 @@ def editar_emprendimiento(id):
 
 # --- Eliminar explorador ---
 @app.route('/eliminar_explorador/<int:id>', methods=['POST'])
+@unidad_de_trabajo
 def eliminar_explorador(id):
-    explorador = Explorador.query.get_or_404(id)
+    explorador = Explorador.query.options(
+        joinedload(Explorador.user),
+        selectinload(Explorador.favoritos).joinedload(Favorito.empresa)
+    ).filter_by(id=id).first_or_404()
     user = explorador.user  # Obtiene el usuario asociado
 
     # Registrar en auditoría antes de eliminar
-    log = LogAccion(
+    registrar_auditoria(
         accion='Eliminación',
+        codigo=EXPLORADOR_ELIMINAR,
         entidad_id=user.id,
         detalles=f'Se eliminó el usuario "{user.username}" asociado al explorador "{explorador.primer_nombre,explorador.primer_apellido}".'
     )
-    db.session.add(log)
 
+    quitar_explorador_de_coocurrencias(explorador.id)
+    if explorador.favoritos:
+        tabla = Empresa.__table__
+        db.session.execute(
+            tabla.update()
+            .where(tabla.c.id.in_([f.empresa_id for f in explorador.favoritos]))
+            .values(favoritos_count=tabla.c.favoritos_count - 1)
+        )
+    # Por el ORM (no con DELETE masivo): el before_flush sube la versión de sus categorías
+    for favorito in explorador.favoritos:
+        db.session.delete(favorito)
+    # Las visitas se conservan para las estadísticas, sin el explorador
+    db.session.execute(update(Visita).where(Visita.explorador_id == explorador.id).values(explorador_id=None))
     db.session.delete(user)  # Esto elimina al usuario y en cascada su registro de explorador
-    db.session.commit()
+    despues_de_confirmar(estadisticas_admin.invalidar)
 
     flash('Explorador eliminado completamente.', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -775,6 +3554,7 @@ def eliminar_explorador(id):
 
 # EDITAR EXPLORADOR
 @app.route('/editar_explorador/<int:id>', methods=['POST'])
+@unidad_de_trabajo
 def editar_explorador(id):
     explorador = Explorador.query.get_or_404(id)
 
@@ -803,12 +3583,11 @@ def editar_explorador(id):
             else:
                 explorador.fecha_nacimiento = fecha_str
         except Exception as e:
+            db.session.rollback()  # descarta los campos ya asignados
             flash(f'Error en la fecha ({e}). Usa el formato AAAA-MM-DD.', 'danger')
             return redirect(url_for('admin_dashboard'))
 
     try:
-        db.session.commit()
-
         # Comparar cambios
         cambios = []
         for campo, valor_anterior in datos_antes.items():
@@ -819,13 +3598,14 @@ def editar_explorador(id):
         detalles = ", ".join(cambios) if cambios else "Sin cambios detectados"
 
         # 🔹 Registrar auditoría
-        log = LogAccion(
+        registrar_auditoria(
             accion="Edición de Explorador",
+            codigo=EXPLORADOR_EDITAR,
             entidad_id=explorador.id,
             detalles=f"Se editaron los datos del explorador '{explorador.primer_nombre} {explorador.primer_apellido}'. Cambios: {detalles}"
         )
-        db.session.add(log)
-        db.session.commit()
+        db.session.flush()  # los errores de la BD aparecen aquí y no al confirmar
+        despues_de_confirmar(estadisticas_admin.invalidar)
 
         flash('Explorador actualizado correctamente.', 'success')
 
@@ -842,33 +3622,1244 @@ def explorador_dashboard():
         flash('Debes iniciar sesión como explorador.', 'warning')
         return redirect(url_for('login'))
 
-    user = User.query.get(session['user_id'])    
-    explorador = Explorador.query.filter_by(user_id=user.id).first()
+    user = User.query.options(joinedload(User.explorador)).filter_by(id=session['user_id']).first()
+    explorador = user.explorador
     #Obtener los favoritos reales del explorador
-    favoritos = Favorito.query.filter_by(explorador_id=explorador.id)\
+    # La plantilla lee fav.empresa en cada fila: se trae en la misma consulta
+    favoritos = Favorito.query.options(joinedload(Favorito.empresa)).filter_by(explorador_id=explorador.id)\
         .order_by(Favorito.fecha_guardado.desc()).all()
     
     return render_template('Explorador/dashboard_explorador.html', user=user, favoritos=favoritos, explorador=explorador)
 
+# -------------------------------
+# Recomendaciones: muestreo ponderado O(1) por categoría (método alias)
+# -------------------------------
+def _sin_acentos(texto):
+    return unicodedata.normalize('NFKD', (texto or '').lower()).encode('ascii', 'ignore').decode()
+
+class TablaAlias:
+    """Muestreo ponderado en O(1) (método alias de Vose); construirla cuesta O(n)."""
+
+    def __init__(self, ids, pesos):
+        n = len(ids)
+        total = sum(pesos)
+        self.ids = ids
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+
+        escalados = [p * n / total for p in pesos]
+        pequeños = [i for i, p in enumerate(escalados) if p < 1]
+        grandes = [i for i, p in enumerate(escalados) if p >= 1]
+        while pequeños and grandes:
+            s, l = pequeños.pop(), grandes.pop()
+            self.prob[s] = escalados[s]
+            self.alias[s] = l
+            escalados[l] -= 1 - escalados[s]
+            (pequeños if escalados[l] < 1 else grandes).append(l)
+
+    def muestrear(self):
+        i = random.randrange(len(self.ids))
+        return self.ids[i] if random.random() < self.prob[i] else self.ids[self.alias[i]]
+
+class IndiceRecomendaciones:
+    """Candidatos por categoría en memoria (solo id y campos de la tarjeta) con su peso por popularidad.
+
+    Las altas, ediciones y favoritos marcan la empresa para recargarla en la siguiente consulta;
+    las visitas se suman directamente al confirmarse. Cada `refresco_s` se recarga todo.
+    """
+
+    def __init__(self, dias, refresco_s, peso_visita, peso_favorito, impulso_plan):
+        self.dias = dias
+        self.refresco_s = refresco_s
+        self.peso_visita = peso_visita
+        self.peso_favorito = peso_favorito
+        self.impulso_plan = impulso_plan
+        self._lock = threading.Lock()
+        self._empresas = {}        # id -> dict con categoría, plan, contadores y campos de la tarjeta
+        self._por_categoria = {}   # categoría normalizada -> set(ids)
+        self._tablas = {}          # tupla de categorías -> TablaAlias
+        self._consultas = {}       # texto normalizado -> tupla de categorías
+        self._pendientes = set()
+        self._cargado_en = None
+
+    def _peso(self, e):
+        return (1 + self.peso_visita * e['visitas'] + self.peso_favorito * e['favoritos']) * self.impulso_plan.get(e['plan'], 1.0)
+
+    def _leer(self, ids=None):
+        desde = datetime.utcnow().date() - timedelta(days=self.dias)  # VisitaDiaria.dia es UTC
+        visitas = db.session.query(VisitaDiaria.empresa_id, func.sum(VisitaDiaria.total))\
+            .filter(VisitaDiaria.dia >= desde).group_by(VisitaDiaria.empresa_id)
+        empresas = db.session.query(
+            Empresa.id, Empresa.clasificacion, Empresa.plan, Empresa.favoritos_count, Empresa.nombre_emprendimiento,
+            func.substr(Empresa.descripcion, 1, 240), Empresa.imagen_filename, Empresa.imagen_variantes, Empresa.url
+        ).filter(Empresa.clasificacion.isnot(None))
+        if ids is not None:
+            visitas = visitas.filter(VisitaDiaria.empresa_id.in_(ids))
+            empresas = empresas.filter(Empresa.id.in_(ids))
+
+        visitas = dict(visitas.all())
+        return {
+            empresa_id: {
+                'categoria': _sin_acentos(clasificacion), 'plan': plan,
+                'visitas': int(visitas.get(empresa_id, 0)), 'favoritos': favoritos,
+                'nombre': nombre, 'descripcion': descripcion, 'imagen_filename': imagen, 'imagen_variantes': variantes, 'url': url
+            }
+            for empresa_id, clasificacion, plan, favoritos, nombre, descripcion, imagen, variantes, url in empresas
+        }
+
+    def _quitar(self, empresa_id):
+        e = self._empresas.pop(empresa_id, None)
+        if e is None:
+            return
+        ids = self._por_categoria[e['categoria']]
+        ids.discard(empresa_id)
+        if not ids:
+            del self._por_categoria[e['categoria']]
+            self._consultas.clear()
+        self._invalidar(e['categoria'])
+
+    def _poner(self, empresa_id, e):
+        if e['categoria'] not in self._por_categoria:
+            self._por_categoria[e['categoria']] = set()
+            self._consultas.clear()
+        self._por_categoria[e['categoria']].add(empresa_id)
+        self._empresas[empresa_id] = e
+        self._invalidar(e['categoria'])
+
+    def _invalidar(self, categoria):
+        for clave in [c for c in self._tablas if categoria in c]:
+            del self._tablas[clave]
+
+    def _al_dia(self):
+        if self._cargado_en is None or time.monotonic() - self._cargado_en > self.refresco_s:
+            empresas = self._leer()
+            with self._lock:
+                self._empresas, self._por_categoria = {}, {}
+                self._tablas.clear()
+                self._consultas.clear()
+                self._pendientes.clear()
+                for empresa_id, e in empresas.items():
+                    self._poner(empresa_id, e)
+                self._cargado_en = time.monotonic()
+        elif self._pendientes:
+            with self._lock:
+                ids, self._pendientes = self._pendientes, set()
+            empresas = self._leer(ids)
+            with self._lock:
+                for empresa_id in ids:
+                    self._quitar(empresa_id)
+                    if empresa_id in empresas:
+                        self._poner(empresa_id, empresas[empresa_id])
+
+    def marcar(self, ids):
+        with self._lock:
+            self._pendientes.update(ids)
+
+    def sumar_visitas(self, conteos):
+        with self._lock:
+            for empresa_id, n in conteos.items():
+                e = self._empresas.get(empresa_id)
+                if e is not None:
+                    e['visitas'] += n
+                    self._invalidar(e['categoria'])
+
+    def elegir(self, texto):
+        """Empresa al azar, ponderada por popularidad, entre las categorías que casan con `texto`."""
+        self._al_dia()
+        clave = _sin_acentos(texto)
+        with self._lock:
+            categorias = self._consultas.get(clave)
+            if categorias is None:
+                # Mismo criterio que la búsqueda: cada palabra es prefijo de alguna palabra de la categoría
+                tokens = re.findall(r'\w+', clave)
+                categorias = tuple(sorted(
+                    c for c in self._por_categoria
+                    if tokens and all(any(p.startswith(t) for p in re.findall(r'\w+', c)) for t in tokens)
+                ))
+                if len(self._consultas) > 1000:
+                    self._consultas.clear()
+                self._consultas[clave] = categorias
+            if not categorias:
+                return None
+
+            tabla = self._tablas.get(categorias)
+            if tabla is None:
+                ids = [i for c in categorias for i in self._por_categoria[c]]
+                tabla = self._tablas[categorias] = TablaAlias(ids, [self._peso(self._empresas[i]) for i in ids])
+            return self._empresas[tabla.muestrear()]
+
+indice_recomendaciones = IndiceRecomendaciones(
+    dias=app.config['RECOMENDACION_DIAS'],
+    refresco_s=app.config['RECOMENDACION_REFRESCO_S'],
+    peso_visita=app.config['RECOMENDACION_PESO_VISITA'],
+    peso_favorito=app.config['RECOMENDACION_PESO_FAVORITO'],
+    impulso_plan=app.config['RECOMENDACION_IMPULSO_PLAN']
+)
+
+# Altas, ediciones, bajas y favoritos: la empresa se recarga en el índice tras el commit
+@event.listens_for(db.session, 'after_flush')
+def _seguir_recomendaciones(sesion, _contexto):
+    ids = set()
+    for obj in list(sesion.new) + list(sesion.dirty) + list(sesion.deleted):
+        if isinstance(obj, Empresa):
+            ids.add(obj.id)
+        elif isinstance(obj, Favorito):
+            ids.add(obj.empresa_id)
+    ids.discard(None)
+    if ids:
+        despues_de_confirmar(functools.partial(indice_recomendaciones.marcar, ids))
+
 # Ruta para recomendar un lugar por categoría
 @app.route('/recomendar/<categoria>')
 def recomendar_lugar(categoria):
-    from random import choice
-    lugares = Empresa.query.filter(Empresa.clasificacion.ilike(f'%{categoria}%')).all()
-    if not lugares:
+    lugar = indice_recomendaciones.elegir(categoria)
+    if not lugar:
         return jsonify({'error': 'No hay lugares en esta categoría'}), 404
 
-    lugar = choice(lugares)
     return jsonify({
-        'nombre': lugar.nombre_emprendimiento,
-        'descripcion': lugar.descripcion,
-        'imagen': url_for('static', filename=f'Empresas/{lugar.imagen_filename}') if lugar.imagen_filename else url_for('static', filename='Imagenes/default.jpg'),
-        'url': lugar.url or '#'
+        'nombre': lugar['nombre'],
+        'descripcion': lugar['descripcion'],
+        'imagen': url_imagen_empresa(lugar['imagen_filename'], lugar['imagen_variantes']),
+        'url': lugar['url'] or '#'
+    })
+
+# -------------------------------
+# "Quienes guardaron esto también guardaron": co-ocurrencia de favoritos
+# -------------------------------
+# Matriz dispersa empresa x empresa: conteo de exploradores que tienen ambas en favoritos.
+# Se guarda en los dos sentidos (a, b) y (b, a) para leer los vecinos de una empresa con un solo rango del índice;
+# la diagonal (a, a) es el total de favoritos de la empresa, el denominador de la similitud.
+class CoocurrenciaFavorito(db.Model):
+    __tablename__ = 'coocurrencia_favorito'
+    empresa_a = db.Column(db.Integer, primary_key=True)
+    empresa_b = db.Column(db.Integer, primary_key=True)
+    conteo = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_coocurrencia_a_conteo', 'empresa_a', 'conteo'),
+    )
+
+def actualizar_coocurrencias(explorador_id, empresa_id, delta):
+    """Suma `delta` (+1 al guardar, -1 al quitar) a los pares de `empresa_id` con los demás favoritos del explorador."""
+    otras = [e for (e,) in db.session.query(Favorito.empresa_id)
+             .filter(Favorito.explorador_id == explorador_id, Favorito.empresa_id != empresa_id)]
+
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    filas = [{'empresa_a': empresa_id, 'empresa_b': empresa_id, 'conteo': delta}]
+    filas += [{'empresa_a': a, 'empresa_b': b, 'conteo': delta}
+              for otra in otras for a, b in ((empresa_id, otra), (otra, empresa_id))]
+    stmt = upsert(CoocurrenciaFavorito)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['empresa_a', 'empresa_b'],
+        set_={'conteo': CoocurrenciaFavorito.conteo + stmt.excluded.conteo}
+    )
+    db.session.execute(stmt, filas)
+
+    if delta < 0:
+        db.session.execute(CoocurrenciaFavorito.__table__.delete().where(
+            CoocurrenciaFavorito.conteo <= 0,
+            or_(and_(CoocurrenciaFavorito.empresa_a == empresa_id, CoocurrenciaFavorito.empresa_b.in_(otras + [empresa_id])),
+                and_(CoocurrenciaFavorito.empresa_b == empresa_id, CoocurrenciaFavorito.empresa_a.in_(otras)))
+        ))
+
+def quitar_explorador_de_coocurrencias(explorador_id):
+    """Resta todos los pares que aportaba un explorador (antes de borrarlo)."""
+    favoritos = [e for (e,) in db.session.query(Favorito.empresa_id).filter(Favorito.explorador_id == explorador_id)]
+    for i, empresa_id in enumerate(favoritos):
+        # Cada par se resta una vez en cada sentido: contra sí misma (diagonal) y los favoritos aún no recorridos
+        restantes = favoritos[i:]
+        if restantes:
+            db.session.execute(
+                update(CoocurrenciaFavorito)
+                .where(or_(and_(CoocurrenciaFavorito.empresa_a == empresa_id, CoocurrenciaFavorito.empresa_b.in_(restantes)),
+                           and_(CoocurrenciaFavorito.empresa_b == empresa_id, CoocurrenciaFavorito.empresa_a.in_(restantes[1:]))))
+                .values(conteo=CoocurrenciaFavorito.conteo - 1)
+            )
+    db.session.execute(CoocurrenciaFavorito.__table__.delete().where(CoocurrenciaFavorito.conteo <= 0))
+
+def quitar_empresa_de_coocurrencias(empresa_id):
+    db.session.execute(CoocurrenciaFavorito.__table__.delete().where(
+        or_(CoocurrenciaFavorito.empresa_a == empresa_id, CoocurrenciaFavorito.empresa_b == empresa_id)
+    ))
+
+def _conteos_favoritos(ids):
+    if not ids:
+        return {}
+    return dict(db.session.query(CoocurrenciaFavorito.empresa_a, CoocurrenciaFavorito.conteo)
+                .filter(CoocurrenciaFavorito.empresa_a.in_(ids), CoocurrenciaFavorito.empresa_b == CoocurrenciaFavorito.empresa_a).all())
+
+def _vecinos(empresa_id, limite):
+    return db.session.query(CoocurrenciaFavorito.empresa_b, CoocurrenciaFavorito.conteo)\
+        .filter(CoocurrenciaFavorito.empresa_a == empresa_id, CoocurrenciaFavorito.empresa_b != empresa_id)\
+        .order_by(CoocurrenciaFavorito.conteo.desc()).limit(limite).all()
+
+def _vecinos_de_varias(ids, limite):
+    """(a, b, conteo) con los `limite` vecinos más fuertes de cada empresa de `ids`, en una sola sentencia.
+
+    Un UNION ALL de subconsultas con LIMIT: cada una corta pronto sobre ix_coocurrencia_a_conteo
+    (un ROW_NUMBER() OVER recorrería todos los vecinos de las empresas populares).
+    """
+    filas = []
+    for i in range(0, len(ids), 400):  # SQLite admite hasta 500 términos por sentencia compuesta
+        partes = [
+            select(select(CoocurrenciaFavorito.empresa_a, CoocurrenciaFavorito.empresa_b, CoocurrenciaFavorito.conteo)
+                   .where(CoocurrenciaFavorito.empresa_a == a, CoocurrenciaFavorito.empresa_b != a)
+                   .order_by(CoocurrenciaFavorito.conteo.desc()).limit(limite).subquery())
+            for a in ids[i:i + 400]
+        ]
+        filas += db.session.execute(union_all(*partes) if len(partes) > 1 else partes[0]).all()
+    return filas
+
+def empresas_similares(empresa_id, k=10):
+    """Top-K por similitud coseno: co(a, b) / sqrt(favoritos(a) · favoritos(b))."""
+    candidatos = _vecinos(empresa_id, k * 5)
+    totales = _conteos_favoritos([empresa_id] + [b for b, _ in candidatos])
+    n_a = totales.get(empresa_id, 0)
+    puntajes = [(b, conteo / math.sqrt(n_a * totales[b])) for b, conteo in candidatos if n_a and totales.get(b)]
+    return sorted(puntajes, key=lambda p: -p[1])[:k]
+
+def recomendaciones_explorador(explorador, k=10):
+    """Suma de similitudes con sus favoritos; sin favoritos, lo más guardado de sus preferencias."""
+    favoritos = {e for (e,) in db.session.query(Favorito.empresa_id).filter(Favorito.explorador_id == explorador.id)}
+    preferencias = {_sin_acentos(p.strip()) for p in re.split(r'[,;]', explorador.preferencias or '') if p.strip()}
+
+    if not favoritos:
+        consulta = db.session.query(Favorito.empresa_id, func.count(Favorito.id))\
+            .join(Empresa, Empresa.id == Favorito.empresa_id)
+        if preferencias:
+            consulta = consulta.filter(func.lower(Empresa.clasificacion).in_(preferencias))
+        consulta = consulta.group_by(Favorito.empresa_id).order_by(func.count(Favorito.id).desc()).limit(k)
+        return [(empresa_id, float(n)) for empresa_id, n in consulta]
+
+    # Solo los vecinos más fuertes de cada favorito: acota el trabajo en empresas muy populares
+    filas = [(a, b, conteo) for a, b, conteo in _vecinos_de_varias(list(favoritos), k * 5) if b not in favoritos]
+    totales = _conteos_favoritos(favoritos | {b for _, b, _ in filas})
+    puntajes = Counter()
+    for a, b, conteo in filas:
+        if totales.get(a) and totales.get(b):
+            puntajes[b] += conteo / math.sqrt(totales[a] * totales[b])
+
+    if preferencias and puntajes:
+        # Pequeño empujón a las categorías que el explorador marcó como preferidas
+        categorias = dict(db.session.query(Empresa.id, Empresa.clasificacion).filter(Empresa.id.in_(list(puntajes))).all())
+        for b in puntajes:
+            if _sin_acentos(categorias.get(b)) in preferencias:
+                puntajes[b] *= 1.25
+    return puntajes.most_common(k)
+
+def _empresas_puntuadas(puntajes):
+    ids = [empresa_id for empresa_id, _ in puntajes]
+    empresas = {e.id: e for e in Empresa.query.filter(Empresa.id.in_(ids))} if ids else {}
+    return [{
+        'id': empresa_id,
+        'nombre': empresas[empresa_id].nombre_emprendimiento,
+        'clasificacion': empresas[empresa_id].clasificacion,
+        'imagen': url_imagen_empresa(empresas[empresa_id].imagen_filename, empresas[empresa_id].imagen_variantes),
+        'url': empresas[empresa_id].url or '#',
+        'puntaje': round(puntaje, 4)
+    } for empresa_id, puntaje in puntajes if empresa_id in empresas]
+
+@app.route('/api/empresas/<int:empresa_id>/similares')
+def api_empresas_similares(empresa_id):
+    k = max(1, min(request.args.get('k', 10, type=int), 50))
+    return jsonify({'empresa_id': empresa_id, 'similares': _empresas_puntuadas(empresas_similares(empresa_id, k))})
+
+@app.route('/api/explorador/recomendaciones')
+def api_recomendaciones_explorador():
+    if 'user_id' not in session or session.get('role') != 'Explorador':
+        return jsonify({'error': 'No autorizado'}), 403
+    explorador = Explorador.query.filter_by(user_id=session['user_id']).first()
+    if not explorador:
+        return jsonify({'error': 'Explorador no encontrado'}), 404
+
+    k = max(1, min(request.args.get('k', 10, type=int), 50))
+    return jsonify({'recomendaciones': _empresas_puntuadas(recomendaciones_explorador(explorador, k))})
+
+SQL_RECONSTRUIR_COOCURRENCIAS = """
+    INSERT INTO coocurrencia_favorito (empresa_a, empresa_b, conteo)
+    SELECT f1.empresa_id, f2.empresa_id, COUNT(*)
+    FROM favorito f1
+    JOIN favorito f2 ON f2.explorador_id = f1.explorador_id
+    GROUP BY f1.empresa_id, f2.empresa_id
+"""
+
+def reconstruir_coocurrencias():
+    CoocurrenciaFavorito.query.delete()
+    db.session.execute(text(SQL_RECONSTRUIR_COOCURRENCIAS))
+    db.session.commit()
+    return CoocurrenciaFavorito.query.count()
+
+@app.cli.command('reconstruir-coocurrencias')
+def reconstruir_coocurrencias_cli():
+    """Recalcula desde cero la matriz de co-ocurrencia a partir de la tabla favorito."""
+    inicio = time.perf_counter()
+    pares = reconstruir_coocurrencias()
+    print(f'{pares} pares en {time.perf_counter() - inicio:.2f} s')
+
+@app.cli.command('bench-coocurrencias')
+@click.option('--favoritos', default=100_000, show_default=True)
+@click.option('--empresas', default=2_000, show_default=True)
+@click.option('--exploradores', default=10_000, show_default=True)
+def bench_coocurrencias(favoritos, empresas, exploradores):
+    """Datos sintéticos (popularidad tipo Zipf) en una base temporal: reconstrucción, toggles y top-K."""
+    import tempfile
+
+    def percentiles(tiempos):
+        tiempos = sorted(tiempos)
+        return f'p50 {tiempos[len(tiempos) // 2] * 1000:7.2f} ms   p95 {tiempos[int(len(tiempos) * 0.95)] * 1000:7.2f} ms'
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        app_bench = Flask(__name__)
+        app_bench.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(carpeta, 'bench.db')
+        db.init_app(app_bench)
+        with app_bench.app_context():
+            db.create_all()
+            rng = random.Random(42)
+            db.session.execute(insert(Empresa), [
+                {'id': i, 'nombre_emprendimiento': f'Empresa {i}', 'nit': str(i), 'clasificacion': 'Comida'}
+                for i in range(1, empresas + 1)
+            ])
+            pesos = [1 / i for i in range(1, empresas + 1)]
+            pares = set()
+            while len(pares) < favoritos:
+                explorador_id = rng.randint(1, exploradores)
+                pares.update((explorador_id, e) for e in rng.choices(range(1, empresas + 1), weights=pesos, k=5))
+            db.session.execute(insert(Favorito), [{'explorador_id': x, 'empresa_id': e} for x, e in sorted(pares)[:favoritos]])
+            db.session.commit()
+
+            inicio = time.perf_counter()
+            n_pares = reconstruir_coocurrencias()
+            print(f'reconstrucción      {time.perf_counter() - inicio:7.2f} s    ({favoritos} favoritos -> {n_pares} pares)')
+
+            tiempos = []
+            for _ in range(500):
+                explorador_id, empresa_id = rng.randint(1, exploradores), rng.randint(1, empresas)
+                inicio = time.perf_counter()
+                existente = Favorito.query.filter_by(explorador_id=explorador_id, empresa_id=empresa_id).first()
+                if existente:
+                    db.session.delete(existente)
+                    actualizar_coocurrencias(explorador_id, empresa_id, -1)
+                else:
+                    db.session.add(Favorito(explorador_id=explorador_id, empresa_id=empresa_id))
+                    actualizar_coocurrencias(explorador_id, empresa_id, +1)
+                db.session.commit()
+                tiempos.append(time.perf_counter() - inicio)
+            print(f'toggle incremental  {percentiles(tiempos)}')
+
+            tiempos = []
+            for empresa_id in rng.sample(range(1, empresas + 1), 500):
+                inicio = time.perf_counter()
+                empresas_similares(empresa_id, 10)
+                tiempos.append(time.perf_counter() - inicio)
+            print(f'similares top-10    {percentiles(tiempos)}')
+
+            tiempos = []
+            for explorador_id in rng.sample(range(1, exploradores + 1), 500):
+                inicio = time.perf_counter()
+                recomendaciones_explorador(Explorador(id=explorador_id), 10)
+                tiempos.append(time.perf_counter() - inicio)
+            print(f'por explorador      {percentiles(tiempos)}')
+            db.session.remove()
+            db.engine.dispose()
+
+# -------------------------------
+# Datos sintéticos a escala y benchmark de rutas
+# -------------------------------
+CATEGORIAS_SINTETICAS = ['Comida', 'Deportes', 'Ocio', 'Arte y Cultura', 'Naturaleza', 'Compras']
+ZONAS_SINTETICAS = ['Centro', 'El Cerrito', 'Delicias', 'Campin', 'Santa Rita', 'Tres esquinas', 'Rio Frio',
+                    'El Misterio', 'La Estacion', 'Fagua', 'Yerbabuena', 'Fonquetá', 'Bojacá']
+PLANES_SINTETICOS = ['Sin Plan', 'Valvanera', 'Castillo Marroquin', 'Diosa Chía']
+NOMBRES_SINTETICOS = ['Ana', 'Luis', 'María', 'Carlos', 'Laura', 'Andrés', 'Sofía', 'Juan', 'Valentina', 'Diego', 'Camila', 'Jorge']
+APELLIDOS_SINTETICOS = ['Gómez', 'Rodríguez', 'Martínez', 'López', 'García', 'Pérez', 'Sánchez', 'Ramírez', 'Torres', 'Castro']
+PALABRAS_SINTETICAS = ['café', 'arepas', 'panadería', 'almojábanas', 'parque', 'sendero', 'taller', 'cerámica', 'mercado',
+                       'artesanías', 'cerveza', 'huerta', 'yoga', 'bicicletas', 'museo', 'música', 'postres', 'asados',
+                       'mirador', 'vivero', 'librería', 'tejidos', 'fritanga', 'granja']
+# (accion, codigo, tipo_entidad, rol del actor, peso relativo) de los logs sintéticos
+ACCIONES_SINTETICAS = [
+    ('Agregacion Favorito', FAVORITO_AGREGAR, 'Favorito', 'Explorador', 50),
+    ('Eliminación Favorito', FAVORITO_ELIMINAR, 'Favorito', 'Explorador', 15),
+    ('Edición Emprendedor', EMPRESA_EDITAR, None, 'Emprendedor', 10),
+    ('Edición de Explorador', EXPLORADOR_EDITAR, None, 'Explorador', 10),
+    ('Creación', USUARIO_CREAR, None, 'Explorador', 10),
+    ('Creación de Empresa', EMPRESA_CREAR, None, 'Emprendedor', 5),
+]
+CLAVE_SINTETICA = 'clave123'
+
+def _pesos_zipf(n, s, rng):
+    """Pesos acumulados 1/rango^s repartidos al azar entre n ids (los populares no son siempre los primeros)."""
+    pesos = [1 / (i ** s) for i in range(1, n + 1)]
+    rng.shuffle(pesos)
+    return list(itertools.accumulate(pesos))
+
+def _insertar_por_lotes(modelo, filas, lote, etiqueta):
+    """INSERT con executemany en bloques de `lote` filas, con un commit por bloque para no inflar el WAL."""
+    filas = iter(filas)
+    total = 0
+    inicio = time.perf_counter()
+    for bloque in iter(lambda: list(itertools.islice(filas, lote)), []):
+        # Insert de Core sobre la tabla: el bulk del ORM parte el bloque en un execute por cada combinación de
+        # columnas a None (los logs sin empresa_id o sin tipo_entidad), y cae de ~35k a ~10k filas/s
+        db.session.execute(insert(modelo.__table__), bloque)
+        db.session.commit()
+        total += len(bloque)
+        print(f'\r{etiqueta:<12} {total:>12,} filas  {total / (time.perf_counter() - inicio):>10,.0f} filas/s', end='', flush=True)
+    print()
+    return total
+
+@app.cli.command('sembrar-datos')
+@click.option('--usuarios', default=50_000, show_default=True)
+@click.option('--empresas', default=10_000, show_default=True)
+@click.option('--visitas', default=10_000_000, show_default=True)
+@click.option('--favoritos', default=1_000_000, show_default=True)
+@click.option('--logs', default=5_000_000, show_default=True)
+@click.option('--dias', default=365, show_default=True, help='Antigüedad máxima de visitas, favoritos y logs')
+@click.option('--lote', default=10_000, show_default=True)
+@click.option('--semilla', default=42, show_default=True)
+@click.option('--forzar', is_flag=True, help='Sembrar aunque la base ya tenga usuarios')
+def sembrar_datos(usuarios, empresas, visitas, favoritos, logs, dias, lote, semilla, forzar):
+    """Llena la base de DATABASE_URL con datos sintéticos (popularidad tipo Zipf) para medir a escala.
+
+    Un administrador, un emprendedor por cada diez usuarios y el resto exploradores, todos con la
+    clave CLAVE_SINTETICA. Al final reconstruye el rollup de visitas, los contadores de empresa y la
+    matriz de co-ocurrencia, como quedarían en producción.
+    """
+    if User.query.first() is not None and not forzar:
+        raise SystemExit('La base ya tiene usuarios; usa --forzar para sembrar encima')
+    n_emprendedores = max(1, min(empresas, usuarios // 10))
+    n_exploradores = usuarios - n_emprendedores - 1
+    if n_exploradores < 1 or empresas < 1:
+        raise SystemExit('Hacen falta al menos 3 usuarios y 1 empresa')
+    # Nadie guarda cientos de sitios: con el tope los exploradores más activos no disparan la co-ocurrencia
+    tope_por_explorador = min(empresas, 200)
+    if favoritos > n_exploradores * tope_por_explorador // 2:
+        raise SystemExit(f'Demasiados favoritos para {n_exploradores} exploradores '
+                         f'(máximo {n_exploradores * tope_por_explorador // 2})')
+
+    rng = random.Random(semilla)
+    ahora = datetime.utcnow()
+    segundos = dias * 86400
+    base_usuario = db.session.query(func.max(User.id)).scalar() or 0
+    base_emprendedor = db.session.query(func.max(Emprendedor.id)).scalar() or 0
+    base_explorador = db.session.query(func.max(Explorador.id)).scalar() or 0
+    base_empresa = db.session.query(func.max(Empresa.id)).scalar() or 0
+    primer_usuario_explorador = base_usuario + 2 + n_emprendedores
+    ids_empresa = range(base_empresa + 1, base_empresa + empresas + 1)
+    ids_explorador = range(base_explorador + 1, base_explorador + n_exploradores + 1)
+    acum_empresas = _pesos_zipf(empresas, 0.8, rng)
+    acum_exploradores = _pesos_zipf(n_exploradores, 0.5, rng)
+
+    def hace_un_rato():
+        return ahora - timedelta(seconds=rng.randrange(segundos))
+
+    def en_orden(n):
+        # Visitas y logs llegan en orden cronológico: los índices por fecha crecen por el final, como en producción
+        desde, paso = ahora - timedelta(seconds=segundos), segundos / max(n, 1)
+        return (desde + timedelta(seconds=(i + rng.random()) * paso) for i in range(n))
+
+    def persona():
+        return {
+            'primer_nombre': rng.choice(NOMBRES_SINTETICOS),
+            'primer_apellido': rng.choice(APELLIDOS_SINTETICOS),
+            'segundo_apellido': rng.choice(APELLIDOS_SINTETICOS),
+            'fecha_nacimiento': date(1950, 1, 1) + timedelta(days=rng.randrange(20_000)),
+            'telefono': f'3{rng.randrange(10 ** 9):09d}',
+        }
+
+    # Un solo hash para todos: generarlo por usuario llevaría minutos
+    clave = generate_password_hash(CLAVE_SINTETICA)
+    roles = itertools.chain(['Administrador'], itertools.repeat('Emprendedor', n_emprendedores),
+                            itertools.repeat('Explorador', n_exploradores))
+    _insertar_por_lotes(User, (
+        {'id': base_usuario + i, 'username': f'sintetico{base_usuario + i}', 'email': f'sintetico{base_usuario + i}@myiana.test',
+         'password_hash': clave, 'role': rol, 'created_at': hace_un_rato()}
+        for i, rol in enumerate(roles, 1)
+    ), lote, 'usuarios')
+    _insertar_por_lotes(Emprendedor, (
+        {'id': base_emprendedor + i, 'user_id': base_usuario + 1 + i, **persona()}
+        for i in range(1, n_emprendedores + 1)
+    ), lote, 'emprendedor')
+    _insertar_por_lotes(Explorador, (
+        {'id': x, 'user_id': primer_usuario_explorador + i, 'preferencias': rng.choice(CATEGORIAS_SINTETICAS), **persona()}
+        for i, x in enumerate(ids_explorador)
+    ), lote, 'explorador')
+
+    def empresa(i):
+        zona = rng.choice(ZONAS_SINTETICAS)
+        return {
+            'id': base_empresa + i,
+            'nombre_emprendimiento': f'{rng.choice(PALABRAS_SINTETICAS).capitalize()} {zona} {base_empresa + i}',
+            'nit': f'SINT-{base_empresa + i}',
+            'clasificacion': rng.choice(CATEGORIAS_SINTETICAS),
+            'plan': rng.choices(PLANES_SINTETICOS, weights=[70, 15, 10, 5])[0],
+            'zona': zona,
+            'ubicacion': f'Calle {rng.randint(1, 30)} # {rng.randint(1, 20)}-{rng.randint(1, 99)}',
+            'descripcion': ' '.join(rng.choices(PALABRAS_SINTETICAS, k=rng.randint(15, 60))).capitalize() + '.',
+            'rango_precios': rng.choice(['$', '$$', '$$$']),
+            # Cada emprendedor tiene al menos una empresa; el resto se reparte al azar
+            'emprendedor_id': base_emprendedor + (i if i <= n_emprendedores else rng.randint(1, n_emprendedores)),
+        }
+    _insertar_por_lotes(Empresa, (empresa(i) for i in range(1, empresas + 1)), lote, 'empresas')
+
+    def generar_favoritos():
+        vistos = set()
+        por_explorador = Counter()
+        while True:
+            for x, e in zip(rng.choices(ids_explorador, cum_weights=acum_exploradores, k=lote),
+                            rng.choices(ids_empresa, cum_weights=acum_empresas, k=lote)):
+                par = x << 32 | e
+                if par in vistos or por_explorador[x] >= tope_por_explorador:
+                    continue
+                vistos.add(par)
+                por_explorador[x] += 1
+                yield {'explorador_id': x, 'empresa_id': e, 'fecha_guardado': hace_un_rato()}
+                if len(vistos) == favoritos:
+                    return
+    if favoritos:
+        _insertar_por_lotes(Favorito, generar_favoritos(), lote, 'favoritos')
+
+    def generar_visitas():
+        fechas = en_orden(visitas)
+        for inicio in range(0, visitas, lote):
+            for e, fecha in zip(rng.choices(ids_empresa, cum_weights=acum_empresas, k=min(lote, visitas - inicio)), fechas):
+                yield {'empresa_id': e, 'fecha': fecha, 'tipo': 'clic'}
+    _insertar_por_lotes(Visita, generar_visitas(), lote, 'visitas')
+
+    def generar_logs():
+        pesos = [a[-1] for a in ACCIONES_SINTETICAS]
+        fechas = en_orden(logs)
+        for inicio in range(0, logs, lote):
+            acciones = rng.choices(ACCIONES_SINTETICAS, weights=pesos, k=min(lote, logs - inicio))
+            for (accion, codigo, tipo_entidad, rol, _peso), fecha in zip(acciones, fechas):
+                empresa_id = rng.choices(ids_empresa, cum_weights=acum_empresas)[0] if codigo not in (EXPLORADOR_EDITAR, USUARIO_CREAR) else None
+                if rol == 'Explorador':
+                    user_id = primer_usuario_explorador + rng.randrange(n_exploradores)
+                else:
+                    user_id = base_usuario + 2 + rng.randrange(n_emprendedores)
+                yield {'user_id': user_id, 'tipo_entidad': tipo_entidad, 'entidad_id': empresa_id or user_id,
+                       'accion': accion, 'detalles': f'{accion} (dato sintético)', 'fecha': fecha,
+                       'empresa_id': empresa_id, 'rol_actor': rol, 'codigo_accion': codigo}
+    _insertar_por_lotes(LogAccion, generar_logs(), lote, 'logs')
+
+    inicio = time.perf_counter()
+    filas_rollup = reconstruir_visitas_diarias()  # también reconcilia favoritos_count y visitas_count
+    pares = reconstruir_coocurrencias()
+    incrementar_versiones_categoria(CATEGORIAS_SINTETICAS)
+    if db.engine.dialect.name == 'postgresql':
+        # Los ids se insertaron explícitos: las secuencias no se enteraron
+        for tabla in ('"user"', 'emprendedor', 'explorador', 'empresa'):
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), (SELECT max(id) FROM {tabla}))"))
+    db.session.commit()
+    print(f'Derivados en {time.perf_counter() - inicio:.1f} s: {filas_rollup} filas de rollup, {pares} pares de co-ocurrencia')
+    print(f"Administrador: sintetico{base_usuario + 1} / clave '{CLAVE_SINTETICA}'")
+
+def _percentil(valores, fraccion):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * fraccion))]
+
+def _rutas_bench(escrituras):
+    """(método, url, user_id, cuerpo JSON) que recorre el benchmark: las de PRESUPUESTO_CONSULTAS y algunas más."""
+    from urllib.parse import quote
+
+    rutas = [('GET', url, user_id, None) for url, user_id in _rutas_con_presupuesto()]
+    empresa = Empresa.query.filter(Empresa.clasificacion.isnot(None)).order_by(Empresa.favoritos_count.desc()).first()
+    if empresa:
+        palabra = (re.findall(r'\w{4,}', empresa.descripcion or '') or [empresa.nombre_emprendimiento])[0]
+        rutas += [('GET', '/', None, None), ('GET', f'/api/buscar?q={palabra}', None, None),
+                  ('GET', f'/api/visitas/{empresa.id}', None, None), ('GET', f'/recomendar/{empresa.clasificacion}', None, None)]
+    explorador = Explorador.query.first()
+    if escrituras and empresa and explorador:
+        # Con un total par de peticiones (calentamiento incluido) los toggles dejan los favoritos como estaban
+        rutas += [('POST', f'/registrar_visita/{empresa.id}', explorador.user_id, None),
+                  ('POST', '/favorito/toggle', explorador.user_id, {'empresa_id': empresa.id})]
+    # Categorías como 'Arte y Cultura' y búsquedas con tildes van codificadas, igual que desde el navegador
+    return [(metodo, quote(url, safe='/?=&'), user_id, cuerpo) for metodo, url, user_id, cuerpo in rutas]
+
+def _hijos(pid):
+    """Pids de los procesos hijos de `pid` (workers de gunicorn), leyendo /proc."""
+    hijos = []
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entrada}/stat') as archivo:
+                campos = archivo.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(campos[1]) == pid:
+            hijos.append(int(entrada))
+    return hijos
+
+def _reiniciar_pico_rss(pids):
+    # Escribir 5 en clear_refs pone VmHWM al RSS actual (Linux >= 4.0)
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/clear_refs', 'w') as archivo:
+                archivo.write('5')
+        except OSError:
+            pass
+
+def _pico_rss_mb(pids):
+    """Mayor VmHWM (pico de memoria residente) entre los procesos; None si no hay /proc."""
+    picos = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as archivo:
+                picos += [int(linea.split()[1]) / 1024 for linea in archivo if linea.startswith('VmHWM:')]
+        except OSError:
+            pass
+    return round(max(picos), 1) if picos else None
+
+def _medir_ruta(pedir, ruta, peticiones, calentamiento, concurrencia, pids):
+    """Latencias, sentencias (de la cabecera Server-Timing) y pico de RSS de `peticiones` a una ruta."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    for _ in range(calentamiento):
+        pedir(*ruta)
+    _reiniciar_pico_rss(pids)
+
+    def una(_i):
+        inicio = time.perf_counter()
+        estado, cabecera = pedir(*ruta)
+        ms = (time.perf_counter() - inicio) * 1000
+        sentencias = re.search(r'desc="(\d+) sentencias"', cabecera or '')
+        db_ms = re.search(r'db;dur=([\d.]+)', cabecera or '')
+        return ms, estado, int(sentencias.group(1)) if sentencias else None, float(db_ms.group(1)) if db_ms else None
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(concurrencia) as hilos:
+        resultados = list(hilos.map(una, range(peticiones)))
+    duracion = time.perf_counter() - inicio
+
+    latencias = [r[0] for r in resultados]
+    sentencias = [r[2] for r in resultados if r[2] is not None]
+    db_ms = [r[3] for r in resultados if r[3] is not None]
+    return {
+        'peticiones': peticiones,
+        'errores': sum(1 for r in resultados if r[1] >= 400),
+        'estados': dict(Counter(str(r[1]) for r in resultados)),
+        'p50_ms': round(_percentil(latencias, 0.50), 2),
+        'p95_ms': round(_percentil(latencias, 0.95), 2),
+        'p99_ms': round(_percentil(latencias, 0.99), 2),
+        'media_ms': round(sum(latencias) / len(latencias), 2),
+        'peticiones_s': round(peticiones / duracion, 1),
+        'sentencias_media': round(sum(sentencias) / len(sentencias), 1) if sentencias else None,
+        'sentencias_max': max(sentencias) if sentencias else None,
+        'db_ms_p95': round(_percentil(db_ms, 0.95), 2) if db_ms else None,
+        'rss_pico_mb': _pico_rss_mb(pids),
+    }
+
+def _cliente_de_prueba(usuarios):
+    """pedir(método, url, user_id, cuerpo) -> (estado, Server-Timing) con el test client, en este proceso."""
+    clientes = {}
+
+    def pedir(metodo, url, user_id, cuerpo):
+        cliente = clientes.get(user_id)
+        if cliente is None:
+            cliente = clientes[user_id] = app.test_client()
+            if user_id:
+                usuario = usuarios[user_id]
+                with cliente.session_transaction() as sesion:
+                    sesion.update(user_id=usuario.id, role=usuario.role, username=usuario.username)
+        respuesta = cliente.open(url, method=metodo, json=cuerpo)
+        respuesta.close()
+        return respuesta.status_code, respuesta.headers.get('Server-Timing')
+    return pedir
+
+def _cliente_http(base, clave, usuarios):
+    """pedir(método, url, user_id, cuerpo) contra un servidor en `base`; cada usuario inicia sesión con /login."""
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    abridores = {}
+    candado = threading.Lock()
+
+    def abridor(user_id):
+        with candado:
+            if user_id not in abridores:
+                nuevo = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+                if user_id:
+                    username = usuarios[user_id].username
+                    datos = urllib.parse.urlencode({'identifier': username, 'password': clave}).encode()
+                    with nuevo.open(base + '/login', data=datos, timeout=60) as respuesta:
+                        if urllib.parse.urlsplit(respuesta.geturl()).path == '/login':
+                            raise SystemExit(f"No se pudo iniciar sesión como {username} con la clave '{clave}'")
+                abridores[user_id] = nuevo
+            return abridores[user_id]
+
+    def pedir(metodo, url, user_id, cuerpo):
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else None
+        peticion = urllib.request.Request(base + url, data=datos, method=metodo,
+                                          headers={'Content-Type': 'application/json'} if datos else {})
+        try:
+            with abridor(user_id).open(peticion, timeout=60) as respuesta:
+                respuesta.read()
+                return respuesta.status, respuesta.headers.get('Server-Timing')
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('Server-Timing')
+    return pedir
+
+def _arrancar_gunicorn(workers):
+    """Lanza `gunicorn app:app` en un puerto libre con PERFIL_SQL=1; devuelve (proceso, url base, pids de los workers)."""
+    import socket
+    import subprocess
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        puerto = s.getsockname()[1]
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{puerto}', '--log-level', 'warning', 'app:app'],
+        cwd=app.root_path, env={**os.environ, 'PERFIL_SQL': '1'}
+    )
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit(f'gunicorn terminó con código {proceso.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', puerto), timeout=1).close()
+            if len(_hijos(proceso.pid)) >= workers:
+                return proceso, f'http://127.0.0.1:{puerto}', _hijos(proceso.pid)
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proceso.terminate()
+    raise SystemExit('gunicorn no arrancó en 60 s')
+
+@app.cli.command('bench-rutas')
+@click.option('--peticiones', default=200, show_default=True, help='Peticiones medidas por ruta')
+@click.option('--calentamiento', default=5, show_default=True, help='Peticiones previas que no se miden')
+@click.option('--concurrencia', default=1, show_default=True)
+@click.option('--gunicorn', 'workers', type=int, help='Lanzar gunicorn local con N workers en vez del test client')
+@click.option('--url', help='Medir un servidor ya en marcha (con PERFIL_SQL=1 para contar sentencias)')
+@click.option('--clave', default=CLAVE_SINTETICA, show_default=True, help='Clave de los usuarios al iniciar sesión por HTTP')
+@click.option('--escrituras', is_flag=True, help='Incluir registrar_visita y favorito/toggle (escriben en la base; usar un total par de peticiones)')
+@click.option('--salida', type=click.Path(dir_okay=False), help='Informe JSON (por defecto instance/bench/rutas-<fecha>.json)')
+@click.option('--comparar', type=click.Path(exists=True, dir_okay=False), help='Informe anterior con el que comparar')
+def bench_rutas(peticiones, calentamiento, concurrencia, workers, url, clave, escrituras, salida, comparar):
+    """p50/p95/p99, sentencias por petición y pico de RSS de cada ruta, con un informe JSON para comparar versiones.
+
+    Por defecto usa el test client en este proceso; con --gunicorn o --url va por HTTP y el RSS es el
+    del worker más cargado (--url no conoce los pids: sin RSS). Conviene correrlo sobre una base de
+    `flask sembrar-datos`. El pico de RSS se reinicia antes de cada ruta (Linux).
+    """
+    rutas = _rutas_bench(escrituras)
+    if not rutas:
+        raise SystemExit('No hay usuarios ni empresas con los que recorrer las rutas (ver flask sembrar-datos)')
+
+    proceso = None
+    if workers:
+        proceso, url, pids = _arrancar_gunicorn(workers)
+        modo = f'gunicorn x{workers}'
+    elif url:
+        url, pids, modo = url.rstrip('/'), [], 'url'
+    else:
+        app.config['PERFIL_SQL'] = True
+        pids, modo = [os.getpid()], 'cliente'
+    # Los hilos de _medir_ruta no tienen contexto de app: los usuarios se leen aquí
+    usuarios = {u.id: u for u in db.session.query(User.id, User.role, User.username)
+                .filter(User.id.in_({ruta[2] for ruta in rutas if ruta[2]}))}
+    pedir = _cliente_http(url, clave, usuarios) if url else _cliente_de_prueba(usuarios)
+
+    mapa = app.url_map.bind('localhost')
+    resultados = {}
+    try:
+        for ruta in rutas:
+            metodo, ruta_url = ruta[0], ruta[1]
+            endpoint, _args = mapa.match(ruta_url.split('?')[0], method=metodo)
+            clave_ruta = f'{metodo} {endpoint}'
+            r = resultados[clave_ruta] = {'url': ruta_url, **_medir_ruta(pedir, ruta, peticiones, calentamiento, concurrencia, pids)}
+            rss = f"{r['rss_pico_mb']:7.1f} MB" if r['rss_pico_mb'] is not None else '      - MB'
+            sentencias = f"{r['sentencias_media']:5.1f}" if r['sentencias_media'] is not None else '    -'
+            print(f"{clave_ruta:<42} p50 {r['p50_ms']:8.2f}  p95 {r['p95_ms']:8.2f}  p99 {r['p99_ms']:8.2f} ms"
+                  f"  {sentencias} sent  {rss}{'  ' + str(r['errores']) + ' errores' if r['errores'] else ''}")
+    finally:
+        if proceso:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+
+    informe = {
+        'fecha': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'huella': HUELLA_DESPLIEGUE,
+        'modo': modo,
+        'peticiones_por_ruta': peticiones,
+        'concurrencia': concurrencia,
+        'base': {modelo.__tablename__: db.session.query(func.count()).select_from(modelo).scalar()
+                 for modelo in (User, Empresa, Favorito, Visita, LogAccion)},
+        'rutas': resultados,
+    }
+    salida = salida or os.path.join(app.instance_path, 'bench', f"rutas-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, 'w', encoding='utf-8') as archivo:
+        json.dump(informe, archivo, ensure_ascii=False, indent=2)
+    print(f'Informe en {salida}')
+
+    if comparar:
+        with open(comparar, encoding='utf-8') as archivo:
+            anterior = json.load(archivo)
+        print(f'\nFrente a {comparar} (p95 y sentencias por petición):')
+        if (anterior.get('modo'), anterior.get('concurrencia'), anterior.get('base')) != (modo, concurrencia, informe['base']):
+            print('Aviso: el informe anterior se midió con otro modo, concurrencia o volumen de datos')
+        anterior = anterior['rutas']
+        for clave_ruta, r in resultados.items():
+            previo = anterior.get(clave_ruta)
+            if not previo:
+                print(f'{clave_ruta:<42} (nueva)')
+                continue
+            cambio = (r['p95_ms'] - previo['p95_ms']) / previo['p95_ms'] * 100 if previo['p95_ms'] else 0.0
+            print(f"{clave_ruta:<42} p95 {previo['p95_ms']:8.2f} -> {r['p95_ms']:8.2f} ms ({cambio:+6.1f}%)"
+                  f"  sentencias {previo['sentencias_media']} -> {r['sentencias_media']}")
+
+# -------------------------------
+# Importación y exportación masiva (CSV / JSONL)
+# -------------------------------
+# Las filas se leen y escriben una a una (y en bloques de `lote` hacia la base): la memoria no crece con el
+# archivo. Ruta '-' = stdin/stdout; con extensión .gz se comprime o descomprime al vuelo.
+CAMPOS_EMPRESA_IMPORTACION = ['nombre_emprendimiento', 'nit', 'clasificacion', 'plan', 'zona', 'ubicacion',
+                              'descripcion', 'url', 'rango_precios', 'imagen_filename']
+CAMPOS_PERFIL_IMPORTACION = ['primer_nombre', 'segundo_nombre', 'primer_apellido', 'segundo_apellido', 'telefono']
+ROLES_IMPORTACION = ['Explorador', 'Emprendedor', 'Administrador']
+
+def _formato_intercambio(ruta, formato):
+    if formato:
+        return formato
+    return 'jsonl' if re.search(r'\.jsonl?(\.gz)?$', ruta) else 'csv'
+
+def _abrir_intercambio(ruta, modo):
+    if ruta == '-':
+        return click.open_file('-', modo, encoding='utf-8')
+    if ruta.endswith('.gz'):
+        return gzip.open(ruta, modo + 't', encoding='utf-8', newline='')
+    return open(ruta, modo, encoding='utf-8', newline='')
+
+def _leer_intercambio(archivo, formato):
+    """(línea, dict) por fila; si la fila no se puede leer, (línea, ValueError) y se sigue con la siguiente."""
+    if formato == 'csv':
+        lector = csv.DictReader(archivo)
+        for fila in lector:
+            yield lector.line_num, fila
+        return
+    for linea, texto in enumerate(archivo, 1):
+        if not texto.strip():
+            continue
+        try:
+            fila = json.loads(texto)
+        except ValueError as error:
+            yield linea, ValueError(f'JSON inválido: {error}')
+            continue
+        yield linea, fila if isinstance(fila, dict) else ValueError('se esperaba un objeto JSON')
+
+def _escribir_intercambio(archivo, formato, columnas, filas):
+    n = 0
+    if formato == 'csv':
+        escritor = csv.writer(archivo)
+        escritor.writerow(columnas)
+        for fila in filas:
+            escritor.writerow(fila)
+            n += 1
+        return n
+    for fila in filas:
+        archivo.write(_linea_jsonl(columnas, fila))
+        n += 1
+    return n
+
+def _linea_jsonl(columnas, fila):
+    return json.dumps(dict(zip(columnas, fila)), ensure_ascii=False, default=_json_fecha) + '\n'
+
+def _campos_de_texto(fila, campos, tabla, requeridos=()):
+    """Valores recortados de `campos` (None si faltan); ValueError si falta uno requerido o no cabe en la columna."""
+    datos = {}
+    for campo in campos:
+        valor = fila.get(campo)
+        valor = str(valor).strip() if valor is not None else ''
+        if not valor:
+            if campo in requeridos:
+                raise ValueError(f'falta {campo}')
+            datos[campo] = None
+            continue
+        maximo = getattr(tabla.c[campo].type, 'length', None)
+        if maximo and len(valor) > maximo:
+            raise ValueError(f'{campo} supera {maximo} caracteres')
+        datos[campo] = valor
+    return datos
+
+def _importar_archivo(ruta, formato, lote, preparar, insertar):
+    """Importa en bloques: preparar(bloque) -> (filas [(línea, datos)], duplicadas, errores); insertar(datos) escribe.
+
+    Cada bloque se confirma por separado. Si su INSERT falla (p. ej. un UNIQUE que otro proceso
+    ocupó entretanto), se reintenta fila por fila con SAVEPOINT para señalar solo las culpables.
+    """
+    totales = Counter()
+    with _abrir_intercambio(ruta, 'r') as archivo:
+        filas = _leer_intercambio(archivo, _formato_intercambio(ruta, formato))
+        for bloque in iter(lambda: list(itertools.islice(filas, lote)), []):
+            legibles = []
+            errores = []
+            for linea, fila in bloque:
+                if isinstance(fila, ValueError):
+                    errores.append((linea, str(fila)))
+                else:
+                    legibles.append((linea, fila))
+            validas, duplicadas, errores_validacion = preparar(legibles)
+            errores += errores_validacion
+            try:
+                with db.session.begin_nested():
+                    if validas:
+                        insertar([datos for _linea, datos in validas])
+                insertadas = len(validas)
+            except IntegrityError:
+                insertadas = 0
+                for linea, datos in validas:
+                    try:
+                        with db.session.begin_nested():
+                            insertar([datos])
+                        insertadas += 1
+                    except IntegrityError as error:
+                        errores.append((linea, f'rechazada por la base: {error.orig}'))
+            db.session.commit()
+            totales.update(importadas=insertadas, duplicadas=duplicadas, errores=len(errores))
+            for linea, mensaje in sorted(errores):
+                click.echo(f'línea {linea}: {mensaje}', err=True)
+    return totales
+
+def _resumir_importacion(ruta, totales, codigo, tipo_entidad):
+    """Un único LogAccion por importación, en vez de uno por fila."""
+    detalles = (f"Importación de '{os.path.basename(ruta)}': {totales['importadas']} nuevas, "
+                f"{totales['duplicadas']} duplicadas, {totales['errores']} con errores.")
+    registrar_auditoria(accion='Importación masiva', codigo=codigo, tipo_entidad=tipo_entidad,
+                        detalles=detalles, rol_actor='Sistema')
+    db.session.commit()
+    click.echo(detalles, err=True)
+
+def _preparar_empresas(filas):
+    tabla = Empresa.__table__
+    nits = {str(f.get('nit') or '').strip() for _linea, f in filas}
+    existentes = set(db.session.scalars(select(Empresa.nit).where(Empresa.nit.in_(nits))))
+    referencias = {str(f.get('emprendedor') or '').strip() for _linea, f in filas} - {''}
+    emprendedores = {}
+    for username, email, emprendedor_id in db.session.execute(
+        select(User.username, User.email, Emprendedor.id).join(Emprendedor, Emprendedor.user_id == User.id)
+        .where(or_(User.username.in_(referencias), User.email.in_(referencias)))
+    ):
+        emprendedores[username] = emprendedores[email] = emprendedor_id
+
+    validas, duplicadas, errores = [], 0, []
+    for linea, fila in filas:
+        try:
+            datos = _campos_de_texto(fila, CAMPOS_EMPRESA_IMPORTACION, tabla, requeridos=('nombre_emprendimiento', 'nit'))
+        except ValueError as error:
+            errores.append((linea, str(error)))
+            continue
+        if datos['nit'] in existentes:
+            duplicadas += 1
+            continue
+        referencia = str(fila.get('emprendedor') or '').strip()
+        if referencia and referencia not in emprendedores:
+            errores.append((linea, f"el emprendedor '{referencia}' no existe"))
+            continue
+        datos['plan'] = datos['plan'] or 'Sin Plan'
+        datos['emprendedor_id'] = emprendedores.get(referencia)
+        existentes.add(datos['nit'])  # repetidas dentro del mismo bloque
+        validas.append((linea, datos))
+    return validas, duplicadas, errores
+
+def _insertar_empresas(filas):
+    # INSERT de Core: no pasa por el before_flush que versiona las categorías, así que se hace aquí
+    db.session.execute(insert(Empresa.__table__), filas)
+    incrementar_versiones_categoria([f['clasificacion'] for f in filas])
+
+def _preparar_usuarios(filas, rol_fijo=None):
+    tabla_usuario = User.__table__
+    nombres = {str(f.get('username') or '').strip() for _linea, f in filas}
+    correos = {str(f.get('email') or '').strip() for _linea, f in filas}
+    ocupados = set(itertools.chain.from_iterable(db.session.execute(
+        select(User.username, User.email).where(or_(User.username.in_(nombres), User.email.in_(correos)))
+    )))
+
+    validas, duplicadas, errores = [], 0, []
+    for linea, fila in filas:
+        try:
+            usuario = _campos_de_texto(fila, ['username', 'email', 'role'], tabla_usuario, requeridos=('username', 'email'))
+            perfil = _campos_de_texto(fila, CAMPOS_PERFIL_IMPORTACION + ['preferencias'], Explorador.__table__)
+            rol = rol_fijo or usuario.pop('role') or 'Explorador'
+            if rol not in ROLES_IMPORTACION:
+                raise ValueError(f"rol '{rol}' desconocido")
+            fecha = str(fila.get('fecha_nacimiento') or '').strip()
+            try:
+                perfil['fecha_nacimiento'] = date.fromisoformat(fecha[:10]) if fecha else None
+            except ValueError:
+                raise ValueError('fecha_nacimiento inválida (AAAA-MM-DD)')
+            if fila.get('password_hash'):
+                usuario['password_hash'] = str(fila['password_hash'])
+            elif fila.get('password'):
+                usuario['password_hash'] = generate_password_hash(str(fila['password']))
+            else:
+                raise ValueError('falta password o password_hash')
+        except ValueError as error:
+            errores.append((linea, str(error)))
+            continue
+        if usuario['username'] in ocupados or usuario['email'] in ocupados:
+            duplicadas += 1
+            continue
+        ocupados.update((usuario['username'], usuario['email']))
+        usuario.update(role=rol, created_at=datetime.utcnow())  # sustituye el 'role' de la fila si hay rol_fijo
+        validas.append((linea, (usuario, perfil)))
+    return validas, duplicadas, errores
+
+def _insertar_usuarios(filas):
+    tabla = User.__table__
+    ids = db.session.execute(
+        insert(tabla).returning(tabla.c.id, sort_by_parameter_order=True), [usuario for usuario, _perfil in filas]
+    ).scalars().all()
+    exploradores, emprendedores = [], []
+    for user_id, (usuario, perfil) in zip(ids, filas):
+        if usuario['role'] == 'Explorador':
+            exploradores.append({'user_id': user_id, **perfil})
+        elif usuario['role'] == 'Emprendedor':
+            emprendedores.append({'user_id': user_id, **{k: v for k, v in perfil.items() if k != 'preferencias'}})
+    if exploradores:
+        db.session.execute(insert(Explorador.__table__), exploradores)
+    if emprendedores:
+        db.session.execute(insert(Emprendedor.__table__), emprendedores)
+
+def _consulta_exportar_usuarios(rol=None, con_hash=False):
+    perfil = [func.coalesce(getattr(Explorador, c), getattr(Emprendedor, c)).label(c)
+              for c in CAMPOS_PERFIL_IMPORTACION + ['fecha_nacimiento']]
+    columnas = [User.id, User.username, User.email, User.role, User.created_at, *perfil, Explorador.preferencias]
+    if con_hash:
+        columnas.append(User.password_hash)
+    consulta = select(*columnas).outerjoin(Explorador, Explorador.user_id == User.id)\
+        .outerjoin(Emprendedor, Emprendedor.user_id == User.id).order_by(User.id)
+    return consulta.where(User.role == rol) if rol else consulta
+
+def _exportar(ruta, formato, consulta):
+    """Vuelca la consulta por bloques de 1000 filas (yield_per): la memoria no depende del tamaño de la tabla."""
+    resultado = db.session.execute(consulta.execution_options(yield_per=1000))
+    with _abrir_intercambio(ruta, 'w') as archivo:
+        n = _escribir_intercambio(archivo, _formato_intercambio(ruta, formato), list(resultado.keys()), resultado)
+    click.echo(f'{n} filas exportadas', err=True)
+
+opcion_formato = click.option('--formato', type=click.Choice(['csv', 'jsonl']), help='Por defecto, según la extensión (.csv, .jsonl, .gz)')
+opcion_lote = click.option('--lote', default=1000, show_default=True)
+
+@app.cli.command('importar-empresas')
+@click.argument('ruta')
+@opcion_formato
+@opcion_lote
+def importar_empresas(ruta, formato, lote):
+    """Da de alta empresas desde CSV o JSONL; las de un nit ya registrado se omiten.
+
+    Columnas: nombre_emprendimiento y nit (obligatorias), clasificacion, plan, zona, ubicacion,
+    descripcion, url, rango_precios, imagen_filename y emprendedor (username o email). Acepta
+    tal cual lo que produce exportar-empresas.
+    """
+    totales = _importar_archivo(ruta, formato, lote, _preparar_empresas, _insertar_empresas)
+    _resumir_importacion(ruta, totales, EMPRESAS_IMPORTAR, 'Empresa')
+
+@app.cli.command('exportar-empresas')
+@click.argument('ruta', default='-')
+@opcion_formato
+def exportar_empresas(ruta, formato):
+    columnas = [getattr(Empresa, c) for c in ['id'] + CAMPOS_EMPRESA_IMPORTACION]
+    _exportar(ruta, formato, select(*columnas, User.username.label('emprendedor'), Empresa.favoritos_count, Empresa.visitas_count)
+              .outerjoin(Emprendedor, Emprendedor.id == Empresa.emprendedor_id)
+              .outerjoin(User, User.id == Emprendedor.user_id).order_by(Empresa.id))
+
+@app.cli.command('importar-usuarios')
+@click.argument('ruta')
+@opcion_formato
+@opcion_lote
+def importar_usuarios(ruta, formato, lote):
+    """Da de alta usuarios con su perfil de explorador o emprendedor; username o email repetidos se omiten.
+
+    Columnas: username, email, role, password (o password_hash ya calculado), primer_nombre,
+    segundo_nombre, primer_apellido, segundo_apellido, fecha_nacimiento (AAAA-MM-DD), telefono y
+    preferencias.
+    """
+    totales = _importar_archivo(ruta, formato, lote, _preparar_usuarios, _insertar_usuarios)
+    _resumir_importacion(ruta, totales, USUARIOS_IMPORTAR, 'Usuario')
+
+@app.cli.command('exportar-usuarios')
+@click.argument('ruta', default='-')
+@opcion_formato
+@click.option('--con-hash', is_flag=True, help='Incluir password_hash (para migrar a otra instancia)')
+def exportar_usuarios(ruta, formato, con_hash):
+    _exportar(ruta, formato, _consulta_exportar_usuarios(con_hash=con_hash))
+
+@app.cli.command('importar-exploradores')
+@click.argument('ruta')
+@opcion_formato
+@opcion_lote
+def importar_exploradores(ruta, formato, lote):
+    """Como importar-usuarios, pero todas las filas entran con rol Explorador."""
+    totales = _importar_archivo(ruta, formato, lote, functools.partial(_preparar_usuarios, rol_fijo='Explorador'),
+                                _insertar_usuarios)
+    _resumir_importacion(ruta, totales, USUARIOS_IMPORTAR, 'Explorador')
+
+@app.cli.command('exportar-exploradores')
+@click.argument('ruta', default='-')
+@opcion_formato
+@click.option('--con-hash', is_flag=True, help='Incluir password_hash (para migrar a otra instancia)')
+def exportar_exploradores(ruta, formato, con_hash):
+    _exportar(ruta, formato, _consulta_exportar_usuarios(rol='Explorador', con_hash=con_hash))
+
+# Búsqueda de empresas por nombre, descripción, clasificación y zona
+@app.route('/api/buscar')
+def buscar_empresas():
+    texto = request.args.get('q', '').strip()
+    limite = max(1, min(request.args.get('limite', 20, type=int), 100))
+
+    consulta = consulta_fts(texto)
+    if not consulta:
+        return jsonify({'q': texto, 'resultados': []})
+
+    if indice_busqueda_disponible():
+        # bm25: más peso al nombre, luego clasificación, zona y descripción
+        filas = db.session.execute(text("""
+            SELECT e.id, e.nombre_emprendimiento, e.clasificacion, e.zona, e.descripcion,
+                   e.imagen_filename, e.imagen_variantes, e.url, bm25(empresa_fts, 10.0, 2.0, 5.0, 3.0) AS puntaje
+            FROM empresa_fts
+            JOIN empresa e ON e.id = empresa_fts.rowid
+            WHERE empresa_fts MATCH :q
+            ORDER BY puntaje
+            LIMIT :limite
+        """), {'q': consulta, 'limite': limite}).mappings().all()
+    else:
+        app.logger.warning('Índice empresa_fts no disponible; usando LIKE (ejecuta flask reindexar-busqueda)')
+        patron = f'%{texto}%'
+        filas = [{
+            'id': e.id, 'nombre_emprendimiento': e.nombre_emprendimiento, 'clasificacion': e.clasificacion,
+            'zona': e.zona, 'descripcion': e.descripcion, 'imagen_filename': e.imagen_filename,
+            'imagen_variantes': e.imagen_variantes, 'url': e.url, 'puntaje': None
+        } for e in Empresa.query.filter(or_(
+            Empresa.nombre_emprendimiento.ilike(patron),
+            Empresa.descripcion.ilike(patron),
+            Empresa.clasificacion.ilike(patron),
+            Empresa.zona.ilike(patron)
+        )).limit(limite).all()]
+
+    return jsonify({
+        'q': texto,
+        'resultados': [{
+            'id': f['id'],
+            'nombre': f['nombre_emprendimiento'],
+            'clasificacion': f['clasificacion'],
+            'zona': f['zona'],
+            'descripcion': (f['descripcion'] or '')[:240],
+            'imagen': url_imagen_empresa(f['imagen_filename'], f['imagen_variantes']),
+            'url': f['url'] or '#',
+            'puntaje': f['puntaje']
+        } for f in filas]
     })
 
 
 
 @app.route('/eliminar_favorito/<int:fav_id>', methods=['POST'])
+@unidad_de_trabajo
 def eliminar_favorito(fav_id):
     if 'user_id' not in session or session.get('role') != 'Explorador':
         flash('Debes iniciar sesión como explorador.', 'warning')
@@ -883,29 +4874,30 @@ def eliminar_favorito(fav_id):
         return redirect(url_for('explorador_dashboard'))
 
     db.session.delete(favorito)
-    db.session.commit()
+    actualizar_coocurrencias(explorador.id, favorito.empresa_id, -1)
+    sumar_contador_empresa(favorito.empresa_id, 'favoritos_count', -1)
+    despues_de_confirmar(functools.partial(metricas.sumar, 'myiana_favoritos_total', accion='quitar'))
 
     empresa = Empresa.query.get(favorito.empresa_id)
     nombre_usuario = explorador.user.username if hasattr(explorador, 'user') and explorador.user else f"Explorador {explorador.id}"
 
-    log = LogAccion(
-        user_id=session['user_id'],
+    registrar_auditoria(
+        accion='Eliminación Favorito',
+        codigo=FAVORITO_ELIMINAR,
         tipo_entidad='Favorito',
         entidad_id=favorito.id,
-        accion='Eliminación Favorito',
+        empresa_id=favorito.empresa_id,
         detalles=f"El usuario {nombre_usuario} eliminó de favoritos la empresa {empresa.nombre_emprendimiento}",
     )
-    db.session.add(log)
-    db.session.commit()
     flash('Lugar eliminado de tus favoritos.', 'success')
     return redirect(url_for('explorador_dashboard'))
 
 @app.route('/api/auditoria_favoritos/<int:empresa_id>')
 def auditoria_favoritos(empresa_id):
     """Devuelve los registros de auditoría (LogAccion) relacionados con favoritos de esta empresa."""
-    logs = LogAccion.query.filter(
-        LogAccion.tipo_entidad == 'Favorito',
-        LogAccion.detalles.like(f'%empresa {Empresa.query.get(empresa_id).nombre_emprendimiento}%')
+    logs = LogAccion.query.options(joinedload(LogAccion.user)).filter(
+        LogAccion.empresa_id == empresa_id,
+        LogAccion.codigo_accion.in_([FAVORITO_AGREGAR, FAVORITO_ELIMINAR])
     ).order_by(LogAccion.fecha.desc()).limit(50).all()
 
     data = []
@@ -918,16 +4910,101 @@ def auditoria_favoritos(empresa_id):
         })
     return jsonify(data)
 
+# -------------------------------
+# Catálogo paginado por categoría (keyset) para el scroll infinito
+# -------------------------------
+# orden -> (expresión, descendente); todos dependen solo de datos que suben la versión de la categoría
+ORDENES_CATALOGO = {
+    'populares': (Empresa.favoritos_count, True),
+    'nombre': (func.lower(Empresa.nombre_emprendimiento), False),
+    'nombre_desc': (func.lower(Empresa.nombre_emprendimiento), True),
+    'recientes': (Empresa.id, True),
+}
+
+# Solo lo que pinta la tarjeta (y version, clave de cache_tarjetas); 241 caracteres bastan para saber si se recorta
+COLUMNAS_CATALOGO = (
+    Empresa.id, Empresa.version, Empresa.nombre_emprendimiento, Empresa.zona, Empresa.ubicacion,
+    Empresa.rango_precios, func.substr(Empresa.descripcion, 1, 241).label('descripcion'), Empresa.url,
+    Empresa.imagen_filename, Empresa.imagen_variantes, Empresa.favoritos_count
+)
+
+def pagina_catalogo(categoria, orden=None, cursor=None, zona=None, precio=None, limite=None):
+    """Una página de la categoría como filas proyectadas: (filas, siguiente_cursor); filas es None si el cursor no vale."""
+    expresion, descendente = ORDENES_CATALOGO.get(orden, ORDENES_CATALOGO['populares'])
+    consulta = db.session.query(*COLUMNAS_CATALOGO).filter(func.lower(Empresa.clasificacion) == categoria.lower())
+    if zona:
+        consulta = consulta.filter(Empresa.zona == zona)
+    if precio:
+        consulta = consulta.filter(Empresa.rango_precios == precio)
+    return paginar_keyset(consulta, expresion, Empresa.id, descendente, cursor, limite or app.config['CATALOGO_POR_PAGINA'])
+
+def _favoritos_del_usuario(ids):
+    """ids (de entre `ids`) que el explorador con sesión tiene en favoritos."""
+    if not ids or session.get('role') != 'Explorador':
+        return set()
+    return {empresa_id for (empresa_id,) in db.session.query(Favorito.empresa_id)
+            .join(Explorador, Explorador.id == Favorito.explorador_id)
+            .filter(Explorador.user_id == session.get('user_id'), Favorito.empresa_id.in_(ids))}
+
+@app.route('/api/catalogo/<string:categoria>')
+def api_catalogo(categoria):
+    """Páginas siguientes de /<categoria>: ?orden=populares|nombre|nombre_desc|recientes&zona=&precio=&cursor="""
+    def generar():
+        filas, siguiente = pagina_catalogo(
+            categoria,
+            orden=request.args.get('orden'),
+            cursor=request.args.get('cursor') or None,
+            zona=request.args.get('zona', '').strip() or None,
+            precio=request.args.get('precio', '').strip() or None,
+            limite=max(1, min(request.args.get('limite', app.config['CATALOGO_POR_PAGINA'], type=int), 100))
+        )
+        if filas is None:
+            return jsonify({'error': 'Cursor inválido'}), 400
+
+        guardados = _favoritos_del_usuario([f.id for f in filas])
+        return jsonify({
+            'items': [{
+                'id': f.id,
+                'nombre_emprendimiento': f.nombre_emprendimiento,
+                'zona': f.zona,
+                'ubicacion': f.ubicacion,
+                'rango_precios': f.rango_precios,
+                'descripcion': (f.descripcion or '')[:240] + ('...' if f.descripcion and len(f.descripcion) > 240 else ''),
+                'url': f.url,
+                'ficha': url_for('ver_emprendimiento', id=f.id),
+                'imagen': imagen_empresa(f.imagen_filename, f.imagen_variantes),
+                'favoritos_count': f.favoritos_count,
+                'guardado': f.id in guardados
+            } for f in filas],
+            'siguiente': siguiente
+        })
+    return respuesta_condicional_categoria(categoria, generar)
+
 @app.route('/<string:categoria>')
 def comida(categoria):
     # Busca case-insensitive
     username = session.get('username')
     role = session.get('role')
-    empresas = Empresa.query.filter(func.lower(Empresa.clasificacion) == categoria.lower()).all()
 
-    return render_template('Explorador/categoria.html',
-                           categoria=categoria,
-                           empresas=empresas,
-                           username=username,
-                           role=role)
+    def generar():
+        # Primera página en el servidor; las siguientes las pide el navegador a /api/catalogo/<categoria>
+        empresas, siguiente = pagina_catalogo(
+            categoria,
+            orden=request.args.get('orden'),
+            zona=request.args.get('zona', '').strip() or None,
+            precio=request.args.get('precio', '').strip() or None
+        )
+
+        # Lo que depende del usuario o de los favoritos se resuelve aquí, fuera de la caché de tarjetas
+        # (el conteo de favoritos ya viene en e.favoritos_count)
+        favoritos_usuario = _favoritos_del_usuario([e.id for e in empresas])
+
+        return render_template('Explorador/categoria.html',
+                               categoria=categoria,
+                               empresas=empresas,
+                               siguiente=siguiente,
+                               favoritos_usuario=favoritos_usuario,
+                               username=username,
+                               role=role)
+    return respuesta_condicional_categoria(categoria, generar)
 
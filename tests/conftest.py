@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py lee la configuración al importarse: base y directorios de trabajo en un temporal,
+# visitas y auditoría escritas en la misma transacción de la petición (sin hilos de buffer)
+_TMP = tempfile.mkdtemp(prefix='myianachia-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_TMP, 'site.db')
+os.environ['AUDITORIA_SPOOL_DIR'] = os.path.join(_TMP, 'auditoria_spool')
+os.environ['METRICAS_DIR'] = os.path.join(_TMP, 'metricas')
+os.environ['ARCHIVO_DIR'] = os.path.join(_TMP, 'archivo')
+os.environ['VISITAS_MODO'] = 'sync'
+os.environ['AUDITORIA_MODO'] = 'sync'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as myiana  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    myiana.app.config['TESTING'] = True
+    with myiana.app.app_context():
+        myiana.db.create_all()
+        yield myiana.app
+        myiana.db.session.remove()
+        myiana.db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def registrar(client, nombre, rol='Explorador'):
+    """Registra e inicia sesión con un usuario nuevo; devuelve su User."""
+    client.post('/register', data={'username': nombre, 'email': f'{nombre}@myiana.test', 'password': 'clave',
+                                   'role': rol, 'preferencias': 'Comida'})
+    client.post('/login', data={'identifier': nombre, 'password': 'clave'})
+    return myiana.User.query.filter_by(username=nombre).one()
+
+
+def crear_empresa(nombre, clasificacion='Comida', emprendedor=None):
+    empresa = myiana.Empresa(nombre_emprendimiento=nombre, nit=nombre, clasificacion=clasificacion,
+                             emprendedor_id=emprendedor.id if emprendedor else None)
+    myiana.db.session.add(empresa)
+    myiana.db.session.commit()
+    return empresa
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from conftest import myiana
+
+
+@pytest.fixture
+def caida():
+    """Estado de la base simulada por el escritor de los buffers de prueba."""
+    estado = {'caida': True, 'llamadas': 0, 'escritas': []}
+    yield estado
+    estado['caida'] = False
+
+
+def _escritor(estado):
+    def escribir(filas):
+        estado['llamadas'] += 1
+        if estado['caida']:
+            raise RuntimeError('base de datos caída')
+        estado['escritas'].extend(filas)
+    return escribir
+
+
+def _buffer(clase, estado, **kwargs):
+    buffer = clase('prueba', _escritor(estado), intervalo_ms=60000, max_filas=1000, max_cola=3, limite_cola=5, **kwargs)
+    myiana.BUFFERS.pop('prueba')
+    return buffer
+
+
+def test_buffer_con_la_base_caida_no_bloquea_ni_crece(app, caida):
+    buffer = _buffer(myiana.BufferEscritura, caida)
+    for i in range(3):
+        buffer.agregar({'n': i})
+    # La tercera fila llega a max_cola: vaciado en línea, que falla
+    assert (caida['llamadas'], buffer.fallos_seguidos) == (1, 1)
+
+    for i in range(3, 8):
+        buffer.agregar({'n': i})
+    # Ya fallando, las peticiones no vuelven a vaciar en línea y la cola no pasa del tope
+    assert caida['llamadas'] == 1
+    assert buffer.estadisticas()['profundidad_cola'] == 5
+    assert buffer.descartadas == 3
+
+    caida['caida'] = False
+    buffer.vaciar()  # dentro de la espera tras el error: no reintenta todavía
+    assert caida['llamadas'] == 1
+    buffer.vaciar(forzar=True)
+    assert [f['n'] for f in caida['escritas']] == [3, 4, 5, 6, 7]
+    assert buffer.fallos_seguidos == 0
+
+
+def test_auditoria_descartada_queda_en_el_spool(app, caida, tmp_path):
+    buffer = _buffer(myiana.BufferAuditoria, caida, directorio=str(tmp_path))
+    for i in range(8):
+        buffer.agregar({'accion': f'evento {i}'})
+    caida['caida'] = False
+    buffer.vaciar(forzar=True)
+
+    # Lo confirmado sale del spool; lo descartado sigue en disco para el reenvío
+    restantes = [json.loads(linea)['accion'] for ruta in sorted(tmp_path.iterdir()) for linea in ruta.read_text().splitlines()]
+    assert restantes == ['evento 0', 'evento 1', 'evento 2']
+    assert [f['accion'] for f in caida['escritas']] == [f'evento {i}' for i in range(3, 8)]
@@ -0,0 +1,21 @@
+from conftest import crear_empresa, myiana, registrar
+
+
+def test_reconciliar_corrige_solo_la_deriva(app):
+    cliente = app.test_client()
+    registrar(cliente, 'ana')
+    empresas = [crear_empresa('Arepas').id, crear_empresa('Tamales').id]
+    cliente.post('/favorito/toggle', json={'empresa_id': empresas[0]})
+    cliente.post(f'/registrar_visita/{empresas[0]}')
+    myiana.db.session.execute(myiana.text('UPDATE empresa SET favoritos_count = 7, visitas_count = 3 WHERE id = :id'),
+                              {'id': empresas[1]})
+    myiana.db.session.commit()
+
+    assert myiana.reconciliar_contadores_empresa(corregir=False) == [
+        (empresas[1], 'favoritos_count', 7, 0), (empresas[1], 'visitas_count', 3, 0)]
+    myiana.db.session.rollback()
+    assert len(myiana.reconciliar_contadores_empresa()) == 2
+    myiana.db.session.commit()
+
+    assert myiana.reconciliar_contadores_empresa(corregir=False) == []
+    assert [(e.favoritos_count, e.visitas_count) for e in myiana.Empresa.query.order_by(myiana.Empresa.id)] == [(1, 1), (0, 0)]
@@ -0,0 +1,21 @@
+import base64
+import json
+
+import pytest
+
+from conftest import crear_empresa, registrar
+
+
+def _cursor(carga):
+    return base64.urlsafe_b64encode(json.dumps(carga).encode()).decode()
+
+
+@pytest.mark.parametrize('valor', [{'a': 1}, [1, 2]])
+def test_cursor_con_valor_no_escalar_responde_400(app, valor):
+    cliente = app.test_client()
+    registrar(cliente, 'admin', rol='Administrador')
+    crear_empresa('Arepas')
+    cursor = _cursor({'v': valor, 'id': 1})
+
+    for url in ('/api/admin/logs', '/api/admin/empresas', '/api/catalogo/Comida'):
+        assert cliente.get(url, query_string={'cursor': cursor}).status_code == 400, url
@@ -0,0 +1,55 @@
+from conftest import crear_empresa, myiana, registrar
+
+
+def _version_categoria(categoria):
+    fila = myiana.db.session.get(myiana.VersionCategoria, categoria.lower())
+    return fila.version if fila else 0
+
+
+def test_eliminar_explorador_con_favoritos(app):
+    explorador_cliente, admin_cliente = app.test_client(), app.test_client()
+    usuario = registrar(explorador_cliente, 'ana')
+    registrar(admin_cliente, 'admin', rol='Administrador')
+    empresas = [crear_empresa('Arepas').id, crear_empresa('Tamales').id]
+    for empresa_id in empresas:
+        assert explorador_cliente.post('/favorito/toggle', json={'empresa_id': empresa_id}).get_json()['ok']
+    explorador_cliente.post(f'/registrar_visita/{empresas[0]}')
+    explorador_id = usuario.explorador.id
+    version = _version_categoria('Comida')
+    myiana.db.session.remove()
+
+    respuesta = admin_cliente.post(f'/eliminar_explorador/{explorador_id}')
+
+    assert respuesta.status_code == 302
+    assert myiana.db.session.get(myiana.Explorador, explorador_id) is None
+    assert myiana.Favorito.query.count() == 0
+    assert myiana.CoocurrenciaFavorito.query.count() == 0
+    assert [e.favoritos_count for e in myiana.Empresa.query.order_by(myiana.Empresa.id)] == [0, 0]
+    assert _version_categoria('Comida') > version
+    # La visita se conserva para las estadísticas, sin explorador
+    assert [(v.empresa_id, v.explorador_id) for v in myiana.Visita.query] == [(empresas[0], None)]
+
+
+def test_eliminar_emprendimiento_con_favoritos_y_visitas(app):
+    emprendedor_cliente, explorador_cliente, admin_cliente = app.test_client(), app.test_client(), app.test_client()
+    emprendedor = registrar(emprendedor_cliente, 'beto', rol='Emprendedor').emprendedor
+    registrar(explorador_cliente, 'ana')
+    registrar(admin_cliente, 'admin', rol='Administrador')
+    propia, ajena = crear_empresa('Arepas', emprendedor=emprendedor), crear_empresa('Tamales')
+    propia_id, ajena_id, emprendedor_id = propia.id, ajena.id, emprendedor.id
+    for empresa_id in (propia_id, ajena_id):
+        explorador_cliente.post('/favorito/toggle', json={'empresa_id': empresa_id})
+        explorador_cliente.post(f'/registrar_visita/{empresa_id}')
+    version = _version_categoria('Comida')
+    myiana.db.session.remove()
+
+    respuesta = admin_cliente.post(f'/eliminar_emprendimiento/{emprendedor_id}')
+
+    assert respuesta.status_code == 302
+    assert myiana.db.session.get(myiana.Empresa, propia_id) is None
+    assert [f.empresa_id for f in myiana.Favorito.query] == [ajena_id]
+    assert [v.empresa_id for v in myiana.Visita.query] == [ajena_id]
+    assert {v.empresa_id for v in myiana.VisitaDiaria.query} == {ajena_id}
+    assert {(c.empresa_a, c.empresa_b) for c in myiana.CoocurrenciaFavorito.query} == {(ajena_id, ajena_id)}
+    assert myiana.db.session.get(myiana.Empresa, ajena_id).favoritos_count == 1
+    assert _version_categoria('Comida') > version
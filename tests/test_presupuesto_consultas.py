@@ -0,0 +1,32 @@
+from flask.sessions import SecureCookieSessionInterface
+
+from conftest import crear_empresa, myiana, registrar
+
+
+def _sembrar(app):
+    """Varias filas en cada relación, para que un N+1 se note en el conteo de sentencias."""
+    registrar(app.test_client(), 'admin', rol='Administrador')
+    empresas = []
+    for i in range(3):
+        emprendedor = registrar(app.test_client(), f'emprendedor{i}', rol='Emprendedor').emprendedor
+        empresas += [crear_empresa(f'Empresa {i}-{j}', emprendedor=emprendedor).id for j in range(3)]
+    for i in range(4):
+        cliente = app.test_client()
+        registrar(cliente, f'explorador{i}')
+        for empresa_id in empresas[i:i + 5]:
+            cliente.post('/favorito/toggle', json={'empresa_id': empresa_id})
+            cliente.post(f'/registrar_visita/{empresa_id}')
+    myiana.db.session.remove()
+
+
+def test_rutas_dentro_de_su_presupuesto(app, monkeypatch):
+    _sembrar(app)
+    # Igual que `flask verificar-consultas`: detector activo y sesión en cookie (no cuenta sesion_servidor)
+    monkeypatch.setitem(app.config, 'DETECTAR_N_MAS_1', True)
+    monkeypatch.setattr(app, 'session_interface', SecureCookieSessionInterface())
+
+    resultados = myiana._medir_rutas_con_presupuesto()
+
+    assert {endpoint for _url, endpoint, _avisos in resultados} == set(myiana.PRESUPUESTO_CONSULTAS)
+    fuera_de_presupuesto = {url: avisos for url, _endpoint, avisos in resultados if avisos}
+    assert fuera_de_presupuesto == {}
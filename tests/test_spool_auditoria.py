@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from conftest import myiana
+
+EVENTO = {'accion': 'Creación', 'codigo_accion': 'USUARIO_CREAR', 'detalles': 'spool', 'fecha': '2024-01-01T00:00:00'}
+
+
+def _spool(directorio, nombre):
+    (directorio / nombre).write_text(json.dumps(EVENTO) + '\n', encoding='utf-8')
+
+
+def test_reenvio_fallido_vuelve_al_spool(app, tmp_path, monkeypatch):
+    _spool(tmp_path, 'auditoria-999999.jsonl')
+
+    def falla(*_args, **_kwargs):
+        raise RuntimeError('base de datos caída')
+    with monkeypatch.context() as m:
+        m.setattr(myiana, 'insert', falla)
+        with pytest.raises(RuntimeError):
+            myiana.reenviar_spool_auditoria(str(tmp_path), todos=True)
+
+    assert [p.name for p in tmp_path.iterdir()] == ['auditoria-999999.jsonl']
+    assert myiana.reenviar_spool_auditoria(str(tmp_path), todos=True) == 1
+    assert list(tmp_path.iterdir()) == []
+    assert myiana.LogAccion.query.count() == 1
+
+
+def test_reenvio_huerfano_se_recoge(app, tmp_path):
+    # Un reenvío que murió a medias deja el archivo con el prefijo de quien lo reclamó
+    _spool(tmp_path, 'reenvio-999999-auditoria-999998-3.enviando')
+
+    assert myiana.reenviar_spool_auditoria(str(tmp_path), todos=True) == 1
+    assert list(tmp_path.iterdir()) == []
+    assert myiana.LogAccion.query.one().detalles == 'spool'
@@ -0,0 +1,22 @@
+import pytest
+
+from conftest import myiana
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def test_misma_raiz_con_otra_extension_no_comparte_variantes(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'static_folder', str(tmp_path))
+    (tmp_path / 'Empresas').mkdir()
+    Image.new('RGB', (800, 600), 'red').save(tmp_path / 'Empresas' / 'arepas.jpg')
+    Image.new('RGB', (800, 600), 'blue').save(tmp_path / 'Empresas' / 'arepas.png')
+
+    with app.test_request_context():
+        variantes = {nombre: myiana.generar_variantes(nombre) for nombre in ('arepas.jpg', 'arepas.png')}
+        urls = {nombre: myiana.url_imagen_empresa(nombre, variantes[nombre], ancho=320) for nombre in variantes}
+
+    assert urls['arepas.jpg'] != urls['arepas.png']
+    for nombre, color in (('arepas.jpg', (255, 0, 0)), ('arepas.png', (0, 0, 255))):
+        archivo = tmp_path / urls[nombre].split('?')[0].removeprefix('/static/')
+        with Image.open(archivo) as variante:
+            assert all(abs(a - b) < 8 for a, b in zip(variante.getpixel((10, 10)), color))